@@ -0,0 +1,233 @@
+"""
+Load test for the WebSocket chat path.
+
+Connects N simulated users to ChatConsumer through channels.testing, has
+them message random peers at a fixed aggregate rate, and reports
+send-to-deliver latency percentiles, delivered messages/sec, DB queries
+per message and memory per connection. Runs against a throwaway test
+database and either the in-memory channel layer or a local Redis.
+
+Usage:
+    python benchmarks/bench_chat.py [--users 50] [--rate 200] [--duration 10]
+                                    [--layer memory|redis] [--redis-url redis://localhost:6379]
+                                    [--output results.json] [--json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.db import database_sync_to_async  # noqa: E402
+from channels.layers import channel_layers  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+
+from chat import encoding  # noqa: E402
+from chat.routing import websocket_urlpatterns  # noqa: E402
+
+
+class QueryCounter:
+    """Counts queries on every DB connection, including worker-thread ones."""
+
+    def __init__(self):
+        self.count = 0
+        self.enabled = False
+        connection_created.connect(self.install, weak=False)
+        self.install(connection=connection)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.enabled:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def configure_layer(args):
+    if args.layer == "redis":
+        settings.CHANNEL_LAYERS = {
+            "default": {
+                "BACKEND": "chat.layers.FanoutRedisChannelLayer",
+                "CONFIG": {"hosts": [args.redis_url]},
+            }
+        }
+    else:
+        settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    channel_layers.backends.clear()
+
+
+@database_sync_to_async
+def create_users(count):
+    User.objects.bulk_create([User(username=f"bench{i}", password="!") for i in range(count)])
+    return list(User.objects.filter(username__startswith="bench").order_by("id"))
+
+
+async def connect(application, user):
+    communicator = WebsocketCommunicator(application, "/ws/chat/?acks=1")
+    communicator.scope["user"] = user
+    connected, _ = await communicator.connect(timeout=10)
+    if not connected:
+        raise RuntimeError(f"{user.username} could not connect")
+    await communicator.receive_from(timeout=10)  # connection_established
+    return communicator
+
+
+async def receive_loop(communicator, user_id, latencies):
+    frames = 1  # connection_established
+    while True:
+        try:
+            text = await communicator.receive_from(timeout=3600)
+        except asyncio.TimeoutError:
+            continue
+        # Acknowledge every frame at once, like a client that keeps up
+        frames += 1
+        await communicator.send_to(text_data=encoding.dumps({"type": "ack", "frames": frames}))
+        data = encoding.loads(text)
+        for event in data if isinstance(data, list) else [data]:
+            if event.get("recipient_id") != user_id or "content" not in event:
+                continue  # own echoes, presence and receipts
+            sent_at = float(event["content"].split(":", 1)[1])
+            latencies.append(time.perf_counter() - sent_at)
+
+
+async def send_loop(communicator, peers, interval, deadline, counter):
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.perf_counter() < deadline:
+        await communicator.send_to(text_data=encoding.dumps({
+            "message": f"bench:{time.perf_counter()!r}",
+            "recipient_id": random.choice(peers).id,
+        }))
+        counter[0] += 1
+        await asyncio.sleep(interval)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return {}
+    # Inclusive: the default method extrapolates past the slowest sample
+    top = max(values)
+    cuts = [min(cut, top) for cut in statistics.quantiles(values, n=100, method="inclusive")]
+    return {
+        "p50": cuts[49] * 1000,
+        "p95": cuts[94] * 1000,
+        "p99": cuts[98] * 1000,
+        "max": top * 1000,
+    }
+
+
+async def run(args):
+    configure_layer(args)
+    queries = QueryCounter()
+    application = URLRouter(websocket_urlpatterns)
+    users = await create_users(args.users)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    communicators = [await connect(application, user) for user in users]
+    memory_per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / len(users)
+    tracemalloc.stop()
+
+    latencies = []
+    sent = [0]
+    receivers = [asyncio.create_task(receive_loop(communicator, user.id, latencies))
+                 for communicator, user in zip(communicators, users)]
+
+    queries.enabled = True
+    interval = args.users / args.rate
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(
+        send_loop(communicator, [peer for peer in users if peer.id != user.id], interval, deadline, sent)
+        for communicator, user in zip(communicators, users)
+    ))
+
+    # Give in-flight messages a chance to arrive before measuring
+    drain_until = time.perf_counter() + args.drain
+    while len(latencies) < sent[0] and time.perf_counter() < drain_until:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    queries.enabled = False
+
+    for task in receivers:
+        task.cancel()
+    for communicator in communicators:
+        await communicator.disconnect()
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "layer": args.layer,
+        "encoder": "orjson" if encoding.orjson is not None else "json",
+        "durability": getattr(settings, "CHAT_MESSAGE_DURABILITY", "commit"),
+        "users": args.users,
+        "target_rate": args.rate,
+        "duration": args.duration,
+        "messages_sent": sent[0],
+        "messages_delivered": len(latencies),
+        "messages_per_second": len(latencies) / elapsed,
+        "latency_ms": percentiles(latencies),
+        "db_queries_per_message": queries.count / sent[0] if sent[0] else None,
+        "memory_per_connection_kb": memory_per_connection / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="simulated connected users")
+    parser.add_argument("--rate", type=float, default=200, help="messages/sec across all users")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for in-flight messages")
+    parser.add_argument("--layer", choices=["memory", "redis"], default="memory")
+    parser.add_argument("--redis-url", default="redis://localhost:6379")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+    if args.users < 2:
+        parser.error("--users must be at least 2")
+
+    # Per-connection INFO logging would dominate the measurement
+    logging.disable(logging.INFO)
+    old_config = connection.creation.create_test_db(verbosity=0)
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        connection.creation.destroy_test_db(old_config, verbosity=0)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2) + "\n")
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{args.users} users, {args.layer} layer, {result['encoder']} encoder, "
+          f"{result['durability']} durability")
+    print(f"  sent {result['messages_sent']}, delivered {result['messages_delivered']}, "
+          f"{result['messages_per_second']:.1f} msgs/sec")
+    for name, millis in result["latency_ms"].items():
+        print(f"  {name:<4}{millis:9.2f} ms")
+    if result["db_queries_per_message"] is not None:
+        print(f"  {result['db_queries_per_message']:.2f} DB queries/message")
+    print(f"  {result['memory_per_connection_kb']:.1f} KiB/connection")
+
+
+if __name__ == "__main__":
+    main()
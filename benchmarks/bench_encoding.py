@@ -0,0 +1,96 @@
+"""
+Per-message CPU cost of building, fanning out and sending a chat event.
+
+Compares the old path (dict event, serialized by the channel layer per
+group, json.dumps per receiving socket) with the pre-encoded path (JSON
+encoded once, forwarded as-is). The channel layer's msgpack round-trip is
+included since that is what channels_redis does per group.
+
+Usage:
+    python benchmarks/bench_encoding.py [--sockets 3] [--groups 2] [--number 20000] [--json]
+"""
+import argparse
+import json
+import sys
+import timeit
+from datetime import datetime, timezone
+from pathlib import Path
+
+import msgpack
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chat import encoding  # noqa: E402
+
+
+def make_message(content_size):
+    return {
+        "id": 123456,
+        "sender": "user1",
+        "sender_id": 1,
+        "recipient_id": 2,
+        "content": "x" * content_size,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def before(message, groups, sockets):
+    event = {"type": "chat_message", "message": dict(message)}
+    for _ in range(groups):
+        packed = msgpack.packb(event, use_bin_type=True)
+    for _ in range(sockets):
+        received = msgpack.unpackb(packed, raw=False)
+        json.dumps(received["message"])
+
+
+def after(message, groups, sockets):
+    event = {"type": "chat_message", "text": encoding.dumps(message)}
+    for _ in range(groups):
+        packed = msgpack.packb(event, use_bin_type=True)
+    for _ in range(sockets):
+        received = msgpack.unpackb(packed, raw=False)
+        received["text"]
+
+
+def run(args):
+    message = make_message(args.content_size)
+    results = {}
+    for name, func in (("before", before), ("after", after)):
+        seconds = min(timeit.repeat(
+            lambda: func(message, args.groups, args.sockets),
+            number=args.number, repeat=args.repeat,
+        ))
+        results[name] = seconds / args.number * 1e6
+    return {
+        "encoder": "orjson" if encoding.orjson is not None else "json",
+        "groups": args.groups,
+        "sockets": args.sockets,
+        "content_size": args.content_size,
+        "us_per_message": results,
+        "speedup": results["before"] / results["after"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=3, help="receiving sockets per message")
+    parser.add_argument("--groups", type=int, default=2, help="groups the event is sent to")
+    parser.add_argument("--content-size", type=int, default=200)
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"encoder: {result['encoder']}, {args.groups} groups, {args.sockets} sockets, "
+          f"{args.content_size} byte messages")
+    for name, micros in result["us_per_message"].items():
+        print(f"  {name:<7}{micros:8.2f} us/message")
+    print(f"  speedup {result['speedup']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
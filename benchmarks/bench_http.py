@@ -0,0 +1,219 @@
+"""
+HTTP throughput of the chat pages and APIs: ASGI workers vs gunicorn.
+
+Logs in as a benchmark user, then keeps --concurrency keep-alive
+connections busy requesting --paths for --duration seconds and reports
+requests/sec and latency percentiles per server.
+
+With --compare it starts both servers itself on local ports, with the
+same worker count and the settings in DJANGO_SETTINGS_MODULE (default
+chat_project.settings):
+    asgi  python daphne_server.py --workers N
+    wsgi  gunicorn --workers N chat_project.wsgi   (pip install gunicorn)
+Without --compare it benchmarks an already running server at --url.
+
+Usage:
+    python benchmarks/bench_http.py --compare [--workers 3] [--concurrency 50] [--duration 10] [--json]
+    python benchmarks/bench_http.py --url http://127.0.0.1:8001 [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+from http.cookiejar import CookieJar
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
+
+USERNAME = "benchuser"
+PASSWORD = "bench-pass-123"
+
+
+def ensure_user():
+    import django
+
+    django.setup()
+    from django.contrib.auth.models import User
+
+    user, created = User.objects.get_or_create(username=USERNAME)
+    if created:
+        user.set_password(PASSWORD)
+        user.save()
+
+
+def login(base_url):
+    """Log in through the real form and return the Cookie header to reuse."""
+    jar = CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    page = opener.open(f"{base_url}/login/").read().decode()
+    token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', page).group(1)
+    form = urllib.parse.urlencode({"username": USERNAME, "password": PASSWORD, "csrfmiddlewaretoken": token})
+    opener.open(urllib.request.Request(f"{base_url}/login/", data=form.encode(),
+                                       headers={"Referer": f"{base_url}/login/"}))
+    cookies = {cookie.name: cookie.value for cookie in jar}
+    if "sessionid" not in cookies:
+        raise RuntimeError("login failed; is the benchmark user in this server's database?")
+    return "; ".join(f"{name}={value}" for name, value in cookies.items())
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    headers = dict(
+        line.split(b": ", 1) for line in head.split(b"\r\n")[1:] if b": " in line
+    )
+    headers = {key.lower(): value for key, value in headers.items()}
+    if b"content-length" in headers:
+        await reader.readexactly(int(headers[b"content-length"]))
+    elif headers.get(b"transfer-encoding") == b"chunked":
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    return status, headers.get(b"connection") == b"close"
+
+
+async def client(host, port, requests, deadline, latencies, errors):
+    reader = writer = None
+    index = 0
+    while time.perf_counter() < deadline:
+        if writer is None:
+            reader, writer = await asyncio.open_connection(host, port)
+        started = time.perf_counter()
+        writer.write(requests[index % len(requests)])
+        index += 1
+        try:
+            status, closed = await read_response(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            errors[0] += 1
+            writer.close()
+            writer = None
+            continue
+        latencies.append(time.perf_counter() - started)
+        if status >= 400:
+            errors[0] += 1
+        if closed:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def load(args, base_url, cookie):
+    url = urllib.parse.urlsplit(base_url)
+    requests = [
+        (f"GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\nCookie: {cookie}\r\n"
+         f"Accept: application/json\r\n\r\n").encode()
+        for path in args.paths.split(",")
+    ]
+    latencies, errors = [], [0]
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(
+        client(url.hostname, url.port, requests, deadline, latencies, errors)
+        for _ in range(args.concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+    # Inclusive: the default method extrapolates past the slowest sample
+    cuts = ([min(cut, max(latencies)) for cut in statistics.quantiles(latencies, n=100, method="inclusive")]
+            if len(latencies) > 1 else [0] * 99)
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_ms": {"p50": cuts[49] * 1000, "p95": cuts[94] * 1000, "p99": cuts[98] * 1000},
+    }
+
+
+def wait_for(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"{base_url}/login/", timeout=5)
+            return
+        except OSError:  # URLError, refused, timed out
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+
+def start_server(kind, args, port):
+    if kind == "asgi":
+        command = [sys.executable, str(BASE_DIR / "daphne_server.py"),
+                   "--workers", str(args.workers), "--port", str(port)]
+    else:
+        command = [shutil.which("gunicorn"), "--workers", str(args.workers),
+                   "--bind", f"127.0.0.1:{port}", "chat_project.wsgi:application"]
+    return subprocess.Popen(command, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run(args):
+    if not args.compare:
+        return {"url": args.url, **asyncio.run(load(args, args.url, login(args.url)))}
+
+    ensure_user()
+    results = {}
+    for kind, port in (("asgi", args.port), ("wsgi", args.port + 1)):
+        if kind == "wsgi" and shutil.which("gunicorn") is None:
+            print("gunicorn not installed; skipping the wsgi baseline", file=sys.stderr)
+            continue
+        server = start_server(kind, args, port)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            wait_for(base_url)
+            results[kind] = asyncio.run(load(args, base_url, login(base_url)))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--compare", action="store_true", help="start and benchmark both server types")
+    parser.add_argument("--url", default="http://127.0.0.1:8001", help="server to benchmark without --compare")
+    parser.add_argument("--port", type=int, default=18001, help="first local port used by --compare")
+    parser.add_argument("--workers", type=int, default=3, help="worker processes per server with --compare")
+    parser.add_argument("--paths", default="/api/users/,/api/conversations/,/api/messages/?user_id=1,/",
+                        help="comma-separated paths requested round-robin")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    result = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "settings": os.environ["DJANGO_SETTINGS_MODULE"],
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "paths": args.paths.split(","),
+        "results": run(args),
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2) + "\n")
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    runs = result["results"] if args.compare else {"server": result["results"]}
+    print(f"{args.concurrency} connections for {args.duration}s over {len(result['paths'])} paths")
+    for name, stats in runs.items():
+        latency = stats["latency_ms"]
+        print(f"  {name:<6}{stats['requests_per_second']:9.1f} req/s  p50 {latency['p50']:.1f} ms  "
+              f"p95 {latency['p95']:.1f} ms  p99 {latency['p99']:.1f} ms  errors {stats['errors']}")
+
+
+if __name__ == "__main__":
+    main()
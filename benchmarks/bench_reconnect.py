@@ -0,0 +1,186 @@
+"""
+Reconnect storm load test.
+
+Connects N simulated users to ChatConsumer through channels.testing, drops
+every connection at once (as when a worker restarts), then has all of them
+reconnect with the browser client's policy: full-jitter exponential backoff,
+and the server's retry_after on a 1013 close. Reports how long until every
+user is back, admitted connections per second over time, rejections and
+connect latency percentiles.
+
+Run it with and without admission control to compare:
+
+    python benchmarks/bench_reconnect.py [--users 500] [--connect-rate 100] [--burst 50]
+                                         [--output results.json] [--json]
+    python benchmarks/bench_reconnect.py --connect-rate 0      # admission off
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.db import database_sync_to_async  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from chat import encoding  # noqa: E402
+from chat.routing import websocket_urlpatterns  # noqa: E402
+from chat.workers import CLOSE_TRY_AGAIN_LATER, connect_admission  # noqa: E402
+
+# Mirrors static/js/chat.js
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+@database_sync_to_async
+def create_users(count):
+    User.objects.bulk_create([User(username=f"storm{i}", password="!") for i in range(count)])
+    return list(User.objects.filter(username__startswith="storm").order_by("id"))
+
+
+async def try_connect(application, user):
+    """Return (communicator, None) once connected, or (None, retry_after) if turned away."""
+    communicator = WebsocketCommunicator(application, "/ws/chat/")
+    communicator.scope["user"] = user
+    connected, _ = await communicator.connect(timeout=30)
+    if not connected:
+        return None, None
+    output = await communicator.receive_output(timeout=30)
+    if output["type"] == "websocket.close":
+        return None, None
+    data = encoding.loads(output["text"])
+    if data.get("type") == "retry_after":
+        close = await communicator.receive_output(timeout=30)
+        assert close.get("code") == CLOSE_TRY_AGAIN_LATER
+        await communicator.wait()
+        return None, data["retry_after"]
+    return communicator, None
+
+
+async def reconnect(application, user, started, stats):
+    """The client's reconnect loop after an unexpected close."""
+    attempt = 0
+    delay = backoff_delay(attempt)
+    while True:
+        await asyncio.sleep(delay)
+        attempted = time.perf_counter()
+        communicator, retry_after = await try_connect(application, user)
+        stats["attempts"] += 1
+        if communicator is not None:
+            now = time.perf_counter()
+            stats["connect_latency"].append(now - attempted)
+            stats["admitted_per_second"][int(now - started)] += 1
+            stats["recovered_at"].append(now - started)
+            return communicator
+        if retry_after is not None:
+            stats["rejected"] += 1
+            delay = retry_after * (1 + random.uniform(0, 0.5))
+        else:
+            attempt += 1
+            delay = backoff_delay(attempt)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return {}
+    # Inclusive: the default method extrapolates past the slowest sample
+    top = max(values)
+    cuts = [min(cut, top) for cut in statistics.quantiles(values, n=100, method="inclusive")]
+    return {"p50": cuts[49] * 1000, "p95": cuts[94] * 1000, "p99": cuts[98] * 1000, "max": top * 1000}
+
+
+async def run(args):
+    application = URLRouter(websocket_urlpatterns)
+    users = await create_users(args.users)
+
+    # Initial connections aren't part of the measurement
+    connect_admission.configure(None, 0)
+    communicators = [(await try_connect(application, user))[0] for user in users]
+
+    connect_admission.configure(args.connect_rate or None, args.burst)
+    for communicator in communicators:
+        await communicator.disconnect()
+
+    stats = {"attempts": 0, "rejected": 0, "connect_latency": [],
+             "admitted_per_second": Counter(), "recovered_at": []}
+    started = time.perf_counter()
+    communicators = await asyncio.wait_for(
+        asyncio.gather(*(reconnect(application, user, started, stats) for user in users)),
+        args.timeout,
+    )
+    recovery = time.perf_counter() - started
+    for communicator in communicators:
+        await communicator.disconnect()
+
+    timeline = [stats["admitted_per_second"][second] for second in range(int(recovery) + 1)]
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "users": args.users,
+        "connect_rate": args.connect_rate or None,
+        "burst": args.burst,
+        "recovery_seconds": recovery,
+        "half_recovered_seconds": sorted(stats["recovered_at"])[len(users) // 2],
+        "attempts": stats["attempts"],
+        "rejected": stats["rejected"],
+        "peak_admitted_per_second": max(timeline),
+        "admitted_per_second": timeline,
+        "connect_latency_ms": percentiles(stats["connect_latency"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500, help="simulated connected users")
+    parser.add_argument("--connect-rate", type=float, default=100,
+                        help="admitted connections/sec during the storm, 0 to turn admission off")
+    parser.add_argument("--burst", type=int, default=50, help="admission burst size")
+    parser.add_argument("--timeout", type=float, default=300, help="give up if not recovered in this many seconds")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    # Per-connection INFO logging would dominate the measurement
+    logging.disable(logging.INFO)
+    old_config = connection.creation.create_test_db(verbosity=0)
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        connection.creation.destroy_test_db(old_config, verbosity=0)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2) + "\n")
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    admission = f"{args.connect_rate:g}/s admission, burst {args.burst}" if args.connect_rate else "no admission"
+    print(f"{args.users} users reconnecting at once, {admission}")
+    print(f"  all back in {result['recovery_seconds']:.1f}s (half in {result['half_recovered_seconds']:.1f}s), "
+          f"{result['attempts']} attempts, {result['rejected']} rejected")
+    print(f"  admitted/sec: {' '.join(str(count) for count in result['admitted_per_second'])}")
+    for name, millis in result["connect_latency_ms"].items():
+        print(f"  connect {name:<4}{millis:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
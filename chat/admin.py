@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ChatMessage
+from .models import ChatMessage, Conversation
 
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
@@ -7,4 +7,11 @@ class ChatMessageAdmin(admin.ModelAdmin):
     list_filter = ('sender', 'recipient', 'timestamp', 'is_read')
     search_fields = ('sender__username', 'recipient__username', 'content')
     date_hierarchy = 'timestamp'
-    ordering = ('-timestamp',)
\ No newline at end of file
+    ordering = ('-timestamp',)
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('user_low', 'user_high', 'last_timestamp', 'retention_days')
+    search_fields = ('user_low__username', 'user_high__username')
+    raw_id_fields = ('user_low', 'user_high', 'last_message')
+    ordering = ('-last_timestamp',)
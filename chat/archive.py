@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .conversations import forget_unread
+from .models import ArchivedChatMessage, ChatMessage, Conversation
+
+ARCHIVED_FIELDS = ('id', 'sender_id', 'recipient_id', 'content', 'timestamp', 'is_read')
+
+
+def archive_cutoff(days=None):
+    if days is None:
+        days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 90)
+    return timezone.now() - timedelta(days=days)
+
+
+def archive_batch(cutoff, batch_size=1000):
+    """
+    Move the oldest ``batch_size`` messages sent before ``cutoff`` into
+    ArchivedChatMessage, in one short transaction. Returns how many moved.
+
+    Unread messages stop counting towards their conversation's unread
+    total once archived, since receipts only mark recent messages read.
+    """
+    with transaction.atomic():
+        rows = list(
+            ChatMessage.objects.filter(timestamp__lt=cutoff)
+            .order_by('timestamp', 'id')
+            .values(*ARCHIVED_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return 0
+        ids = [row['id'] for row in rows]
+        ArchivedChatMessage.objects.bulk_create([ArchivedChatMessage(**row) for row in rows])
+        Conversation.objects.filter(last_message_id__in=ids).update(last_message=None)
+        ChatMessage.objects.filter(id__in=ids).delete()
+        forget_unread(rows)
+    return len(rows)
@@ -0,0 +1,68 @@
+"""
+PostgreSQL backend that borrows connections from a per-process pool.
+
+Django opens one connection per thread and, with CONN_MAX_AGE = 0, closes
+it after every request and every database_sync_to_async call. Here
+"connect" borrows an open connection from chat.pool.ConnectionPool and
+"close" returns it, so Django keeps its per-thread, per-request
+semantics without paying the TCP and auth handshake each time.
+
+Configured through a POOL entry next to the usual database settings:
+
+    'ENGINE': 'chat.backends.postgresql_pool',
+    'POOL': {
+        'MAX_SIZE': 20,                # connections per process
+        'TIMEOUT': 10,                 # seconds to wait for a free one
+        'HEALTH_CHECK_INTERVAL': 30,   # idle seconds before SELECT 1 on checkout
+        'MAX_LIFETIME': 3600,          # recycle connections older than this
+    },
+"""
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+
+from chat.pool import get_pool
+
+if is_psycopg3:
+    from psycopg.pq import TransactionStatus
+
+    TRANSACTION_STATUS_UNKNOWN = TransactionStatus.UNKNOWN
+else:
+    from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_pool(self, conn_params):
+        options = self.settings_dict.get('POOL', {})
+        return get_pool(
+            self.alias,
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+            max_size=options.get('MAX_SIZE', 10),
+            timeout=options.get('TIMEOUT', 10),
+            health_check_interval=options.get('HEALTH_CHECK_INTERVAL', 30),
+            max_lifetime=options.get('MAX_LIFETIME', 3600),
+        )
+
+    def get_new_connection(self, conn_params):
+        return self.get_pool(conn_params).getconn()
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            # Closed mid-transaction, Django keeps referring to the connection
+            # until the atomic block exits, so it can't go back to the pool.
+            # Otherwise only what the driver already knows is checked: a
+            # query here would cost every request a round trip, and idle
+            # connections are health-checked on checkout instead
+            discard = self.in_atomic_block or self._broken()
+            self.get_pool(self.get_connection_params()).putconn(self.connection, discard=discard)
+
+    def _broken(self):
+        if self.connection.closed:
+            return True
+        if is_psycopg3:
+            status = self.connection.info.transaction_status
+        else:
+            status = self.connection.get_transaction_status()
+        return status == TRANSACTION_STATUS_UNKNOWN
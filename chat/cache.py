@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+MISSING = object()
+
+CachedUser = namedtuple('CachedUser', ['id', 'username'])
+
+
+class LRUCache:
+    """Bounded, thread-safe LRU cache with a per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        """Drop every entry whose value satisfies ``predicate``."""
+        with self._lock:
+            for key in [key for key, (value, _) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Users by id: CachedUser for existing users, None for ids known not to exist
+user_cache = LRUCache(
+    maxsize=getattr(settings, 'CHAT_USER_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_USER_CACHE_TTL', 300),
+)
+
+
+def cache_user(user):
+    user_cache.set(user.id, CachedUser(user.id, user.username))
+
+
+def load_user(user_id):
+    """Query the user row and cache the result, including a miss."""
+    row = User.objects.filter(id=user_id).values_list('id', 'username').first()
+    cached = CachedUser(*row) if row else None
+    user_cache.set(user_id, cached)
+    return cached
+
+
+def get_cached_user(user_id):
+    """Return a CachedUser for ``user_id`` (or None if it doesn't exist), querying only on a miss."""
+    cached = user_cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+    return load_user(user_id)
+
+
+# Users resolved for WebSocket handshakes, by session key. Logging out drops
+# the entry in the process that handled the logout; other processes keep
+# theirs until the short TTL runs out.
+session_user_cache = LRUCache(
+    maxsize=getattr(settings, 'CHAT_SESSION_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_SESSION_CACHE_TTL', 30),
+)
+
+
+def forget_user_sessions(user_id):
+    session_user_cache.invalidate_matching(lambda user: user.id == user_id)
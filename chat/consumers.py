@@ -1,71 +1,209 @@
-import json
+import asyncio
 import logging
+import time
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from .models import ChatMessage, UserActivity
-from django.utils import timezone
+from .encoding import dumps, loads, JSONDecodeError
+from .models import ChatMessage
+from .presence import presence_tracker, connection_tracker, presence_group, publish_presence
+from .conversations import conversations_for
+from .persistence import message_writer, DURABILITY_DELIVER
+from .cache import load_user, user_cache, MISSING
+from .layers import group_send_many
+from .receipts import mark_read
+from .replay import message_log, messages_after, with_seq
+from . import metrics
+from .outbound import OutboundBuffer
+from .ratelimit import TokenBucket, user_message_limiter
+from .workers import (
+    connection_registry, connect_admission,
+    CLOSE_POLICY_VIOLATION, CLOSE_SERVICE_RESTART, CLOSE_SLOW_CONSUMER, CLOSE_TRY_AGAIN_LATER,
+)
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+from urllib.parse import parse_qs
 
 logger = logging.getLogger(__name__)
 
+async def mark_offline(channel_layer, user_id):
+    await database_sync_to_async(presence_tracker.touch)(user_id, False)
+    await publish_presence(channel_layer, user_id, False)
+
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         try:
             self.user = self.scope["user"]
-            logger.info(f"Connection attempt by user: {self.user}")
+            logger.info("Connection attempt by user: %s", self.user)
             
             if not self.user.is_authenticated:
                 logger.warning("Unauthenticated connection attempt")
                 await self.close(code=4001)
                 return
 
+            if connection_registry.draining:
+                # This worker is shutting down; send the client to another one
+                await self.accept()
+                await self.close(code=CLOSE_SERVICE_RESTART)
+                return
+
+            retry_after = connect_admission.admit()
+            if retry_after:
+                # Over this worker's connect rate: tell the client when to come back
+                metrics.ws_connections_rejected.inc()
+                await self.accept()
+                await self.send(dumps({"type": "retry_after", "retry_after": round(retry_after, 2)}))
+                await self.close(code=CLOSE_TRY_AGAIN_LATER)
+                return
+
             # Update user activity
             await self.update_user_activity(True)  # Set as online
 
             self.user_room = f"user_{self.user.id}"
+            self.pending_receipts = {}
+            self.receipt_task = None
+            self.persist_tasks = set()
+            self.presence_subscriptions = set()
+            rate = getattr(settings, 'CHAT_MESSAGE_RATE', 5)
+            self.message_bucket = TokenBucket(rate, getattr(settings, 'CHAT_MESSAGE_BURST', 20)) if rate else None
+            rate = getattr(settings, 'CHAT_CONTROL_RATE', 5)
+            self.control_bucket = TokenBucket(rate, getattr(settings, 'CHAT_CONTROL_BURST', 30)) if rate else None
+            self.rejected_in_a_row = 0
             await self.channel_layer.group_add(self.user_room, self.channel_name)
             await self.accept()
-            logger.info(f"WebSocket connection established for user: {self.user}")
+            # Every frame from here on is counted against the client's acks
+            self.outbound = OutboundBuffer(
+                self.send,
+                size=getattr(settings, 'CHAT_OUTBOUND_BUFFER', 256),
+                batch_size=getattr(settings, 'CHAT_OUTBOUND_BATCH', 50),
+                policy=getattr(settings, 'CHAT_OUTBOUND_POLICY', 'coalesce'),
+                window=getattr(settings, 'CHAT_OUTBOUND_WINDOW', 64),
+                acking=parse_qs(self.scope.get("query_string", b"").decode()).get("acks") == ["1"],
+                ack_timeout=getattr(settings, 'CHAT_OUTBOUND_ACK_TIMEOUT', 30),
+                on_stalled=self.acks_stalled,
+            )
+            connection_registry.add(self)
+            presence_tracker.start_flushing()
+            logger.info("WebSocket connection established for user: %s", self.user)
+
+            # Read after joining the user's group, so every message is either
+            # replayed here or delivered live (live duplicates are skipped)
+            resumed, replay = await self.missed_messages()
             
             # Send connection confirmation
-            await self.send(json.dumps({
+            await self.outbound.send_now(dumps({
                 "type": "connection_established",
-                "message": "Connected to chat server"
+                "message": "Connected to chat server",
+                "heartbeat_interval": getattr(settings, 'CHAT_HEARTBEAT_INTERVAL', 25),
+                "seq": self.replayed_seq,
+                "resumed": resumed,
             }))
+            for text in replay:
+                await self.outbound.send_now(text)
+            # Events after the replay are queued behind it, in order
+            self.outbound.start()
+
+            # Only the user's first connection, on any worker, announces them as online
+            try:
+                went_online = await connection_tracker.connected(self.user.id, self.channel_name)
+            except Exception as e:
+                logger.error("Error counting connection of %s: %s", self.user.id, e)
+                went_online = True
+            self.connection_counted = True
+            metrics.ws_connections.inc()
+            await self.subscribe_presence(await self.get_contact_ids())
+            if went_online:
+                await publish_presence(self.channel_layer, self.user.id, True)
             
         except Exception as e:
-            logger.error(f"Error in connect: {str(e)}")
+            logger.error("Error in connect: %s", e)
             await self.close(code=4002)
 
     async def disconnect(self, close_code):
         try:
-            logger.info(f"WebSocket disconnected with code: {close_code}")
+            logger.info("WebSocket disconnected with code: %s", close_code)
+            connection_registry.discard(self)
+            if getattr(self, 'outbound', None):
+                self.outbound.close()
             
-            # Update user activity to offline
-            if hasattr(self, 'user') and self.user.is_authenticated:
-                await self.update_user_activity(False)  # Set as offline
+            # Go offline once the last connection is gone, debounced so
+            # reconnects and extra tabs don't flap presence
+            if getattr(self, 'connection_counted', False):
+                metrics.ws_connections.dec()
+                try:
+                    await connection_tracker.disconnected(
+                        self.user.id,
+                        self.channel_name,
+                        lambda user_id=self.user.id, layer=self.channel_layer: mark_offline(layer, user_id),
+                        getattr(settings, 'CHAT_PRESENCE_DEBOUNCE', 5),
+                    )
+                except Exception as e:
+                    # The heartbeat sweeper takes the user offline instead
+                    logger.error("Error uncounting connection of %s: %s", self.user.id, e)
+
+            if getattr(self, 'presence_subscriptions', None):
+                await asyncio.gather(*(
+                    self.channel_layer.group_discard(presence_group(user_id), self.channel_name)
+                    for user_id in self.presence_subscriptions
+                ))
+
+            if getattr(self, 'receipt_task', None):
+                self.receipt_task.cancel()
+                await self.flush_read_receipts()
                 
             if hasattr(self, 'user_room'):
                 await self.channel_layer.group_discard(self.user_room, self.channel_name)
                 
         except Exception as e:
-            logger.error(f"Error in disconnect: {str(e)}")
+            logger.error("Error in disconnect: %s", e)
 
     async def receive(self, text_data):
         try:
-            data = json.loads(text_data)
+            data = loads(text_data)
+            if data.get('type') == 'ack':
+                # Costs no I/O, and throttling it would stall our own writer
+                if isinstance(data.get('frames'), int):
+                    self.outbound.acknowledge(data['frames'])
+                return
+            if data.get('type') in ('ping', 'read'):
+                # Control frames reach the database too, so they have their own bucket
+                if self.control_bucket is not None and self.control_bucket.take():
+                    metrics.messages_throttled.inc(limit='control')
+                    await self.reject()
+                    return
+                self.rejected_in_a_row = 0
+                if data['type'] == 'ping':
+                    await self.receive_heartbeat()
+                else:
+                    await self.receive_read_receipt(data)
+                return
+
+            retry_after = await self.throttle()
+            if retry_after:
+                if await self.reject():
+                    return
+                await self.outbound.send_now(dumps({
+                    "type": "rate_limited",
+                    "error": "You are sending messages too quickly",
+                    "retry_after": round(retry_after, 2),
+                }))
+                return
+            self.rejected_in_a_row = 0
+
+            metrics.messages_received.inc()
+            started = time.perf_counter()
             message = data.get('message', '').strip()
             recipient_id = data.get('recipient_id')
 
             if not message:
-                await self.send(json.dumps({
+                await self.outbound.send_now(dumps({
                     'error': 'Message cannot be empty'
                 }))
                 return
 
             if not recipient_id:
-                await self.send(json.dumps({
+                await self.outbound.send_now(dumps({
                     'error': 'Recipient ID is required'
                 }))
                 return
@@ -74,108 +212,381 @@ class ChatConsumer(AsyncWebsocketConsumer):
             try:
                 recipient = await self.get_recipient(recipient_id)
                 if not recipient:
-                    await self.send(json.dumps({
+                    await self.outbound.send_now(dumps({
                         'error': 'Recipient not found'
                     }))
                     return
             except Exception as e:
-                logger.error(f"Error validating recipient: {str(e)}")
-                await self.send(json.dumps({
+                logger.error("Error validating recipient: %s", e)
+                await self.outbound.send_now(dumps({
                     'error': 'Invalid recipient'
                 }))
                 return
+            metrics.message_stage_seconds.observe(time.perf_counter() - started, stage='validate')
 
             # Save message to database
             try:
-                chat_message = await self.save_message(
-                    sender=self.user,
-                    recipient=recipient,
-                    content=message
-                )
-                
-                if not chat_message:
-                    raise ValidationError("Failed to save message")
-
-                message_data = {
-                    "type": "chat_message",
-                    "message": {
-                        "id": chat_message.id,
-                        "sender": self.user.username,
-                        "sender_id": self.user.id,
-                        "content": message,
-                        "timestamp": chat_message.timestamp.isoformat(),
-                    }
+                with metrics.message_stage_seconds.time(stage='save'):
+                    chat_message, write = await self.save_message(
+                        sender=self.user,
+                        recipient_id=recipient.id,
+                        content=message
+                    )
+
+                # Encoded once here; every receiving socket forwards it as-is,
+                # adding its user's sequence number
+                event = {
+                    "id": chat_message.id,
+                    "sender": self.user.username,
+                    "sender_id": self.user.id,
+                    "recipient_id": recipient.id,
+                    "content": chat_message.content,
+                    "timestamp": chat_message.timestamp.isoformat(),
                 }
+                if write is not None:
+                    # Not saved yet: clients match the "persisted" follow-up on this
+                    event["temp_id"] = temp_id = uuid.uuid4().hex
+                    task = asyncio.create_task(self.announce_persisted(write, temp_id, recipient.id))
+                    self.persist_tasks.add(task)
+                    task.add_done_callback(self.persist_tasks.discard)
+                payload = dumps(event)
+                try:
+                    with metrics.message_stage_seconds.time(stage='log'):
+                        seqs = await message_log.append([recipient.id, self.user.id], payload)
+                except Exception as e:
+                    # Still deliver; clients just can't replay this one
+                    logger.error("Error logging message for replay: %s", e)
+                    seqs = {}
 
-                # Send to recipient
-                await self.channel_layer.group_send(
-                    f"user_{recipient_id}",
-                    message_data
-                )
-
-                # Send confirmation to sender
-                await self.channel_layer.group_send(
-                    self.user_room,
-                    message_data
-                )
+                # Confirm to this connection directly, then fan out once to
+                # the recipient and the sender's other connections
+                with metrics.message_stage_seconds.time(stage='send'):
+                    own_seq = seqs.get(self.user.id)
+                    await self.deliver(payload if own_seq is None else with_seq(payload, own_seq))
+                metrics.messages_delivered.inc()
+                with metrics.message_stage_seconds.time(stage='group_send'):
+                    await group_send_many(
+                        self.channel_layer,
+                        [f"user_{recipient.id}", self.user_room],
+                        {
+                            "type": "chat_message",
+                            "origin": self.channel_name,
+                            "sender_id": self.user.id,
+                            "text": payload,
+                            "seqs": {str(user_id): seq for user_id, seq in seqs.items()},
+                        },
+                        exclude=[self.channel_name],
+                    )
+                await self.subscribe_presence([recipient.id])
 
             except ValidationError as e:
-                logger.error(f"Validation error saving message: {str(e)}")
-                await self.send(json.dumps({
+                logger.error("Validation error saving message: %s", e)
+                await self.outbound.send_now(dumps({
                     'error': str(e)
                 }))
             except Exception as e:
-                logger.error(f"Error saving message: {str(e)}")
-                await self.send(json.dumps({
+                logger.error("Error saving message: %s", e)
+                await self.outbound.send_now(dumps({
                     'error': 'Failed to save message. Please try again.'
                 }))
 
-        except json.JSONDecodeError:
-            await self.send(json.dumps({
+        except JSONDecodeError:
+            await self.outbound.send_now(dumps({
                 'error': 'Invalid message format'
             }))
         except Exception as e:
-            logger.error(f"Unexpected error in receive: {str(e)}")
-            await self.send(json.dumps({
+            logger.error("Unexpected error in receive: %s", e)
+            await self.outbound.send_now(dumps({
                 'error': 'An unexpected error occurred'
             }))
 
-    async def chat_message(self, event):
+    async def reject(self):
+        """
+        Count a frame refused by a rate limit. Returns True, having closed
+        the connection, once more than CHAT_MESSAGE_MAX_REJECTED in a row are.
+        """
+        self.rejected_in_a_row += 1
+        if self.rejected_in_a_row <= getattr(settings, 'CHAT_MESSAGE_MAX_REJECTED', 50):
+            return False
+        logger.warning("Closing connection of %s for ignoring its rate limit", self.user)
+        metrics.ws_connections_throttled.inc()
+        await self.close(code=CLOSE_POLICY_VIOLATION)
+        return True
+
+    async def throttle(self):
+        """
+        Return 0 if this connection may send a chat message now, else the
+        seconds until it may. Checked before any database or channel layer
+        work, so a flooding client costs the worker next to nothing.
+        """
+        if self.message_bucket is not None:
+            wait = self.message_bucket.take()
+            if wait:
+                metrics.messages_throttled.inc(limit='connection')
+                return wait
+        if user_message_limiter is not None:
+            try:
+                wait = await user_message_limiter.take(self.user.id)
+            except Exception as e:
+                # Fail open: the per-connection limit still applies
+                logger.error("Error checking rate limit for %s: %s", self.user.id, e)
+                return 0
+            if wait:
+                metrics.messages_throttled.inc(limit='user')
+                return wait
+        return 0
+
+    async def missed_messages(self):
+        """
+        Return (resumed, events) for the ``last_seq`` and ``last_id`` the
+        client reconnected with. ``resumed`` is False when the client has
+        to resynchronise itself: it passed no ``last_seq``, or the gap is
+        neither in the replay log nor small enough to load from the database.
+        """
+        params = parse_qs(self.scope.get("query_string", b"").decode())
         try:
-            message = event["message"]
-            await self.send(text_data=json.dumps(message))
+            last_seq = int(params["last_seq"][0]) if "last_seq" in params else None
+            last_id = int(params["last_id"][0]) if "last_id" in params else None
+        except ValueError:
+            last_seq = last_id = None
+
+        self.replayed_seq = 0
+        try:
+            self.replayed_seq, events = await message_log.since(self.user.id, last_seq)
         except Exception as e:
-            logger.error(f"Error sending message: {str(e)}")
+            logger.error("Error reading replay log for %s: %s", self.user.id, e)
+            return False, []
+        if last_seq is None:
+            return False, []
+        if events is not None:
+            metrics.messages_replayed.inc(len(events), source='log')
+            return True, events
+        if last_id is None:
+            return False, []
+
+        limit = getattr(settings, 'CHAT_REPLAY_DB_LIMIT', 500)
+        events = await database_sync_to_async(messages_after)(self.user.id, last_id, limit + 1)
+        if len(events) > limit:
+            return False, []
+        metrics.messages_replayed.inc(len(events), source='db')
+        return True, events
+
+    async def receive_heartbeat(self):
+        # Only refreshes the in-memory tracker; it reaches the DB in the
+        # tracker's periodic bulk flush, which the sweeper's TTL allows for
+        await database_sync_to_async(presence_tracker.touch)(self.user.id)
+        try:
+            await connection_tracker.heartbeat(self.user.id, self.channel_name)
+        except Exception as e:
+            logger.error("Error refreshing connection of %s: %s", self.user.id, e)
+        await self.outbound.send_now(dumps({"type": "pong"}))
+
+    async def receive_read_receipt(self, data):
+        try:
+            sender_id = int(data.get('sender_id'))
+            up_to = int(data.get('up_to'))
+        except (TypeError, ValueError):
+            await self.outbound.send_now(dumps({
+                'error': 'Invalid read receipt'
+            }))
+            return
+        if sender_id == self.user.id:
+            return
+        if (sender_id not in self.pending_receipts
+                and len(self.pending_receipts) >= getattr(settings, 'CHAT_READ_RECEIPT_MAX_PENDING', 20)):
+            # Each pending conversation is an UPDATE on the next flush
+            await self.outbound.send_now(dumps({
+                'error': 'Too many read receipts'
+            }))
+            return
+
+        # Coalesce bursts into one UPDATE per conversation
+        self.pending_receipts[sender_id] = max(up_to, self.pending_receipts.get(sender_id, 0))
+        if self.receipt_task is None:
+            self.receipt_task = asyncio.create_task(self.flush_read_receipts_later())
+
+    async def flush_read_receipts_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_READ_RECEIPT_DELAY', 0.5))
+        await self.flush_read_receipts()
+
+    async def flush_read_receipts(self):
+        pending, self.pending_receipts = self.pending_receipts, {}
+        self.receipt_task = None
+        for sender_id, up_to in pending.items():
+            try:
+                updated = await database_sync_to_async(mark_read)(self.user.id, sender_id, up_to)
+                if not updated:
+                    continue
+                payload = dumps({
+                    "type": "read_receipt",
+                    "reader_id": self.user.id,
+                    "sender_id": sender_id,
+                    "up_to": up_to,
+                })
+                await group_send_many(
+                    self.channel_layer,
+                    [f"user_{sender_id}", self.user_room],
+                    {"type": "read_receipt", "reader_id": self.user.id, "sender_id": sender_id, "text": payload},
+                )
+            except Exception as e:
+                logger.error("Error processing read receipt from %s: %s", self.user.id, e)
+
+    async def subscribe_presence(self, user_ids):
+        new_ids = [user_id for user_id in user_ids
+                   if user_id and user_id not in self.presence_subscriptions]
+        self.presence_subscriptions.update(new_ids)
+        await asyncio.gather(*(
+            self.channel_layer.group_add(presence_group(user_id), self.channel_name)
+            for user_id in new_ids
+        ))
+
+    async def presence_update(self, event):
+        await self.deliver(event["text"], key=('presence', event.get("user_id")))
 
     @database_sync_to_async
-    def save_message(self, sender, recipient, content):
+    def get_contact_ids(self):
+        limit = getattr(settings, 'CHAT_PRESENCE_MAX_CONTACTS', 200)
+        pairs = conversations_for(self.user.id).values_list('user_low_id', 'user_high_id')[:limit]
+        return [low if high == self.user.id else high for low, high in pairs]
+
+    async def read_receipt(self, event):
+        await self.deliver(event["text"], key=('read', event.get("reader_id"), event.get("sender_id")))
+
+    async def deliver(self, text, key=None):
+        """
+        Queue an event for this client. ``key`` marks events where only the
+        latest of a kind matters, which the coalesce policy can merge. A
+        client too far behind under the disconnect policy is closed and
+        told to resynchronise.
+        """
+        if self.outbound.put(text, key):
+            return
+        logger.warning("Closing connection of %s: %d events behind", self.user, len(self.outbound))
+        await self.resync()
+
+    async def acks_stalled(self):
+        logger.warning("Closing connection of %s: %d frames unacknowledged for %ss",
+                       self.user, self.outbound.unacked, self.outbound.ack_timeout)
+        await self.resync()
+
+    async def resync(self):
+        """Close a client that fell too far behind, telling it to reconnect and replay."""
+        metrics.ws_connections_slow.inc()
+        self.outbound.close()
+        await self.send(dumps({"type": "resync", "reason": "slow_consumer"}))
+        await self.close(code=CLOSE_SLOW_CONSUMER)
+
+    def sequenced(self, event):
+        """The event's text with this user's sequence added, or None if it was already replayed."""
+        seq = event.get("seqs", {}).get(str(self.user.id))
+        if seq is None:
+            return event["text"]
+        if seq <= self.replayed_seq:
+            return None  # already replayed on connect
+        return with_seq(event["text"], seq)
+
+    async def chat_message(self, event):
+        if event.get("origin") == self.channel_name:
+            return  # already acknowledged locally
+        try:
+            text = self.sequenced(event)
+            if text is None:
+                return
+            await self.deliver(text)
+            metrics.messages_delivered.inc()
+            if event.get("sender_id") != self.user.id:
+                await self.subscribe_presence([event.get("sender_id")])
+        except Exception as e:
+            logger.error("Error sending message: %s", e)
+
+    async def message_persisted(self, event):
+        try:
+            text = self.sequenced(event)
+            if text is not None:
+                await self.deliver(text)
+        except Exception as e:
+            logger.error("Error sending persisted notice: %s", e)
+
+    async def save_message(self, sender, recipient_id, content):
+        """
+        Queue the message on the per-process write-behind writer. Returns
+        the message and, in "deliver" durability mode, its pending write.
+
+        In the default "commit" mode this waits for the batch to commit, so
+        the message is broadcast with its real id and timestamp. In
+        "deliver" mode it returns at once with a provisional timestamp and
+        no id, and announce_persisted() follows up once the write is done.
+        """
+        chat_message = ChatMessage(sender=sender, recipient_id=recipient_id, content=content)
+        chat_message.clean()
+        chat_message.content = chat_message.content.strip()
+
+        if message_writer.durability == DURABILITY_DELIVER:
+            chat_message.timestamp = timezone.now()
+            return chat_message, message_writer.enqueue(chat_message)
+        return await message_writer.enqueue(chat_message), None
+
+    async def announce_persisted(self, write, temp_id, recipient_id):
+        """
+        Tell both users what became of a message delivered before it was
+        saved: "persisted" with its real id and timestamp, or
+        "persist_failed". Logged for replay like the message itself, so a
+        client that reconnects in between still learns the id.
+        """
         try:
-            return ChatMessage.objects.create(
-                sender=sender,
-                recipient=recipient,
-                content=content
+            chat_message = await write
+            event = {
+                "type": "persisted",
+                "temp_id": temp_id,
+                "id": chat_message.id,
+                "timestamp": chat_message.timestamp.isoformat(),
+            }
+        except Exception as e:
+            logger.error("Message delivered but not persisted: %s", e)
+            event = {"type": "persist_failed", "temp_id": temp_id}
+        event.update(sender_id=self.user.id, recipient_id=recipient_id)
+        payload = dumps(event)
+        try:
+            seqs = await message_log.append([recipient_id, self.user.id], payload)
+        except Exception as e:
+            logger.error("Error logging persisted notice for replay: %s", e)
+            seqs = {}
+        try:
+            await group_send_many(
+                self.channel_layer,
+                [f"user_{recipient_id}", self.user_room],
+                {
+                    "type": "message_persisted",
+                    "text": payload,
+                    "seqs": {str(user_id): seq for user_id, seq in seqs.items()},
+                },
             )
         except Exception as e:
-            logger.error(f"Database error saving message: {str(e)}")
+            logger.error("Error sending persisted notice: %s", e)
+
+    async def get_recipient(self, recipient_id):
+        try:
+            recipient_id = int(recipient_id)
+        except (TypeError, ValueError):
             return None
+        # Steady-state sends are answered from the shared user cache
+        cached = user_cache.get(recipient_id)
+        if cached is not MISSING:
+            return cached
+        return await self.fetch_recipient(recipient_id)
 
     @database_sync_to_async
-    def get_recipient(self, recipient_id):
+    def fetch_recipient(self, recipient_id):
         try:
-            return User.objects.get(id=recipient_id)
-        except User.DoesNotExist:
-            return None
+            return load_user(recipient_id)
         except Exception as e:
-            logger.error(f"Error getting recipient: {str(e)}")
+            logger.error("Error getting recipient: %s", e)
             return None
 
     @database_sync_to_async
     def update_user_activity(self, is_online):
         try:
-            activity, _ = UserActivity.objects.get_or_create(user=self.user)
-            activity.last_activity = timezone.now()
-            activity.is_online = is_online
-            activity.save()
-            logger.info(f"Updated user activity for {self.user.username}: {'online' if is_online else 'offline'}")
+            presence_tracker.touch(self.user.id, is_online)
+            logger.debug("Updated user activity for %s: online=%s", self.user.username, is_online)
         except Exception as e:
-            logger.error(f"Error updating user activity: {str(e)}")
\ No newline at end of file
+            logger.error("Error updating user activity: %s", e)
\ No newline at end of file
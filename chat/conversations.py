@@ -0,0 +1,81 @@
+import collections
+
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Greatest
+
+from .models import Conversation
+
+
+def user_pair(user_a_id, user_b_id):
+    return (user_a_id, user_b_id) if user_a_id < user_b_id else (user_b_id, user_a_id)
+
+
+def conversations_for(user_id):
+    """Queryset of a user's conversations, most recent first."""
+    return Conversation.objects.filter(
+        Q(user_low_id=user_id) | Q(user_high_id=user_id)
+    ).order_by('-last_timestamp', '-id')
+
+
+def record_messages(messages):
+    """
+    Fold newly saved messages into their conversation summaries.
+
+    Called with the whole batch from the bulk insert path, so each
+    conversation costs one get_or_create and one UPDATE however many
+    messages it received. Batches from different workers can commit out of
+    order, so the last_* fields only move forward in time; the unread
+    counts always add up.
+    """
+    summaries = {}
+    for message in messages:
+        low, high = user_pair(message.sender_id, message.recipient_id)
+        summary = summaries.setdefault((low, high), {'last': message, 'unread_low': 0, 'unread_high': 0})
+        if (message.timestamp, message.id or 0) >= (summary['last'].timestamp, summary['last'].id or 0):
+            summary['last'] = message
+        summary['unread_low' if message.recipient_id == low else 'unread_high'] += 1
+
+    for (low, high), summary in summaries.items():
+        last = summary['last']
+        conversation, _ = Conversation.objects.get_or_create(user_low_id=low, user_high_id=high)
+        newer = Q(last_timestamp__isnull=True) | Q(last_timestamp__lte=last.timestamp)
+        Conversation.objects.filter(pk=conversation.pk).update(
+            last_message_id=_if_newer(newer, 'last_message', last.id),
+            last_sender_id=_if_newer(newer, 'last_sender', last.sender_id),
+            last_timestamp=_if_newer(newer, 'last_timestamp', last.timestamp),
+            last_snippet=_if_newer(newer, 'last_snippet', last.content[:Conversation.SNIPPET_LENGTH]),
+            unread_low=F('unread_low') + summary['unread_low'],
+            unread_high=F('unread_high') + summary['unread_high'],
+        )
+
+
+def _if_newer(newer, field, value):
+    """``value`` where the ``newer`` condition holds, else the column's current value."""
+    output_field = Conversation._meta.get_field(field)
+    return Case(When(newer, then=Value(value, output_field=output_field)),
+                default=F(output_field.attname), output_field=output_field)
+
+
+def record_read(reader_id, sender_id, count):
+    """Subtract ``count`` newly read messages from the reader's side of the summary."""
+    low, high = user_pair(reader_id, sender_id)
+    field = 'unread_low' if reader_id == low else 'unread_high'
+    Conversation.objects.filter(user_low_id=low, user_high_id=high).update(
+        **{field: Greatest(F(field) - count, 0)}
+    )
+
+
+def forget_unread(rows):
+    """
+    Drop messages leaving ChatMessage (archived or purged) from the unread
+    totals. ``rows`` are dicts with sender_id, recipient_id and is_read.
+    """
+    unread = collections.Counter((row['recipient_id'], row['sender_id']) for row in rows if not row['is_read'])
+    for (reader_id, sender_id), count in unread.items():
+        record_read(reader_id, sender_id, count)
+
+
+def pair_filter(user_a_id, user_b_id):
+    """Q matching the messages between two users, in either direction."""
+    return (Q(sender_id=user_a_id, recipient_id=user_b_id) |
+            Q(sender_id=user_b_id, recipient_id=user_a_id))
@@ -0,0 +1,27 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+
+if orjson is not None:
+
+    def dumps(data):
+        return orjson.dumps(data).decode('utf-8')
+
+    def loads(text):
+        return orjson.loads(text)
+
+else:
+
+    def dumps(data):
+        return json.dumps(data, separators=(',', ':'))
+
+    def loads(text):
+        return json.loads(text)
+
+
+# orjson.JSONDecodeError subclasses this, so callers can catch one type
+JSONDecodeError = json.JSONDecodeError
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.archive import archive_batch, archive_cutoff
+
+
+class Command(BaseCommand):
+    help = "Move messages older than the archive age from ChatMessage into ArchivedChatMessage, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive messages older than this many days (default: CHAT_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages moved per transaction')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to pause between batches, to leave room for live traffic')
+        parser.add_argument('--max-batches', type=int, default=0, help='Stop after this many batches (default: no limit)')
+
+    def handle(self, *args, **options):
+        # Fixed for the whole run, so the batches converge
+        cutoff = archive_cutoff(options['days'])
+        started = time.monotonic()
+        total = batches = 0
+        while True:
+            moved = archive_batch(cutoff, options['batch_size'])
+            total += moved
+            batches += 1
+            if moved:
+                self.stdout.write(f"Archived {total} messages ({total / (time.monotonic() - started):.0f}/s)")
+            if moved < options['batch_size'] or batches == options['max_batches']:
+                break
+            time.sleep(options['sleep'])
+        self.stdout.write(f"Archived {total} messages sent before {cutoff.isoformat()}")
@@ -0,0 +1,39 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import ExportWriter, FORMATS, export_messages
+
+
+class Command(BaseCommand):
+    help = "Export a user's message history, archived messages included, as NDJSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User whose messages are exported')
+        parser.add_argument('--with', dest='other', help='Only the conversation with this username')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--gzip', action='store_true', help='Gzip the output')
+        parser.add_argument('--output', help='File to write (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched and encoded per chunk')
+
+    def handle(self, *args, **options):
+        user = self.get_user(options['username'])
+        other = self.get_user(options['other']) if options['other'] else None
+        writer = ExportWriter(options['format'], compress=options['gzip'])
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in export_messages(writer, user.id, other.id if other else None, options['chunk_size']):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
+
+    def get_user(self, username):
+        try:
+            return User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {username!r}")
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.retention import expire_snippets, purge_batch, purge_targets
+
+
+class Command(BaseCommand):
+    help = "Delete messages past their retention period (CHAT_RETENTION_DAYS or the conversation's own) in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages deleted per transaction')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to pause between batches, to let replication and vacuum keep up')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted')
+
+    def handle(self, *args, **options):
+        # One fixed "now" for the run, so every batch agrees on the cutoffs
+        targets = purge_targets(timezone.now())
+        if not targets:
+            self.stdout.write("No retention period configured; nothing to purge")
+            return
+
+        started = time.monotonic()
+        total = 0
+        for description, queryset, conversations in targets:
+            if options['dry_run']:
+                self.stdout.write(f"Would purge {queryset.count()} messages: {description}")
+                continue
+
+            purged, after = 0, None
+            while True:
+                deleted, after = purge_batch(queryset, after, options['batch_size'])
+                purged += deleted
+                total += deleted
+                if deleted:
+                    elapsed = time.monotonic() - started
+                    self.stdout.write(f"{description}: {purged} purged, {total} in total ({total / elapsed:.0f} rows/s)")
+                if deleted < options['batch_size']:
+                    break
+                time.sleep(options['sleep'])
+            expire_snippets(conversations)
+
+        if not options['dry_run']:
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"Purged {total} messages in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s)")
@@ -0,0 +1,28 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from chat.presence import publish_presence, sweep_expired
+
+
+class Command(BaseCommand):
+    help = "Mark users offline whose WebSocket heartbeats have stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, default=None,
+                            help='Seconds without a heartbeat before a user is swept (default: CHAT_PRESENCE_TTL)')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running and sweep every N seconds (default: sweep once and exit)')
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        while True:
+            user_ids = sweep_expired(options['ttl'])
+            for user_id in user_ids:
+                async_to_sync(publish_presence)(channel_layer, user_id, False)
+            self.stdout.write(f"Swept {len(user_ids)} expired sessions")
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
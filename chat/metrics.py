@@ -0,0 +1,349 @@
+import atexit
+import bisect
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from asgiref.sync import SyncToAsync
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs
+    )
+    return '{%s}' % ','.join(escaped)
+
+
+class Metric:
+    """
+    A process-local metric family in the Prometheus text format.
+
+    Values are per process. With several workers behind one port, each
+    writes snapshots to CHAT_METRICS_DIR and /metrics combines them (see
+    Registry.render_combined).
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+    def render(self, samples=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in (self.samples() if samples is None else samples):
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    A gauge set directly, or read from ``function()`` at scrape time. For a
+    labelled gauge the function returns {label values tuple: value}.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, function=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        if self.function is not None:
+            return self.function()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        value = self.function()
+        if isinstance(value, dict):
+            return [(self.name, key, (), sample) for key, sample in value.items()]
+        return [(self.name, (), (), value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", key, [('le', _format_value(bound))], cumulative))
+                samples.append((f"{self.name}_sum", key, (), total))
+                samples.append((f"{self.name}_count", key, (), count))
+        return samples
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry(list):
+    def render(self):
+        return '\n'.join(metric.render() for metric in self) + '\n'
+
+    def snapshot(self):
+        """This process's samples by metric name, as JSON-friendly lists."""
+        return {
+            metric.name: [[name, list(key), [list(pair) for pair in extra], value]
+                          for name, key, extra, value in metric.samples()]
+            for metric in self
+        }
+
+    def write_snapshot(self, directory):
+        path = Path(directory) / f"{os.getpid()}.json"
+        temporary = path.with_suffix('.tmp')
+        temporary.write_text(json.dumps(self.snapshot()))
+        # Atomic, so readers never see half a file
+        os.replace(temporary, path)
+
+    def render_combined(self, directory):
+        """
+        Render every worker's snapshot in ``directory``, using this
+        process's live values in place of its own snapshot. Counters and
+        histograms are summed, and those of workers that have exited still
+        count, so totals don't go backwards on a restart. Gauges are
+        reported per live worker with a ``worker`` (pid) label.
+        """
+        processes = [(os.getpid(), self.snapshot())]
+        for path in Path(directory).glob('*.json'):
+            if not path.stem.isdigit() or int(path.stem) == os.getpid():
+                continue
+            pid = int(path.stem)
+            try:
+                processes.append((pid, json.loads(path.read_text())))
+            except (OSError, ValueError):
+                continue
+
+        totals = {metric.name: {} for metric in self}
+        for pid, snapshot in processes:
+            alive = pid == os.getpid() or _process_alive(pid)
+            for metric in self:
+                gauge = metric.type == 'gauge'
+                if gauge and not alive:
+                    continue
+                combined = totals[metric.name]
+                for name, key, extra, value in snapshot.get(metric.name, ()):
+                    extra = tuple(tuple(pair) for pair in extra)
+                    if gauge:
+                        combined[(name, tuple(key), extra + (('worker', str(pid)),))] = value
+                        continue
+                    sample = (name, tuple(key), extra)
+                    combined[sample] = combined.get(sample, 0) + value
+        return '\n'.join(
+            metric.render([(name, key, extra, value) for (name, key, extra), value in totals[metric.name].items()])
+            for metric in self
+        ) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def render():
+    directory = getattr(settings, 'CHAT_METRICS_DIR', None)
+    return REGISTRY.render_combined(directory) if directory else REGISTRY.render()
+
+
+def start_snapshots(directory, interval=5):
+    """Write this process's snapshot to ``directory`` every ``interval`` seconds and at exit."""
+    def write():
+        try:
+            REGISTRY.write_snapshot(directory)
+        except OSError as e:
+            logger.error("Error writing metrics snapshot: %s", e)
+
+    def run():
+        while True:
+            write()
+            time.sleep(interval)
+
+    threading.Thread(target=run, name='metrics-snapshots', daemon=True).start()
+    atexit.register(write)
+
+
+def _db_executor_queue_depth():
+    # database_sync_to_async calls outside a request context share this
+    # one-thread executor, so its backlog is the consumers' DB queue
+    return SyncToAsync.single_thread_executor._work_queue.qsize()
+
+
+# The enclosing track_queries() block's counter. Context variables follow
+# async views into the sync_to_async threads that run their queries.
+_query_count = contextvars.ContextVar('chat_query_count', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    """Execute wrapper installed on every DB connection (see chat.signals)."""
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+@contextmanager
+def track_queries(view):
+    """Record how many queries the wrapped block ran, whichever thread ran them."""
+    counter = [0]
+    token = _query_count.set(counter)
+    try:
+        yield
+    finally:
+        _query_count.reset(token)
+        http_db_queries.observe(counter[0], view=view)
+
+
+ws_connections = Gauge('chat_ws_connections', 'Open WebSocket connections.')
+ws_connections_rejected = Counter(
+    'chat_ws_connections_rejected_total', 'WebSocket connections turned away by connect admission control.')
+messages_received = Counter('chat_messages_received_total', 'Chat messages received from WebSocket clients.')
+messages_throttled = Counter(
+    'chat_messages_throttled_total', 'Chat messages and control frames rejected for going over a rate limit.',
+    ['limit'])
+ws_connections_throttled = Counter(
+    'chat_ws_connections_throttled_total', 'WebSocket connections closed for ignoring their rate limit.')
+outbound_events_dropped = Counter(
+    'chat_outbound_events_dropped_total', 'Events dropped from a connection\'s outbound buffer.', ['reason'])
+outbound_batch_size = Histogram(
+    'chat_outbound_batch_size', 'Events sent to a client per WebSocket frame.', buckets=(1, 2, 5, 10, 25, 50, 100))
+ws_connections_slow = Counter(
+    'chat_ws_connections_slow_total', 'WebSocket connections closed for falling behind their outbound buffer.')
+messages_delivered = Counter('chat_messages_delivered_total', 'Chat messages sent to WebSocket clients.')
+messages_replayed = Counter(
+    'chat_messages_replayed_total', 'Missed messages replayed to reconnecting clients.', ['source'])
+message_stage_seconds = Histogram(
+    'chat_message_stage_seconds',
+    'Time spent in each stage of handling an incoming chat message.',
+    ['stage'],
+)
+db_executor_queue_depth = Gauge(
+    'chat_db_executor_queue_depth',
+    'database_sync_to_async calls waiting for the DB thread.',
+    function=_db_executor_queue_depth,
+)
+# Connection pools by alias, registered by chat.pool
+db_pools = {}
+db_pool_connections = Gauge(
+    'chat_db_pool_connections',
+    'Pooled DB connections by state.',
+    ['alias', 'state'],
+    function=lambda: {
+        (alias, state): stats[state]
+        for alias, stats in ((alias, pool.stats()) for alias, pool in list(db_pools.items()))
+        for state in ('idle', 'in_use')
+    },
+)
+db_pool_waiting = Gauge(
+    'chat_db_pool_waiting',
+    'Threads waiting for a pooled DB connection.',
+    ['alias'],
+    function=lambda: {(alias,): pool.stats()['waiting'] for alias, pool in list(db_pools.items())},
+)
+db_pool_wait_seconds = Histogram('chat_db_pool_wait_seconds', 'Time spent waiting to borrow a DB connection.', ['alias'])
+db_pool_connections_created = Counter('chat_db_pool_connections_created_total', 'DB connections opened by the pool.', ['alias'])
+db_pool_health_check_failures = Counter(
+    'chat_db_pool_health_check_failures_total', 'Idle pooled connections that failed their health check.', ['alias'])
+db_pool_timeouts = Counter('chat_db_pool_timeouts_total', 'Borrow attempts that gave up waiting for a connection.', ['alias'])
+http_db_queries = Histogram(
+    'chat_http_db_queries',
+    'DB queries per API request.',
+    ['view'],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55),
+)
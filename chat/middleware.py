@@ -1,13 +1,17 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.contrib import messages
+import copy
 from channels.middleware import BaseMiddleware
-from channels.auth import AuthMiddlewareStack
+from channels.auth import AuthMiddleware, AuthMiddlewareStack, get_user
+from channels.sessions import CookieMiddleware, SessionMiddleware
 from django.contrib.auth.models import AnonymousUser
 from django.db import close_old_connections
 from urllib.parse import parse_qs
 from django.utils import timezone
-from .models import UserActivity
+from .cache import MISSING, session_user_cache
+from .presence import presence_tracker
 
 class ChatMiddleware:
     def __init__(self, get_response):
@@ -44,15 +48,48 @@ class QueryAuthMiddleware(BaseMiddleware):
 def QueryAuthMiddlewareStack(inner):
     return QueryAuthMiddleware(AuthMiddlewareStack(inner))
 
+class CachedAuthMiddleware(AuthMiddleware):
+    """
+    AuthMiddleware that remembers the user each session key resolved to, so
+    a reconnecting client skips the session and user queries.
+    """
+
+    async def resolve_scope(self, scope):
+        # Reading the key doesn't load the session
+        session_key = scope["session"].session_key
+        user = session_user_cache.get(session_key) if session_key else MISSING
+        if user is MISSING:
+            user = await get_user(scope)
+            if session_key:
+                session_user_cache.set(session_key, user)
+        # Each connection gets its own copy to mutate
+        scope["user"]._wrapped = copy.copy(user)
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
 class UserActivityMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        if request.user.is_authenticated:
-            # Get or create user activity
-            activity, created = UserActivity.objects.get_or_create(user=request.user)
-            activity.update_activity()
-
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.touch(request)
         response = self.get_response(request)
-        return response
\ No newline at end of file
+        return response
+
+    async def __acall__(self, request):
+        # Resolving the session user (and an occasional flush) is sync-only
+        await sync_to_async(self.touch)(request)
+        return await self.get_response(request)
+
+    def touch(self, request):
+        if request.user.is_authenticated:
+            # Buffered; written back in batches by the presence tracker
+            presence_tracker.touch(request.user.id)
\ No newline at end of file
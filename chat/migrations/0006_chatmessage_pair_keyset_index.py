@@ -0,0 +1,21 @@
+# Generated by Django 4.2.9 on 2026-10-18 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_remove_chatmessage_deleted_at_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatmessage',
+            name='chat_chatme_sender__921695_idx',
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['sender', 'recipient', 'timestamp', 'id'], name='chat_msg_pair_ts_id_idx'),
+        ),
+    ]
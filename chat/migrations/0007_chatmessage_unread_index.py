@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-18 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chatmessage_pair_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['recipient', 'sender', 'id'], name='chat_msg_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.9 on 2026-10-18 18:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_conversations(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+
+    summaries = {}
+    for message in ChatMessage.objects.order_by('id').iterator(chunk_size=2000):
+        low, high = sorted((message.sender_id, message.recipient_id))
+        summary = summaries.setdefault((low, high), Conversation(user_low_id=low, user_high_id=high))
+        summary.last_message_id = message.id
+        summary.last_sender_id = message.sender_id
+        summary.last_timestamp = message.timestamp
+        summary.last_snippet = message.content[:100]
+        if not message.is_read:
+            if message.recipient_id == low:
+                summary.unread_low += 1
+            else:
+                summary.unread_high += 1
+    Conversation.objects.bulk_create(summaries.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0007_chatmessage_unread_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('last_snippet', models.CharField(blank=True, max_length=100)),
+                ('unread_low', models.PositiveIntegerField(default=0)),
+                ('unread_high', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatmessage')),
+                ('last_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_timestamp'], name='chat_conv_low_recent_idx'), models.Index(fields=['user_high', '-last_timestamp'], name='chat_conv_high_recent_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='chat_conversation_pair_uniq'),
+        ),
+        migrations.RunPython(build_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+# auth_user is owned by django.contrib.auth, so these PostgreSQL-only
+# indexes for the user directory search are created here. The existing
+# unique index already serves ordering and keyset pagination by username.
+POSTGRES_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS chat_auth_user_username_upper_like "
+    "ON auth_user (UPPER(username::text) varchar_pattern_ops)",
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS chat_auth_user_username_trgm "
+    "ON auth_user USING gin (username gin_trgm_ops)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS chat_auth_user_username_trgm",
+    "DROP INDEX IF EXISTS chat_auth_user_username_upper_like",
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_FORWARD:
+            schema_editor.execute(statement)
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_REVERSE:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0008_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.9 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_username_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['sender', 'id'], name='chat_msg_sender_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['recipient', 'id'], name='chat_msg_recipient_id_idx'),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 4.2.9 on 2026-10-18 18:59
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# PostgreSQL: a trigger keeps search_vector in step with content (bulk_create
+# included) and a GIN index serves the @@ match. The text search
+# configuration must match chat.search.SEARCH_CONFIG.
+#
+# The migration is non-atomic so it can run against a live table: the
+# trigger goes in first so new rows are covered, existing rows are
+# backfilled in committed id-range batches, and the index is built
+# CONCURRENTLY. If the build fails it leaves an INVALID index behind; drop
+# it before running the migration again.
+POSTGRES_TRIGGER = (
+    "CREATE TRIGGER chat_msg_search_vector_update "
+    "BEFORE INSERT OR UPDATE OF content ON chat_chatmessage FOR EACH ROW "
+    "EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', content)"
+)
+POSTGRES_BACKFILL = (
+    "UPDATE chat_chatmessage SET search_vector = to_tsvector('pg_catalog.english', content) "
+    "WHERE id > %s AND id <= %s AND search_vector IS NULL"
+)
+POSTGRES_INDEX = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_msg_search_gin ON chat_chatmessage USING gin (search_vector)"
+)
+BACKFILL_BATCH_SIZE = 10000
+
+POSTGRES_REVERSE = [
+    "DROP TRIGGER IF EXISTS chat_msg_search_vector_update ON chat_chatmessage",
+    "DROP INDEX CONCURRENTLY IF EXISTS chat_msg_search_gin",
+]
+
+# SQLite (development): an external-content FTS5 table over content, kept in
+# sync by triggers. Migrations that rebuild chat_chatmessage on SQLite drop
+# its triggers, so they have to recreate these.
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+    "content, content='chat_chatmessage', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF content ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for statement in SQLITE_FORWARD:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        schema_editor.execute(POSTGRES_TRIGGER)
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT max(id) FROM chat_chatmessage")
+            last_id = cursor.fetchone()[0] or 0
+        # Each batch commits on its own, so no long lock or single huge rewrite
+        for start in range(0, last_id, BACKFILL_BATCH_SIZE):
+            schema_editor.execute(POSTGRES_BACKFILL, (start, start + BACKFILL_BATCH_SIZE))
+        schema_editor.execute(POSTGRES_INDEX)
+
+
+def drop_search_index(apps, schema_editor):
+    statements = {'postgresql': POSTGRES_REVERSE, 'sqlite': SQLITE_REVERSE}
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chat', '0010_chatmessage_replay_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.exceptions import ValidationError
@@ -9,6 +10,9 @@ class UserActivity(models.Model):
     last_activity = models.DateTimeField(default=timezone.now)
     is_online = models.BooleanField(default=False)
 
+    # Consider user active if last activity was within last 5 minutes
+    ACTIVE_WINDOW = timedelta(minutes=5)
+
     def update_activity(self):
         self.last_activity = timezone.now()
         self.is_online = True
@@ -16,8 +20,7 @@ class UserActivity(models.Model):
 
     @property
     def is_active_now(self):
-        # Consider user active if last activity was within last 5 minutes
-        return self.is_online and (timezone.now() - self.last_activity) < timedelta(minutes=5)
+        return self.is_online and (timezone.now() - self.last_activity) < self.ACTIVE_WINDOW
 
     def __str__(self):
         return f"{self.user.username} - {'Online' if self.is_online else 'Offline'}"
@@ -28,17 +31,29 @@ class ChatMessage(models.Model):
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
+    # Filled by a database trigger on PostgreSQL; unused elsewhere (see chat.search)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         ordering = ['timestamp']
         indexes = [
-            models.Index(fields=['sender', 'recipient', 'timestamp']),
+            # Matches both sides of the conversation OR-query and its
+            # (timestamp, id) keyset ordering
+            models.Index(fields=['sender', 'recipient', 'timestamp', 'id'], name='chat_msg_pair_ts_id_idx'),
+            # Only unread rows: keeps unread counts and read-receipt UPDATEs cheap
+            models.Index(fields=['recipient', 'sender', 'id'], condition=models.Q(is_read=False),
+                         name='chat_msg_unread_idx'),
+            # A user's messages after a given id, for replay on reconnect
+            models.Index(fields=['sender', 'id'], name='chat_msg_sender_id_idx'),
+            models.Index(fields=['recipient', 'id'], name='chat_msg_recipient_id_idx'),
+            # Oldest-first scans for archiving and the retention purge
+            models.Index(fields=['timestamp', 'id'], name='chat_msg_ts_id_idx'),
         ]
 
     def clean(self):
         if not self.content.strip():
             raise ValidationError("Message content cannot be empty")
-        if self.sender == self.recipient:
+        if self.sender_id == self.recipient_id:
             raise ValidationError("Cannot send message to yourself")
         if len(self.content) > 10000:  # Reasonable limit for message length
             raise ValidationError("Message is too long")
@@ -49,4 +64,70 @@ class ChatMessage(models.Model):
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"{self.sender.username} to {self.recipient.username}: {self.content[:50]}"
\ No newline at end of file
+        return f"{self.sender.username} to {self.recipient.username}: {self.content[:50]}"
+
+class ArchivedChatMessage(models.Model):
+    """
+    Cold storage for messages older than CHAT_ARCHIVE_AFTER_DAYS, moved out
+    of ChatMessage in batches by the archive_messages command. Rows keep
+    their ChatMessage id, and every archived row is older than every row
+    still in ChatMessage, so history pages continue from one table into
+    the other (see MessageKeysetPagination).
+    """
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    recipient = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    is_read = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', 'recipient', 'timestamp', 'id'], name='chat_archive_pair_ts_id_idx'),
+            # Oldest-first scans for the retention purge
+            models.Index(fields=['timestamp', 'id'], name='chat_archive_ts_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender_id} to {self.recipient_id} (archived): {self.content[:50]}"
+
+class Conversation(models.Model):
+    """
+    Denormalized per-pair summary used by the sidebar and /api/conversations/.
+
+    Each pair of users has one row with user_low.id < user_high.id. It is
+    kept up to date as messages are saved and read (see chat.conversations).
+    """
+    user_low = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    user_high = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    last_message = models.ForeignKey(ChatMessage, null=True, blank=True, related_name='+', on_delete=models.SET_NULL)
+    last_sender = models.ForeignKey(User, null=True, blank=True, related_name='+', on_delete=models.SET_NULL)
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    last_snippet = models.CharField(max_length=100, blank=True)
+    unread_low = models.PositiveIntegerField(default=0)
+    unread_high = models.PositiveIntegerField(default=0)
+    # Days to keep this conversation's messages, overriding CHAT_RETENTION_DAYS
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+
+    SNIPPET_LENGTH = 100
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='chat_conversation_pair_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['user_low', '-last_timestamp'], name='chat_conv_low_recent_idx'),
+            models.Index(fields=['user_high', '-last_timestamp'], name='chat_conv_high_recent_idx'),
+        ]
+
+    def other_user_id(self, user_id):
+        return self.user_high_id if user_id == self.user_low_id else self.user_low_id
+
+    def other_user(self, user_id):
+        return self.user_high if user_id == self.user_low_id else self.user_low
+
+    def unread_for(self, user_id):
+        return self.unread_low if user_id == self.user_low_id else self.unread_high
+
+    def __str__(self):
+        return f"{self.user_low_id} <-> {self.user_high_id}: {self.last_snippet[:30]}"
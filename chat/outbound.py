@@ -0,0 +1,160 @@
+"""
+Per-connection outbound buffer.
+
+Channel layer event handlers put encoded events here instead of writing
+to the socket themselves, so a consumer keeps draining its channel even
+when its client reads slowly. Otherwise the channel layer would fill up
+to its capacity and silently drop that client's events. A writer task
+sends whatever has piled up since its last write as a single frame: one
+event as-is, several as a JSON array.
+
+The server's send() gives no backpressure (Daphne queues without limit
+in the transport), so clients that can acknowledge the frames they have
+handled ({"type": "ack", "frames": n}, counting every frame on the
+connection) do. Once a client has opted in (``?acks=1``) or sent its
+first ack, the writer stops when ``window`` frames are unacknowledged,
+and from then on events wait here, where they are bounded. Clients that
+never ack are written to as before. A client that stops acking for
+``ack_timeout`` seconds is handed to ``on_stalled``, which closes it
+with a resync hint rather than letting it miss events unawares.
+
+The buffer holds at most ``size`` events. When a slow client lets it
+fill, ``policy`` decides what gives:
+
+- ``drop-oldest``: the oldest event is dropped. The next frame tells the
+  client how many were lost ({"type": "messages_dropped"}).
+- ``coalesce``: as drop-oldest, but events with a key (presence and read
+  receipts) also replace any pending event with the same key, since
+  only the latest state matters.
+- ``disconnect``: nothing is dropped. The consumer closes the connection
+  with a resync hint, and the client reconnects and replays what it
+  missed.
+"""
+import asyncio
+import collections
+import itertools
+import logging
+
+from .encoding import dumps
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class OutboundBuffer:
+    def __init__(self, send, size=256, batch_size=50, policy=COALESCE, window=64,
+                 acking=False, ack_timeout=30, on_stalled=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound policy {policy!r}")
+        self.send = send
+        self.size = size
+        self.batch_size = batch_size
+        self.policy = policy
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.on_stalled = on_stalled
+        self.dropped = 0
+        self.closed = False
+        # Frames sent on the connection, and how many the client has handled;
+        # the window only applies to clients that acknowledge
+        self.acking = acking
+        self.sent = 0
+        self.acked = 0
+        self._events = collections.OrderedDict()
+        self._ids = itertools.count()
+        self._pending = asyncio.Event()
+        self._acked = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, text, key=None):
+        """
+        Queue an encoded event. Returns False, and queues nothing, if the
+        buffer is full under the disconnect policy.
+        """
+        if self.closed:
+            return True
+        if key is not None and self.policy == COALESCE:
+            if self._events.pop(key, None) is not None:
+                metrics.outbound_events_dropped.inc(reason='coalesced')
+        else:
+            key = next(self._ids)
+        if len(self._events) >= self.size:
+            if self.policy == DISCONNECT:
+                return False
+            self._events.popitem(last=False)
+            self.dropped += 1
+            metrics.outbound_events_dropped.inc(reason='overflow')
+        self._events[key] = text
+        self._pending.set()
+        return True
+
+    async def send_now(self, text):
+        """Send a frame straight away, ahead of anything queued (replies to the client)."""
+        self.sent += 1
+        await self.send(text)
+
+    def acknowledge(self, frames):
+        """The client has handled its first ``frames`` frames."""
+        self.acking = True
+        self.acked = max(self.acked, min(frames, self.sent))
+        self._acked.set()
+
+    @property
+    def unacked(self):
+        return self.sent - self.acked
+
+    def close(self):
+        """Stop writing and forget anything still pending."""
+        self.closed = True
+        self._events.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    def take_frame(self):
+        """The next frame to send, taking its events off the buffer, or None if empty."""
+        count = min(self.batch_size, len(self._events))
+        batch = [self._events.popitem(last=False)[1] for _ in range(count)]
+        if self.dropped:
+            batch.append(dumps({"type": "messages_dropped", "count": self.dropped}))
+            self.dropped = 0
+        if not batch:
+            return None
+        metrics.outbound_batch_size.observe(len(batch))
+        return batch[0] if len(batch) == 1 else '[%s]' % ','.join(batch)
+
+    async def _run(self):
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            while self._events or self.dropped:
+                if self.acking and not await self._wait_for_acks():
+                    if self.on_stalled is not None:
+                        await self.on_stalled()
+                    return
+                try:
+                    await self.send_now(self.take_frame())
+                except Exception as e:
+                    logger.error("Error sending to client: %s", e)
+
+    async def _wait_for_acks(self):
+        """Wait until the client is back within the window; False if that takes over ``ack_timeout``."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.ack_timeout
+        while self.unacked >= self.window:
+            self._acked.clear()
+            try:
+                await asyncio.wait_for(self._acked.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return False
+        return True
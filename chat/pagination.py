@@ -0,0 +1,175 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over (timestamp_field, id), newest first.
+
+    The cursor for the next (older) page is sent in the X-Next-Cursor header
+    so the response body stays a plain list.
+    """
+    page_size = 50
+    max_page_size = 200
+    timestamp_field = 'timestamp'
+    # Return each page oldest-first instead of newest-first
+    reverse_page = False
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    cursor_header = 'X-Next-Cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.build_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset for async views, fetching the page with the async ORM."""
+        return self.build_page([obj async for obj in self.page_queryset(queryset, request)])
+
+    def page_queryset(self, queryset, request):
+        """The sliced queryset for the requested page, with one extra row to detect a next page."""
+        self.next_cursor = None
+        self.page_size_in_use = page_size = self.get_page_size(request)
+        return self.keyset_queryset(queryset, request)[:page_size + 1]
+
+    def keyset_queryset(self, queryset, request):
+        """``queryset`` after the cursor, in page order."""
+        field = self.timestamp_field
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            timestamp, pk = self.decode_cursor(encoded)
+            queryset = queryset.filter(Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'id__lt': pk}))
+        return queryset.order_by(f'-{field}', '-id')
+
+    def build_page(self, page):
+        if len(page) > self.page_size_in_use:
+            page = page[:self.page_size_in_use]
+            self.next_cursor = self.encode_cursor(page[-1])
+        if self.reverse_page:
+            page.reverse()
+        return page
+
+    def get_paginated_response(self, data):
+        response = Response(data)
+        if self.next_cursor:
+            response[self.cursor_header] = self.next_cursor
+        return response
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, instance):
+        raw = f"{getattr(instance, self.timestamp_field).isoformat()}|{instance.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode()).decode()
+            timestamp, pk = raw.rsplit('|', 1)
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound('Invalid cursor')
+        if timestamp is None:
+            raise NotFound('Invalid cursor')
+        return timestamp, pk
+
+
+class MessageKeysetPagination(KeysetPagination):
+    """
+    Conversation history, newest page first, each page oldest-first so the
+    client can render it directly.
+
+    ?after_id=N or ?since=<iso timestamp> switches to incremental mode and
+    returns only messages newer than what the client already has.
+
+    When the view has get_archive_queryset(), a page that runs out of
+    recent messages is filled from the archive, which only holds older
+    ones, so older pages read across both tables transparently.
+    """
+    reverse_page = True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = list(self.page_queryset(queryset, request))
+        archive = self.archive_queryset(page, request, view)
+        if archive is not None:
+            page += list(archive)
+        return self.build_page(page)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        page = [obj async for obj in self.page_queryset(queryset, request)]
+        archive = self.archive_queryset(page, request, view)
+        if archive is not None:
+            page += [obj async for obj in archive]
+        return self.build_page(page)
+
+    def archive_queryset(self, page, request, view):
+        """The archived rows that complete a short page, or None if none are needed."""
+        if self.incremental or len(page) > self.page_size_in_use or not hasattr(view, 'get_archive_queryset'):
+            return None
+        return self.keyset_queryset(view.get_archive_queryset(), request)[:self.page_size_in_use + 1 - len(page)]
+
+    def page_queryset(self, queryset, request):
+        after_id = request.query_params.get('after_id')
+        since = request.query_params.get('since')
+        self.incremental = bool(after_id or since)
+        if not self.incremental:
+            return super().page_queryset(queryset, request)
+
+        self.next_cursor = None
+        if after_id:
+            if not after_id.isdigit():
+                raise NotFound('Invalid after_id')
+            queryset = queryset.filter(id__gt=int(after_id))
+        if since:
+            since_ts = parse_datetime(since)
+            if since_ts is None:
+                raise NotFound('Invalid since')
+            queryset = queryset.filter(timestamp__gt=since_ts)
+        return queryset.order_by('timestamp', 'id')[:self.get_page_size(request)]
+
+    def build_page(self, page):
+        return page if self.incremental else super().build_page(page)
+
+
+class ConversationKeysetPagination(KeysetPagination):
+    timestamp_field = 'last_timestamp'
+    page_size = 30
+
+
+class UsernameKeysetPagination(KeysetPagination):
+    """Alphabetical keyset pagination for the user directory."""
+    page_size = 30
+
+    def page_queryset(self, queryset, request):
+        self.next_cursor = None
+        self.page_size_in_use = page_size = self.get_page_size(request)
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            queryset = queryset.filter(username__gt=self.decode_cursor(encoded))
+
+        return queryset.order_by('username')[:page_size + 1]
+
+    def encode_cursor(self, instance):
+        return base64.urlsafe_b64encode(instance.username.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        try:
+            return base64.urlsafe_b64decode(encoded.encode()).decode()
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound('Invalid cursor')
+
+
+class MessageSearchPagination(KeysetPagination):
+    """Search results, newest first."""
+    page_size = 20
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .conversations import record_messages
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_COMMIT = 'commit'
+DURABILITY_DELIVER = 'deliver'
+
+
+def persist_messages(messages):
+    """Insert a batch of unsaved ChatMessage instances with one bulk_create."""
+    with transaction.atomic():
+        messages = ChatMessage.objects.bulk_create(messages)
+        # bulk_create skips post_save, so update the summaries here
+        record_messages(messages)
+        return messages
+
+
+def persist_individually(messages):
+    """
+    Insert each message in its own transaction, after a batch failed on a
+    constraint (say a recipient deleted since it was cached). Returns the
+    saved message, or the IntegrityError, for each.
+    """
+    results = []
+    for message in messages:
+        try:
+            results.extend(persist_messages([message]))
+        except IntegrityError as e:
+            results.append(e)
+    return results
+
+
+class MessageWriter:
+    """
+    Per-process write-behind queue for chat messages.
+
+    Messages are collected for up to ``batch_window`` seconds (or until
+    ``batch_size`` are waiting) and then inserted with a single bulk_create.
+    ``enqueue`` returns a future that resolves to the saved instance, with
+    its id and timestamp assigned, once the batch has committed. If a row
+    breaks a constraint, the batch is retried row by row so only that
+    message's future fails.
+    """
+
+    def __init__(self, batch_size=None, batch_window=None):
+        self.batch_size = batch_size or getattr(settings, 'CHAT_MESSAGE_BATCH_SIZE', 100)
+        self.batch_window = batch_window if batch_window is not None else getattr(
+            settings, 'CHAT_MESSAGE_BATCH_WINDOW', 0.01)
+        self._loop = None
+        self._queue = []
+        self._timer = None
+
+    @property
+    def durability(self):
+        return getattr(settings, 'CHAT_MESSAGE_DURABILITY', DURABILITY_COMMIT)
+
+    def enqueue(self, message):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # A new event loop (e.g. a restarted server or test) starts a new queue
+            self._loop = loop
+            self._queue = []
+            self._timer = None
+
+        future = loop.create_future()
+        self._queue.append((message, future))
+        if len(self._queue) >= self.batch_size:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_window, self._flush_now)
+        return future
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if batch:
+            self._loop.create_task(self._write(batch))
+
+    async def _write(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            try:
+                results = await database_sync_to_async(persist_messages)(messages)
+            except IntegrityError as e:
+                logger.warning("Batch of %d messages failed (%s); retrying one at a time", len(batch), e)
+                results = await database_sync_to_async(persist_individually)(messages)
+        except Exception as e:
+            logger.error("Error persisting batch of %d messages: %s", len(batch), e)
+            results = [e] * len(batch)
+
+        logger.debug("Persisted batch of %d messages", len(batch))
+        for result, (_, future) in zip(results, batch):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+message_writer = MessageWriter()
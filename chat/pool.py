@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of DB-API connections for one database alias.
+
+    Threads borrow a connection with getconn() and hand it back with
+    putconn() instead of connecting and disconnecting. When all
+    ``max_size`` connections are in use, getconn() waits up to ``timeout``
+    seconds. Connections idle for longer than ``health_check_interval``
+    are checked with a trivial query before being handed out, and
+    replaced if they fail it. Connections older than ``max_lifetime``
+    are recycled.
+    """
+
+    def __init__(self, connect, alias='default', max_size=10, timeout=10,
+                 health_check_interval=30, max_lifetime=3600):
+        self.connect = connect
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.max_lifetime = max_lifetime
+        self._condition = threading.Condition()
+        # (connection, created_at, returned_at), most recently returned last
+        self._idle = deque()
+        self._created = {}
+        self._in_use = 0
+        self._waiting = 0
+
+    @property
+    def size(self):
+        return len(self._idle) + self._in_use
+
+    def stats(self):
+        with self._condition:
+            return {'size': self.size, 'idle': len(self._idle), 'in_use': self._in_use, 'waiting': self._waiting}
+
+    def getconn(self):
+        started = time.monotonic()
+        with self._condition:
+            while not self._idle and self.size >= self.max_size:
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    metrics.db_pool_timeouts.inc(alias=self.alias)
+                    raise PoolTimeout(f"No connection available in {self.timeout}s (pool size {self.max_size})")
+                self._waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+        metrics.db_pool_wait_seconds.observe(time.monotonic() - started, alias=self.alias)
+
+        try:
+            if entry is not None:
+                connection = self._checked(*entry)
+                if connection is not None:
+                    return connection
+            return self._new_connection()
+        except BaseException:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+    def putconn(self, connection, discard=False):
+        try:
+            if not discard and not self._closed(connection):
+                # Leave no transaction open for the next borrower
+                connection.rollback()
+        except Exception as e:
+            logger.warning("Discarding pooled connection that failed to reset: %s", e)
+            discard = True
+
+        created_at = self._created.get(id(connection), 0)
+        if (discard or self._closed(connection)
+                or time.monotonic() - created_at > self.max_lifetime):
+            self._discard(connection)
+            entry = None
+        else:
+            entry = (connection, created_at, time.monotonic())
+        with self._condition:
+            self._in_use -= 1
+            if entry is not None:
+                self._idle.append(entry)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+    def _new_connection(self):
+        connection = self.connect()
+        self._created[id(connection)] = time.monotonic()
+        metrics.db_pool_connections_created.inc(alias=self.alias)
+        return connection
+
+    def _checked(self, connection, created_at, returned_at):
+        """The idle connection if it's still usable, else None (after closing it)."""
+        now = time.monotonic()
+        if self._closed(connection) or now - created_at > self.max_lifetime:
+            self._discard(connection)
+            return None
+        if now - returned_at > self.health_check_interval:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                connection.rollback()
+            except Exception as e:
+                logger.info("Replacing pooled connection that failed its health check: %s", e)
+                metrics.db_pool_health_check_failures.inc(alias=self.alias)
+                self._discard(connection)
+                return None
+        return connection
+
+    def _discard(self, connection):
+        self._created.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _closed(connection):
+        return bool(getattr(connection, 'closed', False))
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, connect, **options):
+    """The process-wide pool for ``alias``, created on first use."""
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = metrics.db_pools[alias] = ConnectionPool(connect, alias=alias, **options)
+        return pool
@@ -0,0 +1,330 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .encoding import dumps
+from .models import UserActivity
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    """
+    Keeps last-activity timestamps in process memory and writes them back
+    to UserActivity in periodic bulk_update batches.
+
+    Online/offline transitions are written through immediately so other
+    processes see them; plain "still here" touches are throttled per user
+    and coalesced until the next flush. Each worker flushes on a timer
+    (start_flushing), so a user who goes quiet still has their last
+    activity written before the sweeper's TTL runs out.
+
+    Users who went offline, or haven't been seen for CHAT_PRESENCE_TTL,
+    are dropped from memory once written; status() then reads the row.
+    """
+
+    def __init__(self, flush_interval=None, throttle=None):
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(
+            settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 30)
+        self.throttle = throttle if throttle is not None else getattr(
+            settings, 'CHAT_PRESENCE_THROTTLE', 60)
+        self._lock = threading.Lock()
+        # user_id -> (last_activity, is_online)
+        self._seen = {}
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._flusher = None
+
+    def touch(self, user_id, is_online=True):
+        now = timezone.now()
+        with self._lock:
+            known = self._seen.get(user_id)
+            changed = known is None or known[1] != is_online
+            if not changed and (now - known[0]).total_seconds() < self.throttle:
+                return
+            self._seen[user_id] = (now, is_online)
+            if changed:
+                self._pending.pop(user_id, None)
+            else:
+                self._pending[user_id] = (now, is_online)
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+
+        if changed:
+            self._write_through(user_id, now, is_online)
+        elif due:
+            self.flush()
+
+    def _write_through(self, user_id, last_activity, is_online):
+        try:
+            UserActivity.objects.update_or_create(
+                user_id=user_id,
+                defaults={'last_activity': last_activity, 'is_online': is_online},
+            )
+        except DatabaseError as e:
+            logger.error("Error writing presence for user %s: %s", user_id, e)
+            with self._lock:
+                self._pending.setdefault(user_id, (last_activity, is_online))
+            return
+        if not is_online:
+            with self._lock:
+                if self._seen.get(user_id) == (last_activity, False):
+                    del self._seen[user_id]
+
+    def start_flushing(self):
+        """Flush every ``flush_interval`` seconds on the running event loop, once per loop."""
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await database_sync_to_async(self.flush)()
+            except Exception as e:
+                logger.error("Error in periodic presence flush: %s", e)
+
+    def flush(self):
+        idle_before = timezone.now() - timedelta(seconds=getattr(settings, 'CHAT_PRESENCE_TTL', 180))
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            # Written (here or earlier) and gone quiet: nothing left to throttle
+            for user_id in [user_id for user_id, (last_activity, _) in self._seen.items()
+                            if last_activity < idle_before and user_id not in pending]:
+                del self._seen[user_id]
+        if not pending:
+            return 0
+
+        try:
+            activities = list(UserActivity.objects.filter(user_id__in=pending.keys()))
+            for activity in activities:
+                activity.last_activity, activity.is_online = pending[activity.user_id]
+            UserActivity.objects.bulk_update(activities, ['last_activity', 'is_online'], batch_size=500)
+
+            missing = pending.keys() - {activity.user_id for activity in activities}
+            if missing:
+                UserActivity.objects.bulk_create(
+                    [UserActivity(user_id=user_id, last_activity=pending[user_id][0],
+                                  is_online=pending[user_id][1]) for user_id in missing],
+                    ignore_conflicts=True,
+                )
+        except DatabaseError as e:
+            logger.error("Error flushing presence for %d users: %s", len(pending), e)
+            with self._lock:
+                for user_id, state in pending.items():
+                    self._pending.setdefault(user_id, state)
+            return 0
+
+        logger.debug("Flushed presence for %d users", len(pending))
+        return len(pending)
+
+    def status(self, user_id, activity=None):
+        """Return (is_active, last_seen) merging the DB row with unflushed state."""
+        last_activity, is_online = (activity.last_activity, activity.is_online) if activity else (None, False)
+        seen = self._seen.get(user_id)
+        if seen and (last_activity is None or seen[0] >= last_activity):
+            last_activity, is_online = seen
+        is_active = (is_online and last_activity is not None
+                     and timezone.now() - last_activity < UserActivity.ACTIVE_WINDOW)
+        return is_active, last_activity
+
+    def forget(self, user_id):
+        with self._lock:
+            self._seen.pop(user_id, None)
+            self._pending.pop(user_id, None)
+
+
+def activity_of(user):
+    """The user's UserActivity row if it was loaded or exists, else None."""
+    try:
+        return user.useractivity
+    except UserActivity.DoesNotExist:
+        return None
+
+
+class MemoryConnectionSet:
+    """Each user's open connections, in this process only (development, one worker)."""
+
+    def __init__(self):
+        self._connections = {}
+
+    async def add(self, user_id, connection):
+        """Register ``connection``; returns the user's number of connections."""
+        connections = self._connections.setdefault(user_id, set())
+        connections.add(connection)
+        return len(connections)
+
+    async def remove(self, user_id, connection):
+        connections = self._connections.get(user_id, set())
+        connections.discard(connection)
+        if not connections:
+            self._connections.pop(user_id, None)
+        return len(connections)
+
+    async def refresh(self, user_id, connection):
+        pass
+
+    async def count(self, user_id):
+        return len(self._connections.get(user_id, ()))
+
+
+# KEYS: the user's sorted set. ARGV: now, expiry, ttl, connection, add (1/0).
+# Members are connections scored by when they expire. Returns the count left.
+UPDATE_CONNECTIONS_LUA = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    if ARGV[5] == '1' then
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+    else
+        redis.call('ZREM', KEYS[1], ARGV[4])
+    end
+    return redis.call('ZCARD', KEYS[1])
+"""
+
+
+class RedisConnectionSet:
+    """
+    Each user's open connections across all workers, as a sorted set in
+    Redis scored by expiry. Heartbeats push a connection's expiry out, so
+    the connections of a worker that died without running disconnect
+    drop out after ``ttl`` seconds instead of keeping the user online.
+    """
+
+    def __init__(self, url, ttl, prefix='chat:connections', clock=time.time):
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self.clock = clock
+        self._client = None
+        self._loop = None
+
+    @property
+    def client(self):
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Redis connections belong to the loop that opened them
+            self._loop = loop
+            self._client = redis.asyncio.Redis.from_url(self.url)
+        return self._client
+
+    async def _update(self, user_id, connection, add):
+        now = self.clock()
+        return await self.client.eval(
+            UPDATE_CONNECTIONS_LUA, 1, f"{self.prefix}:{user_id}",
+            repr(now), repr(now + self.ttl), self.ttl, connection, 1 if add else 0)
+
+    async def add(self, user_id, connection):
+        return await self._update(user_id, connection, True)
+
+    async def remove(self, user_id, connection):
+        return await self._update(user_id, connection, False)
+
+    async def refresh(self, user_id, connection):
+        await self._update(user_id, connection, True)
+
+    async def count(self, user_id):
+        return await self.client.zcount(f"{self.prefix}:{user_id}", repr(self.clock()), '+inf')
+
+
+class ConnectionTracker:
+    """
+    Counts each user's open WebSocket connections, across workers when the
+    connection set is shared (CHAT_PRESENCE_REDIS_URL).
+
+    The user only goes offline once their last connection closes and no new
+    one opens within the debounce delay, so extra tabs and quick reconnects
+    don't toggle presence. The count is checked again when the delay ends,
+    since the new connection may have opened on another worker.
+    """
+
+    def __init__(self, connections=None):
+        self.connections = connections if connections is not None else MemoryConnectionSet()
+        self._offline_tasks = {}
+
+    async def count(self, user_id):
+        return await self.connections.count(user_id)
+
+    async def connected(self, user_id, connection):
+        """Register a connection; returns True if the user has just come online."""
+        count = await self.connections.add(user_id, connection)
+        pending = self._offline_tasks.pop(user_id, None)
+        if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+            # Reconnected within the debounce window; never reported offline
+            pending.cancel()
+            return False
+        return count == 1
+
+    async def heartbeat(self, user_id, connection):
+        await self.connections.refresh(user_id, connection)
+
+    async def disconnected(self, user_id, connection, on_offline, delay):
+        """Unregister a connection; ``on_offline()`` is awaited if it was the last one."""
+        if await self.connections.remove(user_id, connection) > 0:
+            return
+        self._offline_tasks[user_id] = asyncio.create_task(self._go_offline(user_id, on_offline, delay))
+
+    async def _go_offline(self, user_id, on_offline, delay):
+        await asyncio.sleep(delay)
+        self._offline_tasks.pop(user_id, None)
+        try:
+            if await self.connections.count(user_id):
+                return  # reconnected on another worker
+            await on_offline()
+        except Exception as e:
+            logger.error("Error marking user %s offline: %s", user_id, e)
+
+
+def presence_group(user_id):
+    return f"presence_{user_id}"
+
+
+async def publish_presence(channel_layer, user_id, is_active):
+    """Send a presence delta to everyone subscribed to this user's presence group."""
+    payload = dumps({
+        "type": "presence",
+        "user_id": user_id,
+        "is_active": is_active,
+        "last_seen": timezone.now().isoformat(),
+    })
+    await channel_layer.group_send(presence_group(user_id), {"type": "presence_update", "user_id": user_id, "text": payload})
+
+
+def sweep_expired(ttl=None):
+    """
+    Mark users offline whose last heartbeat is older than ``ttl`` seconds,
+    e.g. because the worker holding their socket died without running
+    disconnect. The flip is a single UPDATE; returns the swept user ids.
+    """
+    ttl = ttl if ttl is not None else getattr(settings, 'CHAT_PRESENCE_TTL', 180)
+    cutoff = timezone.now() - timedelta(seconds=ttl)
+    expired = UserActivity.objects.filter(is_online=True, last_activity__lt=cutoff)
+    user_ids = list(expired.values_list('user_id', flat=True))
+    if user_ids:
+        expired.filter(user_id__in=user_ids).update(is_online=False)
+        logger.info("Swept %d expired presence sessions", len(user_ids))
+    return user_ids
+
+
+presence_tracker = PresenceTracker()
+atexit.register(presence_tracker.flush)
+
+
+def _create_connection_set():
+    url = getattr(settings, 'CHAT_PRESENCE_REDIS_URL', None)
+    if url:
+        return RedisConnectionSet(url, getattr(settings, 'CHAT_PRESENCE_TTL', 180))
+    return MemoryConnectionSet()
+
+
+connection_tracker = ConnectionTracker(_create_connection_set())
@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import threading
+import time
+
+from django.conf import settings
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` events per second on average and bursts of up to
+    ``burst``. Thread-safe; time comes from ``clock`` so tests can drive it.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, tokens=1):
+        """Take ``tokens`` and return 0, or return the seconds until they'd be available."""
+        with self._lock:
+            self._refill(self.clock())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill(self.clock())
+            return self._tokens
+
+
+class MemoryRateLimiter:
+    """
+    A TokenBucket per key, for limits on everything one user does in this
+    worker. Keeps the ``maxsize`` most recently used buckets; one dropped
+    for being idle starts again full.
+    """
+
+    def __init__(self, rate, burst, maxsize=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = collections.OrderedDict()
+
+    async def take(self, key, tokens=1):
+        """Take ``tokens`` from ``key``'s bucket; see TokenBucket.take."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, clock=self.clock)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(tokens)
+
+    def clear(self):
+        self._buckets.clear()
+
+
+# KEYS: the bucket's hash. ARGV: rate, burst, now, tokens to take.
+# Returns the seconds to wait as a string (0 if taken).
+TAKE_LUA = """
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local now, take = tonumber(ARGV[3]), tonumber(ARGV[4])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= take then
+        tokens = tokens - take
+    else
+        wait = (take - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+"""
+
+
+class RedisRateLimiter:
+    """
+    The same buckets kept in Redis, so a limit holds across workers. Each
+    take is one script call; buckets expire once they'd be full again.
+    Time comes from the workers' wall clocks, which should agree closely.
+    """
+
+    def __init__(self, url, rate, burst, prefix='chat:ratelimit', clock=time.time):
+        self.url = url
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self.clock = clock
+        self._client = None
+        self._loop = None
+
+    @property
+    def client(self):
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Redis connections belong to the loop that opened them
+            self._loop = loop
+            self._client = redis.asyncio.Redis.from_url(self.url)
+        return self._client
+
+    async def take(self, key, tokens=1):
+        wait = await self.client.eval(
+            TAKE_LUA, 1, f"{self.prefix}:{key}", self.rate, self.burst, repr(self.clock()), tokens)
+        return float(wait)
+
+
+def _create_user_limiter():
+    rate = getattr(settings, 'CHAT_USER_MESSAGE_RATE', 10)
+    if not rate:
+        return None
+    burst = getattr(settings, 'CHAT_USER_MESSAGE_BURST', 40)
+    url = getattr(settings, 'CHAT_RATELIMIT_REDIS_URL', None)
+    if url:
+        return RedisRateLimiter(url, rate, burst)
+    return MemoryRateLimiter(rate, burst)
+
+
+user_message_limiter = _create_user_limiter()
@@ -0,0 +1,161 @@
+"""
+Per-user message log for replaying missed messages on reconnect.
+
+Every chat message delivered to a user gets the next number in that user's
+sequence, and the encoded event is kept in a bounded log. A reconnecting
+client passes the last sequence it saw (``?last_seq=``) and the consumer
+replays just the events after it. If the log no longer reaches back that
+far, the consumer falls back to the messages after the client's
+``last_id`` in the database.
+
+Two logs: MemoryMessageLog keeps the sequences in this process and is only
+correct with a single worker (development). RedisMessageLog shares them
+between workers and is used when CHAT_REPLAY_REDIS_URL is set.
+"""
+import asyncio
+import collections
+import logging
+
+from django.conf import settings
+from django.db.models import Q
+
+from .encoding import dumps
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+def with_seq(payload, seq):
+    """Add ``"seq"`` to an encoded JSON object without decoding it."""
+    return '{"seq":%d,%s' % (seq, payload[1:])
+
+
+class MemoryMessageLog:
+    def __init__(self, size):
+        self.size = size
+        self._seqs = collections.defaultdict(int)
+        self._events = {}
+
+    async def append(self, user_ids, payload):
+        """Give ``payload`` the next sequence of each user; returns {user_id: seq}."""
+        seqs = {}
+        for user_id in user_ids:
+            seq = self._seqs[user_id] = self._seqs[user_id] + 1
+            events = self._events.get(user_id)
+            if events is None:
+                events = self._events[user_id] = collections.deque(maxlen=self.size)
+            events.append((seq, with_seq(payload, seq)))
+            seqs[user_id] = seq
+        return seqs
+
+    async def since(self, user_id, last_seq):
+        """
+        Return (current_seq, events after ``last_seq``), or (current_seq,
+        None) if the log doesn't reach back to ``last_seq``.
+        """
+        current = self._seqs.get(user_id, 0)
+        if last_seq is None or last_seq == current:
+            return current, []
+        events = self._events.get(user_id, ())
+        if last_seq > current or not events or events[0][0] > last_seq + 1:
+            return current, None
+        return current, [text for seq, text in events if seq > last_seq]
+
+    def clear(self):
+        self._seqs.clear()
+        self._events.clear()
+
+
+# KEYS: a (sequence, log) key pair per user. ARGV: payload, size, ttl.
+# Returns the new sequence per user.
+APPEND_LUA = """
+    local seqs = {}
+    for i = 1, #KEYS, 2 do
+        local seq = redis.call('INCR', KEYS[i])
+        redis.call('ZADD', KEYS[i + 1], seq, '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2))
+        redis.call('ZREMRANGEBYRANK', KEYS[i + 1], 0, -tonumber(ARGV[2]) - 1)
+        redis.call('EXPIRE', KEYS[i + 1], ARGV[3])
+        seqs[#seqs + 1] = seq
+    end
+    return seqs
+"""
+
+
+class RedisMessageLog:
+    """
+    Sequences and logs in Redis: a counter per user and a sorted set of
+    encoded events scored by sequence, trimmed to ``size`` entries.
+    """
+
+    def __init__(self, url, size, ttl=86400, prefix='chat:replay'):
+        self.url = url
+        self.size = size
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = None
+        self._loop = None
+
+    @property
+    def client(self):
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Redis connections belong to the loop that opened them
+            self._loop = loop
+            self._client = redis.asyncio.Redis.from_url(self.url)
+        return self._client
+
+    def _keys(self, user_id):
+        return f"{self.prefix}:seq:{user_id}", f"{self.prefix}:log:{user_id}"
+
+    async def append(self, user_ids, payload):
+        keys = [key for user_id in user_ids for key in self._keys(user_id)]
+        seqs = await self.client.eval(APPEND_LUA, len(keys), *keys, payload, self.size, self.ttl)
+        return dict(zip(user_ids, seqs))
+
+    async def since(self, user_id, last_seq):
+        seq_key, log_key = self._keys(user_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(seq_key)
+        pipe.zrange(log_key, 0, 0, withscores=True)
+        pipe.zrangebyscore(log_key, f"({last_seq or 0}", '+inf')
+        current, first, events = await pipe.execute()
+        current = int(current or 0)
+        if last_seq is None or last_seq == current:
+            return current, []
+        if last_seq > current or not first or first[0][1] > last_seq + 1:
+            return current, None
+        return current, [event.decode() for event in events]
+
+
+def messages_after(user_id, last_id, limit):
+    """Encoded events for the user's messages after ``last_id``, oldest first, at most ``limit``."""
+    rows = (
+        ChatMessage.objects
+        .filter(Q(sender_id=user_id) | Q(recipient_id=user_id), id__gt=last_id)
+        .order_by('id')
+        .values_list('id', 'sender__username', 'sender_id', 'recipient_id', 'content', 'timestamp')[:limit]
+    )
+    return [
+        dumps({
+            "id": id,
+            "sender": sender,
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "content": content,
+            "timestamp": timestamp.isoformat(),
+        })
+        for id, sender, sender_id, recipient_id, content, timestamp in rows
+    ]
+
+
+def _create_log():
+    size = getattr(settings, 'CHAT_REPLAY_BUFFER', 200)
+    url = getattr(settings, 'CHAT_REPLAY_REDIS_URL', None)
+    if url:
+        return RedisMessageLog(url, size, ttl=getattr(settings, 'CHAT_REPLAY_TTL', 86400))
+    return MemoryMessageLog(size)
+
+
+message_log = _create_log()
@@ -0,0 +1,92 @@
+"""
+Message retention: deleting messages older than the retention period.
+
+CHAT_RETENTION_DAYS sets the period for the deployment (None keeps
+messages forever) and Conversation.retention_days overrides it for one
+conversation. purge_batch() deletes one small, keyset-ordered chunk per
+transaction, so the purge_messages command can walk through millions of
+rows without long locks or a WAL burst.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from .conversations import forget_unread, pair_filter
+from .models import ArchivedChatMessage, ChatMessage, Conversation
+
+PURGED_FIELDS = ('id', 'timestamp', 'sender_id', 'recipient_id', 'is_read')
+
+
+def purge_targets(now=None):
+    """
+    (description, queryset, conversations) for everything past retention:
+    both message tables past the default period, leaving out conversations
+    with an override, then each overridden conversation past its own.
+    ``conversations`` are the summaries whose snippets expire with them.
+    """
+    now = now or timezone.now()
+    default_days = getattr(settings, 'CHAT_RETENTION_DAYS', None)
+    overrides = list(Conversation.objects.filter(retention_days__isnull=False)
+                     .values_list('user_low_id', 'user_high_id', 'retention_days'))
+
+    targets = []
+    if default_days is not None:
+        cutoff = now - timedelta(days=default_days)
+        # One correlated lookup on the conversation's unique pair, however
+        # many conversations have an override
+        overridden = Conversation.objects.filter(
+            retention_days__isnull=False,
+            user_low_id=Least(OuterRef('sender_id'), OuterRef('recipient_id')),
+            user_high_id=Greatest(OuterRef('sender_id'), OuterRef('recipient_id')),
+        )
+        for model in (ArchivedChatMessage, ChatMessage):
+            queryset = model.objects.filter(timestamp__lt=cutoff).exclude(Exists(overridden))
+            targets.append((
+                f"{model.__name__} older than {default_days} days",
+                queryset,
+                Conversation.objects.filter(retention_days__isnull=True, last_timestamp__lt=cutoff),
+            ))
+    for low, high, days in overrides:
+        cutoff = now - timedelta(days=days)
+        for model in (ArchivedChatMessage, ChatMessage):
+            targets.append((
+                f"{model.__name__} between users {low} and {high} older than {days} days",
+                model.objects.filter(pair_filter(low, high), timestamp__lt=cutoff),
+                Conversation.objects.filter(user_low_id=low, user_high_id=high, last_timestamp__lt=cutoff),
+            ))
+    return targets
+
+
+def purge_batch(queryset, after=None, batch_size=1000):
+    """
+    Delete the first ``batch_size`` rows of ``queryset`` in (timestamp, id)
+    order after the key ``after``, in one transaction. Returns the number
+    deleted and the key to continue from.
+
+    Continuing from the last key, rather than from the start of the
+    index, skips the entries of rows already deleted but not yet vacuumed.
+    """
+    if after is not None:
+        timestamp, pk = after
+        queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+    model = queryset.model
+    with transaction.atomic():
+        rows = list(queryset.order_by('timestamp', 'id').values(*PURGED_FIELDS)[:batch_size])
+        if not rows:
+            return 0, after
+        ids = [row['id'] for row in rows]
+        if model is ChatMessage:
+            Conversation.objects.filter(last_message_id__in=ids).update(last_message=None)
+            # Archived messages were already taken off the unread totals
+            forget_unread(rows)
+        model.objects.filter(id__in=ids).delete()
+    return len(rows), (rows[-1]['timestamp'], rows[-1]['id'])
+
+
+def expire_snippets(conversations):
+    """Blank the last-message preview of summaries whose last message has been purged."""
+    return conversations.exclude(last_snippet='').update(last_snippet='')
@@ -0,0 +1,87 @@
+"""
+Full-text search over the messages a user sent or received.
+
+PostgreSQL matches ChatMessage.search_vector, a tsvector kept up to date
+by a trigger and indexed with GIN (migration 0011), and builds snippets
+with ts_headline. SQLite matches the chat_message_fts FTS5 table, kept in
+sync by triggers, and builds snippets with snippet(). Other databases fall
+back to an unindexed icontains.
+
+Snippets are plain text with matches wrapped in HIGHLIGHT_START and
+HIGHLIGHT_STOP; render_snippet() escapes them and turns the markers into
+<mark> tags.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+
+from .models import ChatMessage
+
+# Text search configuration used by the trigger in migration 0011
+SEARCH_CONFIG = 'english'
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+SNIPPET_WORDS = 16
+
+
+def fts5_query(query):
+    """
+    An FTS5 MATCH expression for the words in ``query``: all of them, the
+    last one as a prefix. Quoting each word keeps FTS5 syntax out of reach.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search_messages(user_id, query, other_user_id=None):
+    """
+    The user's messages matching ``query``, optionally only those with
+    ``other_user_id``. On PostgreSQL each result is annotated with ``snippet``.
+    """
+    # Matched on in the database, never needed in the results
+    queryset = ChatMessage.objects.defer('search_vector').filter(Q(sender_id=user_id) | Q(recipient_id=user_id))
+    if other_user_id is not None:
+        queryset = queryset.filter(Q(sender_id=other_user_id) | Q(recipient_id=other_user_id))
+
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchHeadline, SearchQuery
+
+        search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+        return queryset.filter(search_vector=search_query).annotate(snippet=SearchHeadline(
+            'content', search_query, config=SEARCH_CONFIG,
+            start_sel=HIGHLIGHT_START, stop_sel=HIGHLIGHT_STOP,
+            max_words=SNIPPET_WORDS, min_words=SNIPPET_WORDS // 2,
+        ))
+
+    if connection.vendor == 'sqlite':
+        match = fts5_query(query)
+        if match is None:
+            return queryset.none()
+        return queryset.filter(id__in=RawSQL(
+            'SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH %s', [match]))
+
+    return queryset.filter(content__icontains=query)
+
+
+def sqlite_snippets(message_ids, query):
+    """{message id: snippet} from the FTS5 table, for one page of SQLite results."""
+    match = fts5_query(query)
+    if not message_ids or match is None:
+        return {}
+    placeholders = ','.join(['%s'] * len(message_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid, snippet(chat_message_fts, 0, %s, %s, '…', %s) FROM chat_message_fts "
+            f"WHERE chat_message_fts MATCH %s AND rowid IN ({placeholders})",
+            [HIGHLIGHT_START, HIGHLIGHT_STOP, SNIPPET_WORDS, match, *message_ids],
+        )
+        return dict(cursor.fetchall())
+
+
+def render_snippet(snippet):
+    return escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
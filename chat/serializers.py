@@ -1,17 +1,76 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import ChatMessage
+from .models import ChatMessage, Conversation
+from .cache import cache_user, get_cached_user
+from .presence import presence_tracker, activity_of
+from .search import render_snippet
 
 class UserSerializer(serializers.ModelSerializer):
+    is_active = serializers.SerializerMethodField()
+    last_seen = serializers.SerializerMethodField()
+
     class Meta:
         model = User
-        fields = ['id', 'username']
+        fields = ['id', 'username', 'is_active', 'last_seen']
+
+    def to_representation(self, instance):
+        # Users listed here are likely to be messaged next; warm the shared cache
+        cache_user(instance)
+        self._status = presence_tracker.status(instance.id, activity_of(instance))
+        return super().to_representation(instance)
+
+    def get_is_active(self, obj):
+        return self._status[0]
+
+    def get_last_seen(self, obj):
+        last_seen = self._status[1]
+        return serializers.DateTimeField().to_representation(last_seen) if last_seen else None
 
 class ChatMessageSerializer(serializers.ModelSerializer):
-    sender_username = serializers.CharField(source='sender.username', read_only=True)
-    recipient_username = serializers.CharField(source='recipient.username', read_only=True)
+    # Resolved through the shared user cache instead of joining auth_user
+    sender_username = serializers.SerializerMethodField()
+    recipient_username = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatMessage
-        fields = ['id', 'sender', 'sender_username', 'recipient', 'recipient_username', 
-                 'content', 'timestamp', 'is_read']
\ No newline at end of file
+        fields = ['id', 'sender', 'sender_username', 'recipient', 'recipient_username',
+                 'content', 'timestamp', 'is_read']
+
+    def get_sender_username(self, obj):
+        user = get_cached_user(obj.sender_id)
+        return user.username if user else None
+
+    def get_recipient_username(self, obj):
+        user = get_cached_user(obj.recipient_id)
+        return user.username if user else None
+
+class MessageSearchSerializer(ChatMessageSerializer):
+    # HTML-escaped excerpt with the matches in <mark> tags
+    snippet = serializers.SerializerMethodField()
+
+    class Meta(ChatMessageSerializer.Meta):
+        fields = ChatMessageSerializer.Meta.fields + ['snippet']
+
+    def get_snippet(self, obj):
+        return render_snippet(getattr(obj, 'snippet', None) or obj.content[:200])
+
+class ConversationSerializer(serializers.ModelSerializer):
+    """A conversation from the requesting user's point of view."""
+
+    class Meta:
+        model = Conversation
+        fields = ['id', 'last_message', 'last_sender', 'last_timestamp', 'last_snippet']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        user_id = self.context['request'].user.id
+        other = instance.other_user(user_id)
+        cache_user(other)
+        is_active, last_seen = presence_tracker.status(other.id, activity_of(other))
+        data.update({
+            'user': {'id': other.id, 'username': other.username},
+            'unread_count': instance.unread_for(user_id),
+            'is_active': is_active,
+            'last_seen': serializers.DateTimeField().to_representation(last_seen) if last_seen else None,
+        })
+        return data
\ No newline at end of file
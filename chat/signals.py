@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import forget_user_sessions, session_user_cache, user_cache
+from .conversations import record_messages
+from .metrics import count_query
+from .models import ChatMessage
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance.id)
+    # A password change or deactivation must reach WebSocket handshakes too
+    forget_user_sessions(instance.id)
+
+
+@receiver(user_logged_out)
+def invalidate_cached_session(sender, request, user, **kwargs):
+    if request is not None and request.session.session_key:
+        session_user_cache.invalidate(request.session.session_key)
+
+
+@receiver(post_save, sender=ChatMessage)
+def update_conversation_summary(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_messages([instance])
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
@@ -3,10 +3,38 @@ from django.contrib.auth.models import User
 from django.urls import reverse
 from channels.testing import WebsocketCommunicator
 from channels.routing import URLRouter
+from channels.layers import get_channel_layer
+from channels.db import database_sync_to_async
 from channels.auth import AuthMiddlewareStack
 from .routing import websocket_urlpatterns
-from .models import ChatMessage
+from .models import ChatMessage, UserActivity, Conversation, ArchivedChatMessage
+from .archive import archive_batch, archive_cutoff
+from .retention import purge_batch, purge_targets
+from .presence import PresenceTracker, presence_tracker, sweep_expired, ConnectionTracker, MemoryConnectionSet
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, IntegrityError
+from unittest import mock
+import asyncio
+import time
+from asgiref.sync import async_to_sync
+from .persistence import MessageWriter, persist_messages
+from .cache import user_cache, get_cached_user, session_user_cache, MISSING
+from .middleware import CachedAuthMiddlewareStack
+from .receipts import mark_read, unread_count
+from .conversations import record_messages
+from . import metrics
+from .workers import connection_registry, connect_admission, ConnectionAdmission
+from .ratelimit import TokenBucket, MemoryRateLimiter
+from .outbound import OutboundBuffer
+from .replay import MemoryMessageLog, message_log
+from django.test import override_settings
+from django.conf import settings
 import json
+from datetime import timedelta
+from django.utils import timezone
+from django.core.management import call_command
+from .pool import ConnectionPool, PoolTimeout
+import threading
 
 class ChatTests(TestCase):
     def setUp(self):
@@ -82,4 +110,1387 @@ class UserAuthTests(TestCase):
             'password': 'testpass123'
         })
         self.assertEqual(response.status_code, 302)
-        self.assertTrue('_auth_user_id' in self.client.session)
\ No newline at end of file
+        self.assertTrue('_auth_user_id' in self.client.session)
+
+class PresenceTrackerTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.tracker = PresenceTracker(flush_interval=3600, throttle=0)
+
+    def test_repeated_touches_are_buffered(self):
+        self.tracker.touch(self.user1.id)
+        self.assertTrue(UserActivity.objects.get(user=self.user1).is_online)
+
+        with CaptureQueriesContext(connection) as ctx:
+            for _ in range(10):
+                self.tracker.touch(self.user1.id)
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+        is_active, last_seen = self.tracker.status(self.user1.id)
+        self.assertTrue(is_active)
+        self.assertGreater(last_seen, UserActivity.objects.get(user=self.user1).last_activity)
+
+    def test_flush_writes_batch(self):
+        self.tracker.touch(self.user1.id)
+        self.tracker.touch(self.user2.id)
+        self.tracker.touch(self.user1.id)
+        self.tracker.touch(self.user2.id)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.tracker.flush(), 2)
+        self.assertEqual(len(ctx.captured_queries), 2)  # one SELECT, one bulk UPDATE
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_offline_is_written_through(self):
+        self.tracker.touch(self.user1.id)
+        self.tracker.touch(self.user1.id, is_online=False)
+        activity = UserActivity.objects.get(user=self.user1)
+        self.assertFalse(activity.is_online)
+        self.assertFalse(self.tracker.status(self.user1.id, activity)[0])
+
+    def test_offline_and_idle_users_are_evicted(self):
+        self.tracker.touch(self.user1.id)
+        self.tracker.touch(self.user1.id, is_online=False)
+        self.tracker.touch(self.user2.id)
+        self.assertNotIn(self.user1.id, self.tracker._seen)
+        self.tracker._seen[self.user2.id] = (timezone.now() - timedelta(days=1), True)
+        self.tracker.flush()
+        self.assertEqual(self.tracker._seen, {})
+
+    async def test_workers_flush_on_a_timer(self):
+        tracker = PresenceTracker(flush_interval=0.05, throttle=0)
+        await database_sync_to_async(tracker.touch)(self.user1.id)
+        with mock.patch.object(tracker, 'flush_interval', 3600):
+            await database_sync_to_async(tracker.touch)(self.user1.id)  # buffered
+        tracker.start_flushing()
+        await asyncio.sleep(0.3)
+        tracker._flusher.cancel()
+        self.assertEqual(tracker._pending, {})
+        activity = await database_sync_to_async(UserActivity.objects.get)(user=self.user1)
+        self.assertEqual(activity.last_activity, tracker._seen[self.user1.id][0])
+
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.client.login(username='user1', password='testpass123')
+        self.messages = [
+            ChatMessage.objects.create(
+                sender=self.user1 if i % 2 else self.user2,
+                recipient=self.user2 if i % 2 else self.user1,
+                content=f'Message {i}'
+            )
+            for i in range(5)
+        ]
+
+    def get(self, **params):
+        return self.client.get(reverse('message-list'), {'user_id': self.user2.id, **params})
+
+    def test_newest_page_first_then_cursor(self):
+        response = self.get(page_size=2)
+        self.assertEqual([m['content'] for m in response.json()], ['Message 3', 'Message 4'])
+
+        response = self.get(page_size=2, cursor=response['X-Next-Cursor'])
+        self.assertEqual([m['content'] for m in response.json()], ['Message 1', 'Message 2'])
+
+        response = self.get(page_size=2, cursor=response['X-Next-Cursor'])
+        self.assertEqual([m['content'] for m in response.json()], ['Message 0'])
+        self.assertFalse(response.has_header('X-Next-Cursor'))
+
+    def test_after_id_returns_only_newer(self):
+        response = self.get(after_id=self.messages[2].id)
+        self.assertEqual([m['id'] for m in response.json()], [self.messages[3].id, self.messages[4].id])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.get(cursor='not-a-cursor').status_code, 404)
+
+    def test_search_vector_is_not_loaded(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(len(self.get().json()), 5)
+            self.client.get(reverse('message-search'), {'q': 'message'})
+        selects = [q['sql'] for q in ctx.captured_queries if 'chat_chatmessage' in q['sql']]
+        self.assertEqual(len(selects), 2)
+        self.assertFalse([sql for sql in selects if 'search_vector' in sql])
+
+
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+
+    async def test_concurrent_messages_share_one_insert(self):
+        writer = MessageWriter(batch_size=10, batch_window=0.05)
+        with mock.patch.object(ChatMessage.objects, 'bulk_create',
+                               wraps=ChatMessage.objects.bulk_create) as bulk_create:
+            saved = await asyncio.gather(*[
+                writer.enqueue(ChatMessage(sender=self.user1, recipient=self.user2, content=f'Message {i}'))
+                for i in range(3)
+            ])
+        self.assertEqual(bulk_create.call_count, 1)
+        self.assertTrue(all(message.id and message.timestamp for message in saved))
+        self.assertEqual(len({message.id for message in saved}), 3)
+
+    async def test_full_batch_is_flushed_without_waiting(self):
+        writer = MessageWriter(batch_size=2, batch_window=60)
+        saved = await asyncio.wait_for(asyncio.gather(*[
+            writer.enqueue(ChatMessage(sender=self.user1, recipient=self.user2, content=f'Message {i}'))
+            for i in range(2)
+        ]), timeout=5)
+        self.assertEqual(len(saved), 2)
+
+    async def test_a_bad_row_fails_only_its_own_message(self):
+        writer = MessageWriter(batch_size=3, batch_window=60)
+        with self.assertLogs('chat.persistence', 'WARNING'):
+            results = await asyncio.wait_for(asyncio.gather(*[
+                writer.enqueue(ChatMessage(sender=self.user1, recipient=self.user2, content=content))
+                for content in ('first', None, 'third')  # NULL content violates a constraint
+            ], return_exceptions=True), timeout=5)
+        self.assertTrue(results[0].id and results[2].id)
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertEqual(await database_sync_to_async(ChatMessage.objects.count)(), 2)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # connection_established
+        return communicator
+
+    async def receive_event(self, communicator):
+        event = await communicator.receive_json_from(timeout=5)
+        while event.get('type') == 'presence':
+            event = await communicator.receive_json_from(timeout=5)
+        return event
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='commit')
+    async def test_authenticated_send_is_persisted_and_echoed(self):
+        communicator = await self.connect(self.user1)
+        await communicator.send_json_to({'message': 'Hello', 'recipient_id': self.user2.id})
+        response = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(response['content'], 'Hello')
+        self.assertNotIn('temp_id', response)
+        saved = await database_sync_to_async(ChatMessage.objects.get)(content='Hello')
+        self.assertEqual(response['id'], saved.id)
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+        await communicator.disconnect()
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='deliver')
+    async def test_deliver_mode_follows_up_with_the_real_id(self):
+        sender = await self.connect(self.user1)
+        recipient = await self.connect(self.user2)
+        await sender.send_json_to({'message': 'Hello', 'recipient_id': self.user2.id})
+        for communicator in (sender, recipient):
+            message = await self.receive_event(communicator)
+            self.assertEqual((message['content'], message['id']), ('Hello', None))
+            persisted = await self.receive_event(communicator)
+            self.assertEqual((persisted['type'], persisted['temp_id']), ('persisted', message['temp_id']))
+            self.assertEqual((persisted['sender_id'], persisted['recipient_id']), (self.user1.id, self.user2.id))
+            self.assertEqual(persisted['seq'], message['seq'] + 1)
+        saved = await database_sync_to_async(ChatMessage.objects.get)(content='Hello')
+        self.assertEqual(persisted['id'], saved.id)
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='deliver')
+    async def test_deliver_mode_reports_a_failed_write(self):
+        sender = await self.connect(self.user1)
+        with mock.patch('chat.persistence.persist_messages', side_effect=RuntimeError('database down')), \
+                self.assertLogs('chat.consumers', 'ERROR'):
+            await sender.send_json_to({'message': 'Hello', 'recipient_id': self.user2.id})
+            message = await self.receive_event(sender)
+            failed = await self.receive_event(sender)
+        self.assertEqual(failed, {
+            'type': 'persist_failed', 'temp_id': message['temp_id'], 'seq': message['seq'] + 1,
+            'sender_id': self.user1.id, 'recipient_id': self.user2.id,
+        })
+        await sender.disconnect()
+
+
+class UserCacheTests(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+
+    def test_repeat_lookups_hit_cache(self):
+        self.assertEqual(get_cached_user(self.user2.id).username, 'user2')
+        with self.assertNumQueries(0):
+            for _ in range(5):
+                self.assertEqual(get_cached_user(self.user2.id).username, 'user2')
+        self.assertEqual(user_cache.stats()['hits'], 5)
+        self.assertIsNone(get_cached_user(999999))
+
+    def test_rename_and_delete_invalidate(self):
+        get_cached_user(self.user2.id)
+        self.user2.username = 'renamed'
+        self.user2.save()
+        self.assertEqual(get_cached_user(self.user2.id).username, 'renamed')
+
+        user_id = self.user2.id
+        self.user2.delete()
+        self.assertIsNone(get_cached_user(user_id))
+
+    def test_lru_evicts_oldest(self):
+        from .cache import LRUCache, MISSING
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('a'), 1)
+
+class FanoutTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # connection_established
+        return communicator
+
+    async def test_each_connection_receives_message_once(self):
+        sender = await self.connect(self.user1)
+        sender_other_tab = await self.connect(self.user1)
+        recipient = await self.connect(self.user2)
+
+        await sender.send_json_to({'message': 'Hello', 'recipient_id': self.user2.id})
+        for communicator in (sender, sender_other_tab, recipient):
+            response = await communicator.receive_json_from(timeout=5)
+            self.assertEqual(response['content'], 'Hello')
+            self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+
+        for communicator in (sender, sender_other_tab, recipient):
+            await communicator.disconnect()
+
+
+
+class ReadReceiptTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.messages = [
+            ChatMessage.objects.create(sender=self.user1, recipient=self.user2, content=f'Message {i}')
+            for i in range(3)
+        ]
+
+    def test_mark_read_is_one_range_update(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(mark_read(self.user2.id, self.user1.id, self.messages[1].id), 2)
+        message_updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "chat_chatmessage"')]
+        self.assertEqual(len(message_updates), 1)
+        self.assertEqual(unread_count(self.user2.id), 1)
+        self.assertEqual(mark_read(self.user2.id, self.user1.id, self.messages[1].id), 0)
+
+    @override_settings(CHAT_READ_RECEIPT_DELAY=0.05)
+    async def test_receipts_are_coalesced_and_pushed_to_sender(self):
+        sender = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        sender.scope['user'] = self.user1
+        reader = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        reader.scope['user'] = self.user2
+        for communicator in (sender, reader):
+            await communicator.connect()
+            await communicator.receive_json_from()  # connection_established
+        presence = await sender.receive_json_from(timeout=5)
+        self.assertEqual(presence['type'], 'presence')
+
+        for message in self.messages:
+            await reader.send_json_to({'type': 'read', 'sender_id': self.user1.id, 'up_to': message.id})
+
+        receipt = await sender.receive_json_from(timeout=5)
+        self.assertEqual(receipt['type'], 'read_receipt')
+        self.assertEqual(receipt['up_to'], self.messages[-1].id)
+        self.assertTrue(await sender.receive_nothing(timeout=0.2))
+
+        for communicator in (sender, reader):
+            await communicator.disconnect()
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.user3 = User.objects.create_user(username='user3', password='testpass123')
+        self.client.login(username='user1', password='testpass123')
+
+    def test_summary_tracks_saves_and_reads(self):
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user1, content='First')
+        persist_messages([
+            ChatMessage(sender=self.user2, recipient=self.user1, content='Second'),
+            ChatMessage(sender=self.user1, recipient=self.user2, content='Reply'),
+        ])
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_snippet, 'Reply')
+        self.assertEqual(conversation.last_sender, self.user1)
+        self.assertEqual(conversation.unread_for(self.user1.id), 2)
+        self.assertEqual(conversation.unread_for(self.user2.id), 1)
+
+        last_incoming = ChatMessage.objects.filter(sender=self.user2).latest('id')
+        mark_read(self.user1.id, self.user2.id, last_incoming.id)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.unread_for(self.user1.id), 0)
+
+    def test_batches_committing_out_of_order_keep_the_newest_last(self):
+        newer, older = ChatMessage.objects.bulk_create([
+            ChatMessage(sender=self.user2, recipient=self.user1, content='Newer'),
+            ChatMessage(sender=self.user2, recipient=self.user1, content='Older'),
+        ])
+        older.timestamp = newer.timestamp - timedelta(seconds=1)
+        ChatMessage.objects.filter(pk=older.pk).update(timestamp=older.timestamp)
+        # Two workers' batches, the later-written one committing first
+        record_messages([newer])
+        record_messages([older])
+
+        conversation = Conversation.objects.get()
+        self.assertEqual((conversation.last_message_id, conversation.last_snippet), (newer.id, 'Newer'))
+        self.assertEqual(conversation.last_timestamp, newer.timestamp)
+        self.assertEqual(conversation.unread_for(self.user1.id), 2)
+
+    def test_conversation_list_is_sorted_by_recency(self):
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user1, content='Older')
+        ChatMessage.objects.create(sender=self.user1, recipient=self.user3, content='Newer')
+
+        response = self.client.get(reverse('conversation-list'))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([c['user']['username'] for c in data], ['user3', 'user2'])
+        self.assertEqual(data[1]['unread_count'], 1)
+        self.assertEqual(data[1]['last_snippet'], 'Older')
+
+    def test_chat_view_lists_recent_conversations(self):
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user1, content='Hi there')
+        response = self.client.get(reverse('chat'))
+        self.assertContains(response, 'Hi there')
+        self.assertEqual(len(response.context['conversations']), 1)
+
+class UserDirectoryTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.me = User.objects.create_user(username='me', password='testpass123')
+        for name in ('alice', 'albert', 'alfred', 'bob'):
+            User.objects.create_user(username=name, password='testpass123')
+        self.client.login(username='me', password='testpass123')
+
+    def test_prefix_search_is_paginated(self):
+        response = self.client.get(reverse('user-list'), {'q': 'AL', 'page_size': 2})
+        self.assertEqual([u['username'] for u in response.json()], ['albert', 'alfred'])
+        self.assertIn('is_active', response.json()[0])
+
+        response = self.client.get(reverse('user-list'), {'q': 'AL', 'page_size': 2,
+                                                          'cursor': response['X-Next-Cursor']})
+        self.assertEqual([u['username'] for u in response.json()], ['alice'])
+        self.assertFalse(response.has_header('X-Next-Cursor'))
+
+    def test_directory_excludes_current_user(self):
+        response = self.client.get(reverse('user-list'))
+        usernames = [u['username'] for u in response.json()]
+        self.assertNotIn('me', usernames)
+        self.assertEqual(len(usernames), 4)
+
+
+@override_settings(CHAT_PRESENCE_DEBOUNCE=0.1)
+class PresenceBroadcastTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        ChatMessage.objects.create(sender=self.user1, recipient=self.user2, content='Hello')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # connection_established
+        return communicator
+
+    async def test_contacts_see_online_and_debounced_offline(self):
+        watcher = await self.connect(self.user2)
+
+        first_tab = await self.connect(self.user1)
+        update = await watcher.receive_json_from(timeout=5)
+        self.assertEqual((update['type'], update['user_id'], update['is_active']), ('presence', self.user1.id, True))
+
+        # A second tab closing doesn't take the user offline
+        second_tab = await self.connect(self.user1)
+        await second_tab.disconnect()
+        self.assertTrue(await watcher.receive_nothing(timeout=0.3))
+
+        await first_tab.disconnect()
+        update = await watcher.receive_json_from(timeout=5)
+        self.assertFalse(update['is_active'])
+        await watcher.disconnect()
+
+    async def test_quick_reconnect_is_not_broadcast(self):
+        watcher = await self.connect(self.user2)
+        tab = await self.connect(self.user1)
+        await watcher.receive_json_from(timeout=5)  # online
+
+        await tab.disconnect()
+        tab = await self.connect(self.user1)
+        self.assertTrue(await watcher.receive_nothing(timeout=0.3))
+
+        await tab.disconnect()
+        await watcher.receive_json_from(timeout=5)  # offline
+        await watcher.disconnect()
+
+
+    async def test_connections_are_counted_across_workers(self):
+        # Two workers' trackers sharing one connection set, as with Redis
+        connections = MemoryConnectionSet()
+        worker1, worker2 = ConnectionTracker(connections), ConnectionTracker(connections)
+        on_offline = mock.AsyncMock()
+        self.assertTrue(await worker1.connected(self.user1.id, 'tab-1'))
+        self.assertFalse(await worker2.connected(self.user1.id, 'tab-2'))
+
+        await worker1.disconnected(self.user1.id, 'tab-1', on_offline, 0.01)
+        await asyncio.sleep(0.05)
+        on_offline.assert_not_awaited()
+
+        # Closed, then reopened elsewhere before the debounce ran out
+        await worker2.disconnected(self.user1.id, 'tab-2', on_offline, 0.05)
+        await worker1.connected(self.user1.id, 'tab-3')
+        await asyncio.sleep(0.1)
+        on_offline.assert_not_awaited()
+
+        await worker1.disconnected(self.user1.id, 'tab-3', on_offline, 0.01)
+        await asyncio.sleep(0.05)
+        on_offline.assert_awaited_once()
+        self.assertEqual(await worker2.count(self.user1.id), 0)
+
+
+class PresenceSweepTests(TestCase):
+    def setUp(self):
+        self.stale = User.objects.create_user(username='stale', password='testpass123')
+        self.fresh = User.objects.create_user(username='fresh', password='testpass123')
+        self.offline = User.objects.create_user(username='offline', password='testpass123')
+        long_ago = timezone.now() - timedelta(minutes=10)
+        UserActivity.objects.create(user=self.stale, is_online=True, last_activity=long_ago)
+        UserActivity.objects.create(user=self.fresh, is_online=True)
+        UserActivity.objects.create(user=self.offline, is_online=False, last_activity=long_ago)
+
+    def tearDown(self):
+        for user in (self.stale, self.fresh, self.offline):
+            presence_tracker.forget(user.id)
+
+    def test_sweep_marks_only_expired_sessions_offline(self):
+        with CaptureQueriesContext(connection) as ctx:
+            swept = sweep_expired(ttl=60)
+        self.assertEqual(swept, [self.stale.id])
+        self.assertEqual(sum(q['sql'].startswith('UPDATE') for q in ctx.captured_queries), 1)
+        self.assertEqual(
+            set(UserActivity.objects.filter(is_online=True).values_list('user_id', flat=True)),
+            {self.fresh.id},
+        )
+
+    def test_command_sweeps_once(self):
+        call_command('sweep_presence', ttl=60, stdout=mock.MagicMock())
+        self.assertFalse(UserActivity.objects.get(user=self.stale).is_online)
+
+    async def test_ping_is_answered_with_pong(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = self.fresh
+        await communicator.connect()
+        established = await communicator.receive_json_from()
+        self.assertIn('heartbeat_interval', established)
+
+        await communicator.send_json_to({'type': 'ping'})
+        self.assertEqual(await communicator.receive_json_from(timeout=5), {'type': 'pong'})
+        await communicator.disconnect()
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.client.login(username='user1', password='testpass123')
+
+    def test_text_format(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'A counter.', ['kind'], registry=registry)
+        histogram = metrics.Histogram('test_seconds', 'A histogram.', registry=registry, buckets=(0.1, 1))
+        counter.inc(kind='a "b"')
+        histogram.observe(0.5)
+        self.assertEqual(registry.render(), (
+            '# HELP test_total A counter.\n'
+            '# TYPE test_total counter\n'
+            'test_total{kind="a \\"b\\""} 1.0\n'
+            '# HELP test_seconds A histogram.\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="0.1"} 0.0\n'
+            'test_seconds_bucket{le="1.0"} 1.0\n'
+            'test_seconds_bucket{le="+Inf"} 1.0\n'
+            'test_seconds_sum 0.5\n'
+            'test_seconds_count 1.0\n'
+        ))
+
+    def test_workers_are_combined(self):
+        import os
+        import tempfile
+        from pathlib import Path
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'A counter.', registry=registry)
+        gauge = metrics.Gauge('test_open', 'A gauge.', registry=registry)
+        histogram = metrics.Histogram('test_seconds', 'A histogram.', registry=registry, buckets=(1,))
+        counter.inc(2)
+        gauge.set(3)
+        histogram.observe(0.5)
+        with tempfile.TemporaryDirectory() as directory:
+            # Two other workers with the same values; worker 222 has exited
+            for pid in (111, 222):
+                Path(directory, f"{pid}.json").write_text(json.dumps(registry.snapshot()))
+            counter.inc()  # this worker's live value is used over its snapshot
+            registry.write_snapshot(directory)
+            with mock.patch('chat.metrics._process_alive', side_effect=lambda pid: pid == 111):
+                output = registry.render_combined(directory)
+        self.assertIn('test_total 7.0\n', output)
+        self.assertIn(f'test_open{{worker="{os.getpid()}"}} 3.0\n', output)
+        self.assertIn('test_open{worker="111"} 3.0\n', output)
+        self.assertNotIn('worker="222"', output)
+        self.assertIn('test_seconds_bucket{le="1.0"} 3.0\n', output)
+        self.assertIn('test_seconds_count 3.0\n', output)
+
+    def test_endpoint_is_restricted(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'chat_ws_connections', response.content)
+        self.assertIn(b'chat_db_executor_queue_depth', response.content)
+
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+    def test_message_list_queries_are_recorded(self):
+        before = metrics.http_db_queries.count(view='message-list')
+        self.client.get(reverse('message-list'), {'user_id': self.user2.id})
+        self.assertEqual(metrics.http_db_queries.count(view='message-list'), before + 1)
+
+    async def test_message_stages_are_timed(self):
+        received = metrics.messages_received.value()
+        saves = metrics.message_stage_seconds.count(stage='save')
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = self.user1
+        await communicator.connect()
+        await communicator.receive_json_from()  # connection_established
+        self.assertEqual(metrics.ws_connections.value(), 1)
+
+        await communicator.send_json_to({'message': 'Hello', 'recipient_id': self.user2.id})
+        await communicator.receive_json_from(timeout=5)
+        self.assertEqual(metrics.messages_received.value(), received + 1)
+        self.assertEqual(metrics.message_stage_seconds.count(stage='save'), saves + 1)
+        await communicator.disconnect()
+        self.assertEqual(metrics.ws_connections.value(), 0)
+
+
+class WorkerDrainTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+
+    def tearDown(self):
+        connection_registry.draining = False
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_drain_closes_connections_with_service_restart(self):
+        communicators = [await self.connect(self.user1), await self.connect(self.user2)]
+        for communicator in communicators:
+            await communicator.receive_json_from()  # connection_established
+        self.assertEqual(len(connection_registry), 2)
+
+        await connection_registry.drain(window=0, grace=0)
+        for communicator in communicators:
+            output = await communicator.receive_output(timeout=5)
+            while output['type'] != 'websocket.close':
+                output = await communicator.receive_output(timeout=5)
+            self.assertEqual(output['code'], 1012)
+            await communicator.disconnect()
+
+    async def test_draining_worker_turns_new_connections_away(self):
+        connection_registry.draining = True
+        communicator = await self.connect(self.user1)
+        output = await communicator.receive_output(timeout=5)
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 1012))
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        ChatMessage.objects.create(sender=self.user1, recipient=self.user2, content='Hello')
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user1, content='Hi')
+
+    def test_views_are_async(self):
+        from . import views
+        for view in (views.chat_view, views.UserListView.as_view(),
+                     views.ChatMessageListView.as_view(), views.ConversationListView.as_view()):
+            self.assertTrue(asyncio.iscoroutinefunction(view))
+
+    def test_anonymous_requests(self):
+        response = self.client.get(reverse('chat'))
+        self.assertRedirects(response, f"{reverse('login')}?next=/", fetch_redirect_response=False)
+        response = self.client.get(reverse('message-list'), {'user_id': self.user2.id})
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('detail', response.json())
+
+    def test_invalid_cursor_is_a_json_404(self):
+        self.client.login(username='user1', password='testpass123')
+        response = self.client.get(reverse('message-list'), {'user_id': self.user2.id, 'cursor': '!!'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'detail': 'Invalid cursor'})
+
+    def test_usernames_are_prefilled_into_the_cache(self):
+        self.client.login(username='user1', password='testpass123')
+        user_cache.clear()
+        response = self.client.get(reverse('message-list'), {'user_id': self.user2.id})
+        self.assertEqual([m['sender_username'] for m in response.json()], ['user1', 'user2'])
+        self.assertIsNotNone(get_cached_user(self.user2.id))
+
+
+class FakeConnection:
+    """Just enough of a DB-API connection for the pool."""
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+        self.fail_queries = False
+
+    def cursor(self):
+        connection = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql):
+                if connection.fail_queries:
+                    raise Exception('server closed the connection')
+        return Cursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.opened = []
+
+    def connect(self):
+        connection = FakeConnection()
+        self.opened.append(connection)
+        return connection
+
+    def pool(self, **options):
+        return ConnectionPool(self.connect, alias='test', **options)
+
+    def test_connections_are_reused(self):
+        pool = self.pool()
+        first = pool.getconn()
+        pool.putconn(first)
+        self.assertIs(pool.getconn(), first)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(first.rollbacks, 1)
+
+    def test_waits_for_a_free_connection(self):
+        pool = self.pool(max_size=1, timeout=5)
+        held = pool.getconn()
+        borrowed = []
+        waiter = threading.Thread(target=lambda: borrowed.append(pool.getconn()))
+        waiter.start()
+        deadline = time.monotonic() + 5
+        while pool.stats()['waiting'] == 0:
+            if time.monotonic() > deadline:
+                pool.putconn(held)
+                self.fail("getconn() never started waiting")
+            time.sleep(0.001)
+        pool.putconn(held)
+        waiter.join(5)
+        self.assertEqual(borrowed, [held])
+
+    def test_times_out_when_exhausted(self):
+        pool = self.pool(max_size=1, timeout=0.05)
+        pool.getconn()
+        before = metrics.db_pool_timeouts.value(alias='test')
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual(metrics.db_pool_timeouts.value(alias='test'), before + 1)
+        self.assertEqual(pool.stats()['in_use'], 1)
+
+    def test_failed_health_check_replaces_the_connection(self):
+        pool = self.pool(health_check_interval=0)
+        stale = pool.getconn()
+        pool.putconn(stale)
+        stale.fail_queries = True
+        fresh = pool.getconn()
+        self.assertIsNot(fresh, stale)
+        self.assertTrue(stale.closed)
+
+    def test_discarded_and_expired_connections_are_closed(self):
+        pool = self.pool(max_lifetime=0)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        self.assertTrue(connection.closed)
+        pool = self.pool()
+        connection = pool.getconn()
+        pool.putconn(connection, discard=True)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats(), {'size': 0, 'idle': 0, 'in_use': 0, 'waiting': 0})
+
+    def test_pool_metrics(self):
+        pool = self.pool()
+        metrics.db_pools['test'] = pool
+        self.addCleanup(metrics.db_pools.pop, 'test')
+        pool.putconn(pool.getconn())
+        pool.getconn()
+        output = metrics.render()
+        self.assertIn('chat_db_pool_connections{alias="test",state="in_use"} 1.0', output)
+        self.assertIn('chat_db_pool_connections{alias="test",state="idle"} 0.0', output)
+        self.assertIn('chat_db_pool_waiting{alias="test"} 0.0', output)
+
+
+class SessionAuthCacheTests(TestCase):
+    def setUp(self):
+        session_user_cache.clear()
+        self.user = User.objects.create_user(username='user1', password='testpass123')
+        self.client = Client()
+        self.client.login(username='user1', password='testpass123')
+        self.session_key = self.client.session.session_key
+
+    async def handshake(self, session_key):
+        users = []
+
+        async def app(scope, receive, send):
+            users.append(scope['user'])
+
+        scope = {'type': 'websocket', 'path': '/ws/chat/',
+                 'headers': [(b'cookie', f'sessionid={session_key}'.encode())]}
+        await CachedAuthMiddlewareStack(app)(scope, None, None)
+        return users[0]
+
+    async def test_repeat_handshakes_skip_the_database(self):
+        user = await self.handshake(self.session_key)
+        self.assertEqual(user.id, self.user.id)
+        with mock.patch('chat.middleware.get_user') as get_user:
+            again = await self.handshake(self.session_key)
+        get_user.assert_not_called()
+        self.assertEqual(again.id, self.user.id)
+        self.assertIsNot(again, user)
+
+    async def test_unknown_session_is_cached_as_anonymous(self):
+        self.assertFalse((await self.handshake('nosuchsession')).is_authenticated)
+        with mock.patch('chat.middleware.get_user') as get_user:
+            self.assertFalse((await self.handshake('nosuchsession')).is_authenticated)
+        get_user.assert_not_called()
+
+    def test_logout_invalidates_the_session(self):
+        async_to_sync(self.handshake)(self.session_key)
+        self.client.post(reverse('logout'))
+        self.assertIs(session_user_cache.get(self.session_key), MISSING)
+        self.assertFalse(async_to_sync(self.handshake)(self.session_key).is_authenticated)
+
+    def test_password_change_invalidates_the_users_sessions(self):
+        async_to_sync(self.handshake)(self.session_key)
+        self.user.set_password('newpass456')
+        self.user.save()
+        self.assertIs(session_user_cache.get(self.session_key), MISSING)
+        self.assertFalse(async_to_sync(self.handshake)(self.session_key).is_authenticated)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ConnectAdmissionTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.user = User.objects.create_user(username='user1', password='testpass123')
+
+    def tearDown(self):
+        connect_admission.configure(settings.CHAT_CONNECT_RATE, settings.CHAT_CONNECT_BURST)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2, clock=self.clock)
+        self.assertEqual((bucket.take(), bucket.take()), (0, 0))
+        self.assertAlmostEqual(bucket.take(), 0.1)
+        self.clock.now += 0.1
+        self.assertEqual(bucket.take(), 0)
+        self.clock.now += 10
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_rejected_clients_get_spread_out_retry_slots(self):
+        admission = ConnectionAdmission(rate=10, burst=1, max_retry_after=0.35, clock=self.clock)
+        self.assertEqual(admission.admit(), 0)
+        waits = [admission.admit() for _ in range(4)]
+        self.assertEqual([round(wait, 2) for wait in waits], [0.2, 0.3, 0.35, 0.35])
+
+    def test_disabled_admission_admits_everything(self):
+        admission = ConnectionAdmission(rate=None, burst=0, clock=self.clock)
+        self.assertEqual([admission.admit() for _ in range(100)], [0] * 100)
+
+    async def test_over_rate_connection_is_told_to_retry_later(self):
+        connect_admission.configure(1, 1)
+        connect_admission.bucket.take()
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        message = await communicator.receive_json_from()
+        self.assertEqual(message['type'], 'retry_after')
+        self.assertGreater(message['retry_after'], 0)
+        output = await communicator.receive_output(timeout=5)
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 1013))
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # connection_established
+        return communicator
+
+    async def send(self, communicator, content):
+        await communicator.send_json_to({'message': content, 'recipient_id': self.user2.id})
+        message = await communicator.receive_json_from(timeout=5)
+        while message.get('type') == 'presence':
+            message = await communicator.receive_json_from(timeout=5)
+        return message
+
+    async def test_memory_limiter_buckets_per_key(self):
+        limiter = MemoryRateLimiter(rate=1, burst=2, maxsize=2, clock=self.clock)
+        self.assertEqual([await limiter.take(1) for _ in range(3)], [0, 0, 1])
+        self.assertEqual(await limiter.take(2), 0)
+        await limiter.take(3)  # evicts key 1, which starts again full
+        self.assertEqual(await limiter.take(1), 0)
+
+    @override_settings(CHAT_MESSAGE_RATE=1, CHAT_MESSAGE_BURST=2)
+    async def test_connection_over_its_limit_gets_rejections(self):
+        throttled = metrics.messages_throttled.value(limit='connection')
+        with mock.patch('chat.consumers.user_message_limiter', None):
+            communicator = await self.connect(self.user1)
+            replies = [await self.send(communicator, f'message {n}') for n in range(3)]
+            await communicator.disconnect()
+        self.assertEqual([reply.get('content') for reply in replies[:2]], ['message 0', 'message 1'])
+        self.assertEqual(replies[2]['type'], 'rate_limited')
+        self.assertGreater(replies[2]['retry_after'], 0)
+        self.assertEqual(await database_sync_to_async(ChatMessage.objects.count)(), 2)
+        self.assertEqual(metrics.messages_throttled.value(limit='connection'), throttled + 1)
+
+    @override_settings(CHAT_MESSAGE_RATE=None)
+    async def test_user_limit_spans_connections(self):
+        throttled = metrics.messages_throttled.value(limit='user')
+        with mock.patch('chat.consumers.user_message_limiter', MemoryRateLimiter(rate=1, burst=1)):
+            first = await self.connect(self.user1)
+            second = await self.connect(self.user1)
+            self.assertEqual((await self.send(first, 'hello'))['content'], 'hello')
+            self.assertEqual((await self.send(second, 'again'))['type'], 'rate_limited')
+            await first.disconnect()
+            await second.disconnect()
+        self.assertEqual(metrics.messages_throttled.value(limit='user'), throttled + 1)
+
+    @override_settings(CHAT_MESSAGE_RATE=1, CHAT_MESSAGE_BURST=1, CHAT_MESSAGE_MAX_REJECTED=2)
+    async def test_connection_ignoring_its_limit_is_closed(self):
+        closed = metrics.ws_connections_throttled.value()
+        with mock.patch('chat.consumers.user_message_limiter', None):
+            communicator = await self.connect(self.user1)
+            await self.send(communicator, 'allowed')
+            for _ in range(2):
+                self.assertEqual((await self.send(communicator, 'flood'))['type'], 'rate_limited')
+            await communicator.send_json_to({'message': 'flood', 'recipient_id': self.user2.id})
+            output = await communicator.receive_output(timeout=5)
+            await communicator.disconnect()
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 1008))
+        self.assertEqual(metrics.ws_connections_throttled.value(), closed + 1)
+
+    @override_settings(CHAT_CONTROL_RATE=1, CHAT_CONTROL_BURST=2, CHAT_MESSAGE_MAX_REJECTED=3)
+    async def test_ping_flood_is_throttled_and_closed(self):
+        throttled = metrics.messages_throttled.value(limit='control')
+        communicator = await self.connect(self.user1)
+        with mock.patch.object(presence_tracker, 'touch') as touch:
+            for _ in range(2):
+                await communicator.send_json_to({'type': 'ping'})
+                self.assertEqual(await communicator.receive_json_from(timeout=5), {'type': 'pong'})
+            for _ in range(4):
+                await communicator.send_json_to({'type': 'ping'})
+            output = await communicator.receive_output(timeout=5)
+            await communicator.disconnect()
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 1008))
+        self.assertEqual(touch.call_count, 2)
+        self.assertEqual(metrics.messages_throttled.value(limit='control'), throttled + 4)
+
+    @override_settings(CHAT_CONTROL_RATE=None, CHAT_READ_RECEIPT_MAX_PENDING=2, CHAT_READ_RECEIPT_DELAY=0.05)
+    async def test_read_receipt_flood_is_bounded(self):
+        communicator = await self.connect(self.user1)
+        with mock.patch('chat.consumers.mark_read', return_value=0) as mark_read:
+            for sender_id in [self.user1.id, self.user2.id, 1000, 1001, 1002, self.user2.id]:
+                await communicator.send_json_to({'type': 'read', 'sender_id': sender_id, 'up_to': 5})
+            errors = [await communicator.receive_json_from(timeout=5) for _ in range(2)]
+            self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+            await communicator.disconnect()
+        self.assertEqual(errors, [{'error': 'Too many read receipts'}] * 2)
+        self.assertEqual(sorted(call.args[1] for call in mark_read.call_args_list), [self.user2.id, 1000])
+
+
+class OutboundBufferTests(TestCase):
+    def buffer(self, policy, size=3, batch_size=10):
+        return OutboundBuffer(mock.AsyncMock(), size=size, batch_size=batch_size, policy=policy)
+
+    def test_drop_oldest_reports_what_was_lost(self):
+        buffer = self.buffer('drop-oldest')
+        for n in range(5):
+            self.assertTrue(buffer.put(f'{{"n":{n}}}', key='ignored'))
+        frame = json.loads(buffer.take_frame())
+        self.assertEqual(frame, [{'n': 2}, {'n': 3}, {'n': 4}, {'type': 'messages_dropped', 'count': 2}])
+        self.assertIsNone(buffer.take_frame())
+
+    def test_coalesce_keeps_the_latest_per_key(self):
+        buffer = self.buffer('coalesce')
+        buffer.put('{"presence":1,"online":true}', key=('presence', 1))
+        buffer.put('{"message":1}')
+        buffer.put('{"presence":1,"online":false}', key=('presence', 1))
+        self.assertEqual(json.loads(buffer.take_frame()), [{'message': 1}, {'presence': 1, 'online': False}])
+
+    def test_disconnect_refuses_instead_of_dropping(self):
+        buffer = self.buffer('disconnect', size=2)
+        self.assertTrue(buffer.put('{"n":1}'))
+        self.assertTrue(buffer.put('{"n":2}'))
+        self.assertFalse(buffer.put('{"n":3}'))
+        self.assertEqual(json.loads(buffer.take_frame()), [{'n': 1}, {'n': 2}])
+
+    def test_batches_are_capped(self):
+        buffer = self.buffer('coalesce', size=10, batch_size=2)
+        for n in range(3):
+            buffer.put(f'{{"n":{n}}}')
+        self.assertEqual(json.loads(buffer.take_frame()), [{'n': 0}, {'n': 1}])
+        self.assertEqual(json.loads(buffer.take_frame()), {'n': 2})
+
+    async def test_writer_sends_pending_events(self):
+        buffer = self.buffer('coalesce')
+        buffer.start()
+        buffer.put('{"n":1}')
+        buffer.put('{"n":2}')
+        await asyncio.sleep(0.01)
+        buffer.close()
+        buffer.send.assert_awaited_once_with('[{"n":1},{"n":2}]')
+
+    async def test_writer_waits_for_acks_past_the_window(self):
+        buffer = OutboundBuffer(mock.AsyncMock(), batch_size=1, window=1, acking=True)
+        buffer.start()
+        buffer.put('{"n":1}')
+        buffer.put('{"n":2}')
+        await asyncio.sleep(0.01)
+        buffer.send.assert_awaited_once_with('{"n":1}')
+        self.assertEqual((buffer.unacked, len(buffer)), (1, 1))
+        buffer.acknowledge(1)
+        await asyncio.sleep(0.01)
+        buffer.close()
+        self.assertEqual(buffer.send.await_args_list, [mock.call('{"n":1}'), mock.call('{"n":2}')])
+
+    async def test_clients_that_never_ack_are_not_held_back(self):
+        buffer = OutboundBuffer(mock.AsyncMock(), batch_size=1, window=1)
+        buffer.start()
+        for n in range(3):
+            buffer.put(f'{{"n":{n}}}')
+            await asyncio.sleep(0.01)
+        buffer.close()
+        self.assertEqual(buffer.send.await_count, 3)
+        buffer.acknowledge(3)
+        self.assertTrue(buffer.acking)
+
+    async def test_a_client_that_stops_acking_is_handed_over(self):
+        on_stalled = mock.AsyncMock()
+        buffer = OutboundBuffer(mock.AsyncMock(), window=1, acking=True, ack_timeout=0.05, on_stalled=on_stalled)
+        buffer.start()
+        buffer.put('{"n":1}')
+        buffer.put('{"n":2}', key='later')
+        await asyncio.sleep(0.01)
+        buffer.put('{"n":3}')
+        await asyncio.sleep(0.1)
+        on_stalled.assert_awaited_once()
+        self.assertEqual(buffer.send.await_count, 1)
+        buffer.close()
+
+    async def test_acks_cannot_run_ahead_of_what_was_sent(self):
+        buffer = self.buffer('coalesce')
+        await buffer.send_now('{"n":1}')
+        buffer.acknowledge(5)
+        buffer.acknowledge(0)
+        self.assertEqual((buffer.acked, buffer.unacked), (1, 0))
+
+    async def connect(self, user, query=''):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{query}")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # connection_established
+        return communicator
+
+    async def push(self, user, sender, *contents):
+        for n in contents:
+            await get_channel_layer().group_send(f"user_{user.id}", {
+                "type": "chat_message", "sender_id": sender.id, "text": f'{{"content":"{n}"}}',
+            })
+
+    @override_settings(CHAT_OUTBOUND_POLICY='disconnect', CHAT_OUTBOUND_BUFFER=2,
+                       CHAT_OUTBOUND_BATCH=1, CHAT_OUTBOUND_WINDOW=2)
+    async def test_client_too_far_behind_is_told_to_resync(self):
+        user1 = await database_sync_to_async(User.objects.create_user)(username='user1', password='testpass123')
+        user2 = await database_sync_to_async(User.objects.create_user)(username='user2', password='testpass123')
+        closed = metrics.ws_connections_slow.value()
+        # The client opts in to acks, then never acknowledges anything
+        communicator = await self.connect(user1, '?acks=1')
+        await self.push(user1, user2, *range(4))
+        self.assertEqual(await communicator.receive_json_from(timeout=5), {'content': '0'})
+        self.assertEqual(await communicator.receive_json_from(timeout=5), {'type': 'resync', 'reason': 'slow_consumer'})
+        output = await communicator.receive_output(timeout=5)
+        await communicator.disconnect()
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 4008))
+        self.assertEqual(metrics.ws_connections_slow.value(), closed + 1)
+
+    @override_settings(CHAT_OUTBOUND_POLICY='disconnect', CHAT_OUTBOUND_BUFFER=2,
+                       CHAT_OUTBOUND_BATCH=1, CHAT_OUTBOUND_WINDOW=2)
+    async def test_acks_keep_the_client_connected(self):
+        user1 = await database_sync_to_async(User.objects.create_user)(username='user1', password='testpass123')
+        user2 = await database_sync_to_async(User.objects.create_user)(username='user2', password='testpass123')
+        communicator = await self.connect(user1, '?acks=1')
+        received = []
+        for n in range(4):
+            await self.push(user1, user2, n)
+            received.append(await communicator.receive_json_from(timeout=5))
+            await communicator.send_json_to({'type': 'ack', 'frames': n + 2})
+        self.assertEqual(received, [{'content': str(n)} for n in range(4)])
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+        await communicator.disconnect()
+
+    @override_settings(CHAT_OUTBOUND_BATCH=1, CHAT_OUTBOUND_WINDOW=2)
+    async def test_clients_that_never_ack_still_get_everything(self):
+        user1 = await database_sync_to_async(User.objects.create_user)(username='user1', password='testpass123')
+        user2 = await database_sync_to_async(User.objects.create_user)(username='user2', password='testpass123')
+        communicator = await self.connect(user1)
+        await self.push(user1, user2, *range(5))
+        received = [await communicator.receive_json_from(timeout=5) for _ in range(5)]
+        self.assertEqual(received, [{'content': str(n)} for n in range(5)])
+        await communicator.disconnect()
+
+    @override_settings(CHAT_OUTBOUND_BATCH=1, CHAT_OUTBOUND_WINDOW=2, CHAT_OUTBOUND_ACK_TIMEOUT=0.1)
+    async def test_client_that_stops_acking_is_told_to_resync(self):
+        user1 = await database_sync_to_async(User.objects.create_user)(username='user1', password='testpass123')
+        user2 = await database_sync_to_async(User.objects.create_user)(username='user2', password='testpass123')
+        closed = metrics.ws_connections_slow.value()
+        communicator = await self.connect(user1)
+        await communicator.send_json_to({'type': 'ack', 'frames': 1})
+        await asyncio.sleep(0.05)
+        # Under the default coalesce policy: resynced, not silently dropped
+        await self.push(user1, user2, *range(4))
+        received = [await communicator.receive_json_from(timeout=5) for _ in range(2)]
+        self.assertEqual(received, [{'content': '0'}, {'content': '1'}])
+        self.assertEqual(await communicator.receive_json_from(timeout=5), {'type': 'resync', 'reason': 'slow_consumer'})
+        output = await communicator.receive_output(timeout=5)
+        await communicator.disconnect()
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 4008))
+        self.assertEqual(metrics.ws_connections_slow.value(), closed + 1)
+
+
+class MessageReplayTests(TestCase):
+    def setUp(self):
+        message_log.clear()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+
+    async def connect(self, user, query=''):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{query}")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        established = await communicator.receive_json_from()
+        return communicator, established
+
+    async def receive_message(self, communicator):
+        message = await communicator.receive_json_from(timeout=5)
+        while 'content' not in message:
+            message = await communicator.receive_json_from(timeout=5)
+        return message
+
+    async def test_log_sequences_and_gaps(self):
+        log = MemoryMessageLog(size=2)
+        self.assertEqual(await log.append([1, 2], '{"id":1}'), {1: 1, 2: 1})
+        await log.append([1], '{"id":2}')
+        await log.append([1], '{"id":3}')
+        self.assertEqual(await log.since(1, 1), (3, ['{"seq":2,"id":2}', '{"seq":3,"id":3}']))
+        self.assertEqual(await log.since(1, 3), (3, []))
+        self.assertEqual(await log.since(1, 0), (3, None))  # seq 1 fell out of the log
+        self.assertEqual(await log.since(2, 5), (1, None))  # ahead of the log: it was reset
+
+    async def test_messages_carry_per_user_sequences(self):
+        sender, established = await self.connect(self.user1)
+        self.assertEqual((established['seq'], established['resumed']), (0, False))
+        recipient, _ = await self.connect(self.user2)
+        for content in ('one', 'two'):
+            await sender.send_json_to({'message': content, 'recipient_id': self.user2.id})
+        self.assertEqual([(await self.receive_message(sender))['seq'] for _ in range(2)], [1, 2])
+        self.assertEqual([(await self.receive_message(recipient))['seq'] for _ in range(2)], [1, 2])
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    async def test_reconnect_replays_only_the_gap(self):
+        sender, _ = await self.connect(self.user1)
+        for content in ('seen', 'missed 1', 'missed 2'):
+            await sender.send_json_to({'message': content, 'recipient_id': self.user2.id})
+            await self.receive_message(sender)
+
+        recipient, established = await self.connect(self.user2, '?last_seq=1')
+        self.assertEqual((established['seq'], established['resumed']), (3, True))
+        replayed = [await recipient.receive_json_from(timeout=5) for _ in range(2)]
+        self.assertEqual([(m['seq'], m['content']) for m in replayed], [(2, 'missed 1'), (3, 'missed 2')])
+        self.assertTrue(await recipient.receive_nothing(timeout=0.2))
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    async def test_falls_back_to_the_database_past_the_log(self):
+        first = await database_sync_to_async(ChatMessage.objects.create)(
+            sender=self.user1, recipient=self.user2, content='before')
+        await database_sync_to_async(ChatMessage.objects.create)(
+            sender=self.user1, recipient=self.user2, content='after')
+        recipient, established = await self.connect(self.user2, f'?last_seq=7&last_id={first.id}')
+        self.assertTrue(established['resumed'])
+        replayed = await recipient.receive_json_from(timeout=5)
+        self.assertEqual((replayed['content'], replayed['sender']), ('after', 'user1'))
+        await recipient.disconnect()
+
+        recipient, established = await self.connect(self.user2, '?last_seq=7')
+        self.assertFalse(established['resumed'])
+        self.assertTrue(await recipient.receive_nothing(timeout=0.2))
+        await recipient.disconnect()
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.user3 = User.objects.create_user(username='user3', password='testpass123')
+        ChatMessage.objects.create(sender=self.user1, recipient=self.user2, content='Lunch at the <b>noodle</b> place?')
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user1, content='Noodles sound great')
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user3, content='No noodles for me')
+        self.client.login(username='user1', password='testpass123')
+
+    def search(self, **params):
+        response = self.client.get(reverse('message-search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_matches_only_the_users_conversations_with_snippets(self):
+        results = self.search(q='noodle').json()
+        self.assertEqual([r['content'] for r in results], ['Noodles sound great', 'Lunch at the <b>noodle</b> place?'])
+        self.assertIn('<mark>Noodles</mark>', results[0]['snippet'])
+        self.assertIn('&lt;b&gt;<mark>noodle</mark>&lt;/b&gt;', results[1]['snippet'])
+
+    def test_prefix_and_conversation_filter(self):
+        self.assertEqual(len(self.search(q='lun').json()), 1)
+        self.assertEqual(len(self.search(q='noodle', user_id=self.user3.id).json()), 0)
+
+    def test_fts_syntax_is_not_interpreted(self):
+        self.assertEqual(len(self.search(q='noodle" (').json()), 2)
+        self.assertEqual(self.search(q='***').json(), [])
+
+    def test_paginates_with_a_cursor(self):
+        response = self.search(q='noodle', page_size=1)
+        cursor = response['X-Next-Cursor']
+        older = self.search(q='noodle', page_size=1, cursor=cursor).json()
+        self.assertEqual(older[0]['content'], 'Lunch at the <b>noodle</b> place?')
+
+    def test_index_follows_edits_and_deletes(self):
+        message = ChatMessage.objects.get(content='Noodles sound great')
+        message.content = 'Pizza sounds great'
+        message.save()
+        self.assertEqual(len(self.search(q='pizza').json()), 1)
+        message.delete()
+        self.assertEqual(self.search(q='pizza').json(), [])
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        now = timezone.now()
+        for days_ago in (200, 150, 100, 1, 0):
+            message = ChatMessage.objects.create(sender=self.user1, recipient=self.user2, content=f'{days_ago} days ago')
+            ChatMessage.objects.filter(id=message.id).update(timestamp=now - timedelta(days=days_ago))
+
+    def test_moves_old_messages_in_batches(self):
+        cutoff = archive_cutoff(90)
+        self.assertEqual(archive_batch(cutoff, batch_size=2), 2)
+        self.assertEqual(archive_batch(cutoff, batch_size=2), 1)
+        self.assertEqual(archive_batch(cutoff, batch_size=2), 0)
+        self.assertEqual(sorted(ArchivedChatMessage.objects.values_list('content', flat=True)),
+                         ['100 days ago', '150 days ago', '200 days ago'])
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        self.assertEqual(unread_count(self.user2.id), 2)
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.unread_for(self.user2.id), 2)
+
+    def test_command(self):
+        call_command('archive_messages', days=90, batch_size=2, sleep=0, stdout=mock.MagicMock())
+        self.assertEqual(ArchivedChatMessage.objects.count(), 3)
+
+    def test_history_pages_continue_into_the_archive(self):
+        archive_batch(archive_cutoff(90))
+        self.client.login(username='user1', password='testpass123')
+        url = reverse('message-list')
+        contents, cursor = [], None
+        while True:
+            params = {'user_id': self.user2.id, 'page_size': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get(url, params)
+            contents = [m['content'] for m in response.json()] + contents
+            cursor = response.get('X-Next-Cursor')
+            if not cursor:
+                break
+        self.assertEqual(contents, ['200 days ago', '150 days ago', '100 days ago', '1 days ago', '0 days ago'])
+
+
+@override_settings(CHAT_RETENTION_DAYS=120)
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.user3 = User.objects.create_user(username='user3', password='testpass123')
+        self.now = timezone.now()
+        for other in (self.user2, self.user3):
+            for days_ago in (200, 150, 100, 1):
+                message = ChatMessage.objects.create(sender=self.user1, recipient=other, content=f'{days_ago} days ago')
+                ChatMessage.objects.filter(id=message.id).update(timestamp=self.now - timedelta(days=days_ago))
+        # 200 days ago goes to the archive, the rest stay live
+        archive_batch(self.now - timedelta(days=175))
+
+    def remaining(self, other):
+        return sorted(
+            content
+            for model in (ChatMessage, ArchivedChatMessage)
+            for content in model.objects.filter(recipient=other).values_list('content', flat=True)
+        )
+
+    def purge(self, batch_size=1000):
+        for _, queryset, _ in purge_targets(self.now):
+            after = None
+            while True:
+                deleted, after = purge_batch(queryset, after, batch_size)
+                if not deleted:
+                    break
+
+    def test_default_retention_purges_live_and_archived(self):
+        self.purge(batch_size=1)
+        for other in (self.user2, self.user3):
+            self.assertEqual(self.remaining(other), ['1 days ago', '100 days ago'])
+        self.assertEqual(ArchivedChatMessage.objects.count(), 0)
+        self.assertEqual(unread_count(self.user2.id), 2)
+        self.assertEqual(Conversation.objects.get(user_high=self.user2).unread_for(self.user2.id), 2)
+
+    def test_conversation_override(self):
+        Conversation.objects.filter(user_high=self.user2).update(retention_days=30)
+        Conversation.objects.filter(user_high=self.user3).update(retention_days=365)
+        self.purge()
+        self.assertEqual(self.remaining(self.user2), ['1 days ago'])
+        self.assertEqual(self.remaining(self.user3), ['1 days ago', '100 days ago', '150 days ago', '200 days ago'])
+
+    @override_settings(CHAT_RETENTION_DAYS=None)
+    def test_keeps_everything_without_a_policy(self):
+        self.assertEqual(purge_targets(self.now), [])
+        Conversation.objects.filter(user_high=self.user2).update(retention_days=120)
+        self.purge()
+        self.assertEqual(self.remaining(self.user2), ['1 days ago', '100 days ago'])
+        self.assertEqual(len(self.remaining(self.user3)), 4)
+
+    def test_command(self):
+        call_command('purge_messages', dry_run=True, stdout=mock.MagicMock())
+        self.assertEqual(ChatMessage.objects.count() + ArchivedChatMessage.objects.count(), 8)
+        call_command('purge_messages', batch_size=1, sleep=0, stdout=mock.MagicMock())
+        self.assertEqual(ChatMessage.objects.count(), 4)
+        self.assertEqual(ArchivedChatMessage.objects.count(), 0)
+
+
+class MessageExportTests(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='testpass123')
+        self.user2 = User.objects.create_user(username='user2', password='testpass123')
+        self.user3 = User.objects.create_user(username='user3', password='testpass123')
+        old = ChatMessage.objects.create(sender=self.user1, recipient=self.user2, content='archived, "quoted"')
+        ChatMessage.objects.filter(id=old.id).update(timestamp=timezone.now() - timedelta(days=365))
+        archive_batch(archive_cutoff(90))
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user1, content='recent')
+        ChatMessage.objects.create(sender=self.user3, recipient=self.user1, content='other chat')
+        ChatMessage.objects.create(sender=self.user2, recipient=self.user3, content='not mine')
+        self.async_client.login(username='user1', password='testpass123')
+
+    async def export(self, **params):
+        response = await self.async_client.get(reverse('message-export'), params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_ndjson_includes_the_archive_in_order(self):
+        response, body = await self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([row['content'] for row in rows], ['archived, "quoted"', 'recent', 'other chat'])
+        self.assertEqual((rows[1]['sender'], rows[1]['recipient']), ('user2', 'user1'))
+
+    async def test_gzipped_csv_for_one_conversation(self):
+        import csv, gzip, io
+        response, body = await self.export(format='csv', gzip='1', user_id=self.user2.id)
+        self.assertIn('messages.csv.gz', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(body).decode())))
+        self.assertEqual([row['content'] for row in rows], ['archived, "quoted"', 'recent'])
+
+    async def test_csv_neutralises_formulas(self):
+        import csv, io
+        await database_sync_to_async(ChatMessage.objects.create)(
+            sender=self.user2, recipient=self.user1, content='=HYPERLINK("http://evil.example","x")')
+        await database_sync_to_async(ChatMessage.objects.create)(
+            sender=self.user2, recipient=self.user1, content='-1+2')
+        _, body = await self.export(format='csv')
+        contents = [row['content'] for row in csv.DictReader(io.StringIO(body.decode()))]
+        self.assertEqual(contents[-2:], ['\'=HYPERLINK("http://evil.example","x")', "'-1+2"])
+        self.assertIn('archived, "quoted"', contents)
+
+    async def test_rejects_unknown_formats(self):
+        response = await self.async_client.get(reverse('message-export'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command_writes_in_chunks(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile(suffix='.ndjson') as output:
+            call_command('export_messages', 'user1', output=output.name, chunk_size=1)
+            lines = open(output.name).read().splitlines()
+        self.assertEqual(len(lines), 3)
@@ -9,4 +9,8 @@ urlpatterns = [
     path('logout/', LogoutView.as_view(next_page='login'), name='logout'),
     path('api/users/', views.UserListView.as_view(), name='user-list'),
     path('api/messages/', views.ChatMessageListView.as_view(), name='message-list'),
+    path('api/messages/search/', views.MessageSearchView.as_view(), name='message-search'),
+    path('api/messages/export/', views.export_view, name='message-export'),
+    path('api/conversations/', views.ConversationListView.as_view(), name='conversation-list'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,41 +1,62 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
-from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.models import User
-from rest_framework import generics
-from rest_framework.permissions import IsAuthenticated
-from .models import ChatMessage, UserActivity
-from .serializers import UserSerializer, ChatMessageSerializer
-from django.db import models
+from django.contrib.auth.views import redirect_to_login
+from django.views import View
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from .models import ArchivedChatMessage, ChatMessage
+from .serializers import UserSerializer, ChatMessageSerializer, ConversationSerializer, MessageSearchSerializer
+from .presence import presence_tracker, activity_of
+from .pagination import (
+    MessageKeysetPagination, ConversationKeysetPagination, UsernameKeysetPagination, MessageSearchPagination,
+)
+from .conversations import conversations_for
+from .search import search_messages, sqlite_snippets
+from .export import ExportWriter, FORMATS, aexport_messages
+from .cache import cache_user, user_cache, MISSING
+from .encoding import dumps
+from . import metrics
+from django.conf import settings
+from django.db import connection, models
 from django.utils import timezone
 
-@login_required
-def chat_view(request):
-    # Update current user's activity
-    activity, _ = UserActivity.objects.get_or_create(user=request.user)
-    activity.update_activity()
-
-    # Get all users except current user with their activity status
-    users = User.objects.exclude(id=request.user.id).select_related('useractivity')
-    
-    # Create a list of user data including activity status
-    user_data = []
-    for user in users:
-        try:
-            is_active = user.useractivity.is_active_now
-            last_seen = user.useractivity.last_activity
-        except UserActivity.DoesNotExist:
-            is_active = False
-            last_seen = None
-        
-        user_data.append({
-            'user': user,
+async def is_authenticated(request):
+    # AuthenticationMiddleware caches the user once resolved (usually by
+    # UserActivityMiddleware); otherwise loading it from the session is sync-only
+    if hasattr(request, '_cached_user'):
+        return request._cached_user.is_authenticated
+    return await sync_to_async(lambda: request.user.is_authenticated)()
+
+async def chat_view(request):
+    if not await is_authenticated(request):
+        return redirect_to_login(request.get_full_path())
+    # Current user's activity is recorded by UserActivityMiddleware.
+    # Other users are found through the paginated /api/users/ search.
+
+    # Recent conversations come from the summary table in one indexed query
+    conversations = conversations_for(request.user.id).filter(
+        last_timestamp__isnull=False
+    ).select_related('user_low__useractivity', 'user_high__useractivity')[:20]
+
+    conversation_data = []
+    async for conversation in conversations:
+        other = conversation.other_user(request.user.id)
+        is_active, last_seen = presence_tracker.status(other.id, activity_of(other))
+        conversation_data.append({
+            'user': other,
             'is_active': is_active,
-            'last_seen': last_seen
+            'last_seen': last_seen,
+            'snippet': conversation.last_snippet,
+            'sent_by_me': conversation.last_sender_id == request.user.id,
+            'last_timestamp': conversation.last_timestamp,
+            'unread': conversation.unread_for(request.user.id),
         })
 
-    return render(request, 'chat/chat.html', {'users': user_data})
+    return render(request, 'chat/chat.html', {'conversations': conversation_data})
 
 def login_view(request):
     if request.user.is_authenticated:
@@ -49,8 +70,7 @@ def login_view(request):
             if user is not None:
                 login(request, user)
                 # Set user as online
-                activity, _ = UserActivity.objects.get_or_create(user=user)
-                activity.update_activity()
+                presence_tracker.touch(user.id)
                 return redirect('chat')
     else:
         form = AuthenticationForm()
@@ -59,12 +79,7 @@ def login_view(request):
 def logout_view(request):
     if request.user.is_authenticated:
         # Set user as offline
-        try:
-            activity = UserActivity.objects.get(user=request.user)
-            activity.is_online = False
-            activity.save()
-        except UserActivity.DoesNotExist:
-            pass
+        presence_tracker.touch(request.user.id, is_online=False)
     logout(request)
     return redirect('login')
 
@@ -77,27 +92,158 @@ def register(request):
             user = form.save()
             login(request, user)
             # Create activity record for new user
-            UserActivity.objects.create(user=user, is_online=True)
+            presence_tracker.touch(user.id)
             return redirect('chat')
     else:
         form = UserCreationForm()
     return render(request, 'chat/register.html', {'form': form})
 
-class UserListView(generics.ListAPIView):
+def username_search(query):
+    # Prefix match uses the username index; trigram matching needs pg_trgm
+    condition = models.Q(username__istartswith=query)
+    if getattr(settings, 'CHAT_USER_TRIGRAM_SEARCH', False) and connection.vendor == 'postgresql':
+        condition |= models.Q(username__trigram_similar=query)
+    return condition
+
+async def prefetch_usernames(messages):
+    # Usernames come from the user cache; fill any gaps in one query
+    missing = {user_id for message in messages for user_id in (message.sender_id, message.recipient_id)
+               if user_cache.get(user_id) is MISSING}
+    if missing:
+        async for user in User.objects.filter(id__in=missing).only('id', 'username'):
+            cache_user(user)
+
+class AsyncListView(View):
+    """
+    Async counterpart of a DRF ListAPIView for session-authenticated JSON
+    lists: same serializers, keyset paginators and X-Next-Cursor header,
+    but the page is fetched with the async ORM so an ASGI worker serves
+    it without parking a thread per request.
+    """
+    serializer_class = None
+    pagination_class = None
+    metrics_name = None
+
+    async def get(self, request, *args, **kwargs):
+        if self.metrics_name is None:
+            return await self.list(request)
+        with metrics.track_queries(self.metrics_name):
+            return await self.list(request)
+
+    async def list(self, request):
+        if not await is_authenticated(request):
+            return self.error_response('Authentication credentials were not provided.', 403)
+        self.request = request
+        paginator = self.pagination_class()
+        try:
+            # The DRF Request only parses query_params for the paginator
+            page = await paginator.apaginate_queryset(self.get_queryset(), Request(request), view=self)
+        except APIException as e:
+            return self.error_response(e.detail, e.status_code)
+        await self.prefetch(page)
+
+        data = self.serializer_class(page, many=True, context={'request': request}).data
+        response = HttpResponse(dumps(data), content_type='application/json')
+        if paginator.next_cursor:
+            response[paginator.cursor_header] = paginator.next_cursor
+        return response
+
+    async def prefetch(self, page):
+        """Load anything the serializer would otherwise query lazily."""
+
+    def error_response(self, detail, status):
+        return HttpResponse(dumps({'detail': str(detail)}), content_type='application/json', status=status)
+
+class UserListView(AsyncListView):
     serializer_class = UserSerializer
-    permission_classes = [IsAuthenticated]
+    pagination_class = UsernameKeysetPagination
 
     def get_queryset(self):
-        return User.objects.exclude(id=self.request.user.id).select_related('useractivity')
+        queryset = User.objects.exclude(id=self.request.user.id).select_related('useractivity')
+        query = self.request.GET.get('q', '').strip()
+        if query:
+            queryset = queryset.filter(username_search(query))
+        return queryset
 
-class ChatMessageListView(generics.ListAPIView):
+class ChatMessageListView(AsyncListView):
     serializer_class = ChatMessageSerializer
-    permission_classes = [IsAuthenticated]
+    pagination_class = MessageKeysetPagination
+    metrics_name = 'message-list'
 
     def get_queryset(self):
-        other_user_id = self.request.query_params.get('user_id')
-        if other_user_id:
-            return ChatMessage.objects.filter(
-                (models.Q(sender=self.request.user, recipient_id=other_user_id) |
-                 models.Q(sender_id=other_user_id, recipient=self.request.user))
-            ).order_by('timestamp')
\ No newline at end of file
+        # The tsvector is only for search to match on; don't load it per message
+        return self.conversation(ChatMessage.objects.defer('search_vector'))
+
+    def get_archive_queryset(self):
+        # Older pages continue into the archive (see MessageKeysetPagination)
+        return self.conversation(ArchivedChatMessage.objects.all())
+
+    def conversation(self, queryset):
+        other_user_id = self.request.GET.get('user_id')
+        if not other_user_id:
+            return queryset.none()
+        return queryset.filter(
+            (models.Q(sender=self.request.user, recipient_id=other_user_id) |
+             models.Q(sender_id=other_user_id, recipient=self.request.user))
+        )
+
+    async def prefetch(self, page):
+        await prefetch_usernames(page)
+
+class MessageSearchView(AsyncListView):
+    serializer_class = MessageSearchSerializer
+    pagination_class = MessageSearchPagination
+    metrics_name = 'message-search'
+
+    def get_queryset(self):
+        query = self.request.GET.get('q', '').strip()
+        other_user_id = self.request.GET.get('user_id')
+        if not query or (other_user_id and not other_user_id.isdigit()):
+            return ChatMessage.objects.none()
+        return search_messages(self.request.user.id, query, int(other_user_id) if other_user_id else None)
+
+    async def prefetch(self, page):
+        await prefetch_usernames(page)
+        if page and connection.vendor == 'sqlite':
+            query = self.request.GET.get('q', '').strip()
+            snippets = await sync_to_async(sqlite_snippets)([message.id for message in page], query)
+            for message in page:
+                message.snippet = snippets.get(message.id)
+
+class ConversationListView(AsyncListView):
+    serializer_class = ConversationSerializer
+    pagination_class = ConversationKeysetPagination
+
+    def get_queryset(self):
+        return conversations_for(self.request.user.id).filter(
+            last_timestamp__isnull=False
+        ).select_related('user_low__useractivity', 'user_high__useractivity')
+
+async def export_view(request):
+    """
+    Stream the user's whole message history (or one conversation with
+    ?user_id=) as ?format=ndjson|csv, gzipped with ?gzip=1.
+    """
+    if not await is_authenticated(request):
+        return HttpResponse(dumps({'detail': 'Authentication credentials were not provided.'}),
+                            content_type='application/json', status=403)
+    export_format = request.GET.get('format', 'ndjson')
+    other_user_id = request.GET.get('user_id')
+    if export_format not in FORMATS or (other_user_id and not other_user_id.isdigit()):
+        return HttpResponse(dumps({'detail': 'Invalid export parameters'}),
+                            content_type='application/json', status=400)
+
+    writer = ExportWriter(export_format, compress=request.GET.get('gzip') == '1')
+    response = StreamingHttpResponse(
+        aexport_messages(writer, request.user.id, int(other_user_id) if other_user_id else None),
+        content_type=writer.content_type,
+    )
+    response['Content-Disposition'] = f'attachment; filename="messages.{writer.extension}"'
+    return response
+
+def metrics_view(request):
+    # Scraped from inside the network; staff can look too
+    allowed_ips = getattr(settings, 'CHAT_METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in allowed_ips):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
\ No newline at end of file
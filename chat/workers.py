@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import math
+import time
+import weakref
+
+from django.conf import settings
+
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# RFC 6455 "Service Restart": the client should reconnect, to another worker
+CLOSE_SERVICE_RESTART = 1012
+# RFC 6455 "Try Again Later": the worker is overloaded, retry after a delay
+CLOSE_TRY_AGAIN_LATER = 1013
+# RFC 6455 "Policy Violation": the client kept sending over its rate limit
+CLOSE_POLICY_VIOLATION = 1008
+# Application code: the client fell too far behind and should resync
+CLOSE_SLOW_CONSUMER = 4008
+
+
+class ConnectionRegistry:
+    """
+    The WebSocket consumers open in this worker process, so a shutting-down
+    worker can hand its clients over to the others gradually.
+    """
+
+    # Closes are spread over this many evenly spaced batches
+    drain_batches = 20
+
+    def __init__(self):
+        self._consumers = weakref.WeakSet()
+        self.draining = False
+
+    def add(self, consumer):
+        self._consumers.add(consumer)
+
+    def discard(self, consumer):
+        self._consumers.discard(consumer)
+
+    def __len__(self):
+        return len(self._consumers)
+
+    async def drain(self, window, grace=5):
+        """
+        Close every connection with 1012 over ``window`` seconds, then wait up
+        to ``grace`` seconds for their disconnect handlers to finish.
+        """
+        self.draining = True
+        consumers = list(self._consumers)
+        logger.info("Draining %d WebSocket connections over %ss", len(consumers), window)
+        if consumers:
+            batches = min(self.drain_batches, len(consumers))
+            size = math.ceil(len(consumers) / batches)
+            for start in range(0, len(consumers), size):
+                await asyncio.gather(
+                    *(consumer.close(code=CLOSE_SERVICE_RESTART) for consumer in consumers[start:start + size]),
+                    return_exceptions=True,
+                )
+                if start + size < len(consumers):
+                    await asyncio.sleep(window / batches)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + grace
+        while self._consumers and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._consumers:
+            logger.warning("%d connections still open after drain", len(self._consumers))
+
+
+connection_registry = ConnectionRegistry()
+
+
+class ConnectionAdmission:
+    """
+    Caps the rate at which this worker accepts WebSocket connections, so a
+    reconnect storm is spread out instead of landing on connect() at once.
+
+    A rejected client is told how long to wait. Successive rejections get
+    successive slots at the refill rate, so their retries come back at
+    about the rate the worker admits them rather than all together.
+    """
+
+    def __init__(self, rate, burst, max_retry_after=30, clock=time.monotonic):
+        self.clock = clock
+        self.max_retry_after = max_retry_after
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst, clock=self.clock) if rate else None
+        self._next_slot = 0
+
+    def admit(self):
+        """Return 0 to accept a connection, else the seconds the client should wait."""
+        if self.bucket is None:
+            return 0
+        wait = self.bucket.take()
+        if not wait:
+            return 0
+        now = self.clock()
+        self._next_slot = max(self._next_slot, now + wait) + 1 / self.bucket.rate
+        return min(self._next_slot - now, self.max_retry_after)
+
+
+connect_admission = ConnectionAdmission(
+    rate=getattr(settings, 'CHAT_CONNECT_RATE', 100),
+    burst=getattr(settings, 'CHAT_CONNECT_BURST', 200),
+    max_retry_after=getattr(settings, 'CHAT_CONNECT_MAX_RETRY_AFTER', 30),
+)
@@ -2,18 +2,18 @@ import os
 import django
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
 # Proper Django setup before imports
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings_prod')
 django.setup()
 
 # Import after Django setup
+from chat.middleware import CachedAuthMiddlewareStack
 from chat.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
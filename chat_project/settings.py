@@ -151,10 +151,119 @@ LOGGING = {
         'chat': {
             'handlers': ['console'],
             'level': 'DEBUG',
+            'propagate': False,
         },
     },
 }
 
 # Update WebSocket settings
 WEBSOCKET_HOST = '0.0.0.0'  # Listen on all available interfaces
-WEBSOCKET_PORT = 8001
\ No newline at end of file
+WEBSOCKET_PORT = 8001
+
+# Presence: last-activity timestamps are buffered in memory and written back
+# in batches by each worker. Seconds between flushes / between touches per user.
+CHAT_PRESENCE_FLUSH_INTERVAL = 30
+CHAT_PRESENCE_THROTTLE = 60
+
+# Message persistence: incoming WebSocket messages are inserted in batches.
+# CHAT_MESSAGE_DURABILITY is "commit" (ack after the batch commits) or
+# "deliver" (fan out first under a temporary id, then follow up with a
+# "persisted" event carrying the real id once the batch commits).
+CHAT_MESSAGE_BATCH_SIZE = 100
+CHAT_MESSAGE_BATCH_WINDOW = 0.01
+CHAT_MESSAGE_DURABILITY = 'commit'
+
+# Cached (id, username) lookups for recipients and serializers
+CHAT_USER_CACHE_SIZE = 10000
+CHAT_USER_CACHE_TTL = 300
+
+# Seconds to coalesce read receipts before the batched is_read UPDATE, and
+# how many conversations one connection may have waiting for it
+CHAT_READ_RECEIPT_DELAY = 0.5
+CHAT_READ_RECEIPT_MAX_PENDING = 20
+
+# Presence broadcasting: seconds to wait after a user's last connection
+# closes before announcing them offline, and how many recent contacts each
+# connection subscribes to. Open connections are counted in this process,
+# or across all workers when CHAT_PRESENCE_REDIS_URL is set.
+CHAT_PRESENCE_DEBOUNCE = 5
+CHAT_PRESENCE_MAX_CONTACTS = 200
+CHAT_PRESENCE_REDIS_URL = None
+
+# Seconds between client heartbeats on /ws/chat/
+CHAT_HEARTBEAT_INTERVAL = 25
+
+# Users online but silent for this many seconds are swept offline. Must
+# exceed the heartbeat interval plus the presence throttle and flush delay
+CHAT_PRESENCE_TTL = 180
+
+# Addresses allowed to scrape /metrics (staff users always can)
+CHAT_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# Directory where each worker process writes its metrics, so /metrics on
+# any worker reports all of them (gauges per worker). daphne_server.py sets
+# it for its workers; unset, /metrics reports the answering process only
+CHAT_METRICS_DIR = os.getenv('CHAT_METRICS_DIR')
+
+# Sessions are read through the cache, falling back to the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Users resolved during WebSocket handshakes, cached per process by session
+# key. Logout invalidates the entry in the logging-out process at once and
+# everywhere else within the TTL (seconds).
+CHAT_SESSION_CACHE_SIZE = 10000
+CHAT_SESSION_CACHE_TTL = 30
+
+# WebSocket connect admission per worker: connections/sec, burst size, and
+# the longest retry_after (seconds) a rejected client is told to wait.
+# CHAT_CONNECT_RATE = None turns admission control off.
+CHAT_CONNECT_RATE = 100
+CHAT_CONNECT_BURST = 200
+CHAT_CONNECT_MAX_RETRY_AFTER = 30
+
+# Chat messages a client may send, per connection and per user across all
+# their connections: messages/sec and burst size, None turning a limit off.
+# With CHAT_RATELIMIT_REDIS_URL the per-user limit is shared by all workers.
+# A connection that carries on through CHAT_MESSAGE_MAX_REJECTED rejected
+# messages in a row is closed.
+CHAT_MESSAGE_RATE = 5
+CHAT_MESSAGE_BURST = 20
+CHAT_USER_MESSAGE_RATE = 10
+CHAT_USER_MESSAGE_BURST = 40
+CHAT_MESSAGE_MAX_REJECTED = 50
+CHAT_RATELIMIT_REDIS_URL = None
+# Heartbeats and read receipts a connection may send (frames/sec, burst);
+# over it they are ignored and count as rejected toward the limit above
+CHAT_CONTROL_RATE = 5
+CHAT_CONTROL_BURST = 30
+
+# Missed-message replay: each user's recent messages are kept in a log of
+# this many entries, in memory (single process) or in Redis when
+# CHAT_REPLAY_REDIS_URL is set. Larger gaps are loaded from the database
+# up to CHAT_REPLAY_DB_LIMIT messages; beyond that the client resyncs.
+CHAT_REPLAY_BUFFER = 200
+CHAT_REPLAY_DB_LIMIT = 500
+CHAT_REPLAY_REDIS_URL = None
+CHAT_REPLAY_TTL = 86400
+
+# Messages older than this many days are moved to ArchivedChatMessage by
+# the archive_messages command; history pages read across both tables
+CHAT_ARCHIVE_AFTER_DAYS = 90
+
+# Messages older than this many days are deleted (live or archived) by the
+# purge_messages command; None keeps them forever. Conversation.retention_days
+# overrides it per conversation
+CHAT_RETENTION_DAYS = None
+
+# Per-connection outbound buffer: events waiting to be written to a client,
+# the most sent together in one frame, and how many frames may go out before
+# a client that acknowledges frames (?acks=1, or once it first acks) must
+# ack them. One that leaves them unacknowledged for CHAT_OUTBOUND_ACK_TIMEOUT
+# seconds is closed with a resync hint. CHAT_OUTBOUND_POLICY says what
+# happens when a slow client lets the buffer fill: 'drop-oldest',
+# 'coalesce' (also keep only the latest presence/read receipt per user) or
+# 'disconnect' (close with a resync hint; the client reconnects and replays)
+CHAT_OUTBOUND_BUFFER = 256
+CHAT_OUTBOUND_BATCH = 50
+CHAT_OUTBOUND_WINDOW = 64
+CHAT_OUTBOUND_ACK_TIMEOUT = 30
+CHAT_OUTBOUND_POLICY = 'coalesce'
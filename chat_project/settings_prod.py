@@ -5,30 +5,69 @@ from dotenv import load_dotenv
 load_dotenv()
 
 DEBUG = False
+
+# Trigram lookups for the user directory search
+INSTALLED_APPS = INSTALLED_APPS + ['django.contrib.postgres']
+CHAT_USER_TRIGRAM_SEARCH = os.getenv('CHAT_USER_TRIGRAM_SEARCH', 'false').lower() == 'true'
 ALLOWED_HOSTS = [os.getenv('DOMAIN_NAME', '*')]
 
 # Database
+# With DB_POOL on, each worker process keeps its connections open in a pool
+# (chat.backends.postgresql_pool) and Django borrows one per request or
+# database_sync_to_async call instead of connecting every time.
+# CONN_MAX_AGE = 0 makes Django hand connections back as soon as it's done.
+DB_POOL = os.getenv('DB_POOL', 'true').lower() == 'true'
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'chat.backends.postgresql_pool' if DB_POOL else 'django.db.backends.postgresql',
         'NAME': os.getenv('DB_NAME', 'chat_db'),
         'USER': os.getenv('DB_USER', 'chat_user'),
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST', 'localhost'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        'CONN_MAX_AGE': 0,
+        # Django's ASGI handler runs each HTTP request's sync code in a thread
+        # of its own, so connections in use aren't bounded by a thread count:
+        # the pool is the cap, at concurrent HTTP queries plus the consumers'
+        # shared DB thread and the message writer. Keep workers x DB_POOL_SIZE
+        # under max_connections; requests past the cap queue for up to
+        # DB_POOL_TIMEOUT seconds, short enough to shed load rather than let
+        # a backlog build behind a slow database
+        'POOL': {
+            'MAX_SIZE': int(os.getenv('DB_POOL_SIZE', 20)),
+            'TIMEOUT': float(os.getenv('DB_POOL_TIMEOUT', 3)),
+            'HEALTH_CHECK_INTERVAL': 30,
+            'MAX_LIFETIME': 3600,
+        },
     }
 }
 
 # Redis configuration
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # RedisChannelLayer plus a pipelined multi-group send
+        'BACKEND': 'chat.layers.FanoutRedisChannelLayer',
         'CONFIG': {
             'hosts': [(os.getenv('REDIS_HOST', 'localhost'), 6379)],
         },
     },
 }
 
+# Shared cache, so cached_db sessions are read from Redis in every worker
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/1",
+    },
+}
+
+# Per-user replay logs shared by all workers
+CHAT_REPLAY_REDIS_URL = f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/2"
+# Per-user message rate limits shared by all workers
+CHAT_RATELIMIT_REDIS_URL = f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/3"
+# Open connections per user counted across all workers, for presence
+CHAT_PRESENCE_REDIS_URL = f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/4"
+
 # Static and media files
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
@@ -1,16 +1,221 @@
+"""
+Run the ASGI application in several Daphne worker processes on one port.
+
+    python daphne_server.py --workers 4 --bind 0.0.0.0 --port 8001
+
+The parent binds the listening socket once and hands it to every worker,
+so the kernel spreads new connections across them. Workers must share a
+Redis channel layer (settings_prod) for messages to reach users connected
+to other workers.
+
+Signals to the parent:
+    SIGTERM/SIGINT  drain every worker, then exit
+    SIGHUP          rolling restart: replace workers one at a time, each
+                    old worker draining its WebSockets over --drain seconds
+
+A draining worker stops accepting connections straight away, then closes
+its WebSockets with code 1012 in small batches; the clients reconnect to
+the other workers, so a deploy never drops every user at the same moment.
+
+Workers write their metrics to a shared directory (--metrics-dir, a
+temporary one by default), so a scrape of /metrics answered by any
+worker reports totals for all of them.
+"""
+import argparse
+import asyncio
+import logging
 import os
+import shutil
+import signal
+import socket
+import subprocess
 import sys
-import django
+import tempfile
+import time
 from pathlib import Path
 
 # Add the project directory to the Python path
 BASE_DIR = Path(__file__).resolve().parent
 sys.path.append(str(BASE_DIR))
 
-# Set up Django settings
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings_prod')
-django.setup()
+logger = logging.getLogger('daphne_server')
+
+
+def run_worker(args):
+    # Importing daphne.server installs the asyncio Twisted reactor; it has
+    # to happen before anything else imports twisted
+    from daphne.server import Server
+    from twisted.internet import reactor
+
+    from chat_project.asgi import application
+    from django.conf import settings
+    from chat import metrics
+    from chat.workers import connection_registry
+
+    backend = settings.CHANNEL_LAYERS['default']['BACKEND']
+    if args.workers > 1 and backend.endswith('InMemoryChannelLayer'):
+        logger.warning("%s is per process; messages won't cross workers", backend)
+    if settings.CHAT_METRICS_DIR:
+        metrics.start_snapshots(settings.CHAT_METRICS_DIR)
+
+    class WorkerServer(Server):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.ports = []
+
+        def listen_success(self, port):
+            self.ports.append(port)
+            super().listen_success(port)
+
+    def shutdown():
+        if connection_registry.draining:
+            return
+        # Leave new connections to the other workers sharing the socket;
+        # otherwise clients closed with 1012 could reconnect straight back
+        for port in server.ports:
+            port.stopListening()
+        drain = asyncio.ensure_future(connection_registry.drain(args.drain))
+        drain.add_done_callback(lambda _: reactor.stop())
+
+    def install_signal_handlers():
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, shutdown)
+
+    reactor.callWhenRunning(install_signal_handlers)
+    server = WorkerServer(
+        application,
+        endpoints=[f"fd:fileno={args.worker_fd}"],
+        signal_handlers=False,
+        proxy_forwarded_address_header='X-Forwarded-For' if args.proxy_headers else None,
+        proxy_forwarded_port_header='X-Forwarded-Port' if args.proxy_headers else None,
+        proxy_forwarded_proto_header='X-Forwarded-Proto' if args.proxy_headers else None,
+    )
+    server.run()
+
+
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        self.workers = []
+        self.stopping = False
+        self.reloading = False
+
+        # Twisted adopts inherited sockets as IPv4 only
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((args.bind, args.port))
+        self.socket.listen(args.backlog)
+        self.socket.set_inheritable(True)
+
+        # Workers inherit CHAT_METRICS_DIR; snapshots of a previous run go
+        if args.metrics_dir:
+            self.metrics_dir = args.metrics_dir
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            for name in os.listdir(self.metrics_dir):
+                if name.endswith(('.json', '.tmp')):
+                    os.remove(os.path.join(self.metrics_dir, name))
+        else:
+            self.metrics_dir = tempfile.mkdtemp(prefix='chat-metrics-')
+        os.environ['CHAT_METRICS_DIR'] = self.metrics_dir
+
+    def spawn(self):
+        fd = self.socket.fileno()
+        command = [
+            sys.executable, __file__,
+            '--worker-fd', str(fd),
+            '--workers', str(self.args.workers),
+            '--drain', str(self.args.drain),
+        ]
+        if self.args.proxy_headers:
+            command.append('--proxy-headers')
+        worker = subprocess.Popen(command, pass_fds=[fd])
+        logger.info("Started worker %s", worker.pid)
+        return worker
+
+    def stop_worker(self, worker):
+        """SIGTERM a worker and wait for it to drain, killing it if it overruns."""
+        if worker.poll() is None:
+            worker.send_signal(signal.SIGTERM)
+        try:
+            worker.wait(self.args.drain + self.args.grace)
+        except subprocess.TimeoutExpired:
+            logger.warning("Worker %s did not drain in time; killing it", worker.pid)
+            worker.kill()
+            worker.wait()
+
+    def rolling_restart(self):
+        logger.info("Rolling restart of %d workers", len(self.workers))
+        for index, old in enumerate(list(self.workers)):
+            if self.stopping:
+                return
+            # Bring the replacement up first so capacity never drops
+            self.workers[index] = self.spawn()
+            time.sleep(self.args.boot_wait)
+            self.stop_worker(old)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        logger.info("Listening on %s:%s with %d workers", self.args.bind, self.args.port, self.args.workers)
+        self.workers = [self.spawn() for _ in range(self.args.workers)]
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.rolling_restart()
+            for index, worker in enumerate(self.workers):
+                if worker.poll() is not None and not self.stopping:
+                    logger.warning("Worker %s exited with %s; restarting", worker.pid, worker.returncode)
+                    self.workers[index] = self.spawn()
+            time.sleep(0.5)
+
+        # Drain all workers at once on shutdown
+        for worker in self.workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in self.workers:
+            self.stop_worker(worker)
+        self.socket.close()
+        if not self.args.metrics_dir:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--bind', default='127.0.0.1', help='IPv4 address to listen on')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--drain', type=float, default=10,
+                        help='seconds a stopping worker spreads its WebSocket closes over')
+    parser.add_argument('--grace', type=float, default=10,
+                        help='extra seconds to wait for a drained worker before killing it')
+    parser.add_argument('--boot-wait', type=float, default=2,
+                        help='seconds to let a replacement worker start during a rolling restart')
+    parser.add_argument('--proxy-headers', action='store_true',
+                        help='trust X-Forwarded-* headers from the reverse proxy')
+    parser.add_argument('--metrics-dir',
+                        help='directory for the workers\' metrics snapshots (default: a temporary one)')
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Set up Django settings
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings_prod')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(name)s %(message)s')
+
+    if args.worker_fd is not None:
+        run_worker(args)
+    else:
+        Supervisor(args).run()
+
 
-# Import after Django setup
-from channels.routing import get_default_application
-application = get_default_application() 
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -103,10 +103,8 @@ python manage.py collectstatic --noinput
 echo "Running migrations..."
 python manage.py migrate
 
-echo "Setting up Gunicorn..."
-sudo cp gunicorn.service /etc/systemd/system/
-sudo systemctl start gunicorn
-sudo systemctl enable gunicorn
+# Daphne now serves HTTP too; retire the old gunicorn service if present
+sudo systemctl disable --now gunicorn 2>/dev/null || true
 
 echo "Setting up Supervisor for Daphne..."
 sudo cp daphne.conf /etc/supervisor/conf.d/
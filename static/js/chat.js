@@ -1,9 +1,38 @@
 let selectedUserId = null;
 let chatSocket = null;
 let reconnectAttempts = 0;
-const maxReconnectAttempts = 5;
+const maxReconnectAttempts = 8;
+// Reconnect delays grow exponentially with full jitter, so clients dropped
+// together don't come back together
+const reconnectBaseDelay = 1000;
+const reconnectMaxDelay = 30000;
+// Seconds the server asked us to wait when it turned the connection away
+let retryAfter = null;
+// Highest per-user sequence number and message id received, sent on
+// reconnect so the server replays only what was missed
+let lastSeq = null;
+let lastSeenId = null;
 let isConnecting = false;
 let intentionalClose = false;
+let heartbeatTimer = null;
+let lastPong = 0;
+// Frames handled on the current socket, acknowledged so the server keeps
+// sending; it stops after CHAT_OUTBOUND_WINDOW unacknowledged frames
+const ackEvery = 16;
+const ackDelay = 250;
+let framesReceived = 0;
+let framesAcked = 0;
+let ackTimer = null;
+
+// Message history paging state for the selected conversation
+const historyPageSize = 50;
+let nextCursor = null;
+let lastMessageId = null;
+let loadingOlder = false;
+
+// Read receipts: newest message from the selected user, and the last receipt sent
+let lastIncomingId = null;
+let lastReadSent = null;
 
 // DOM Elements
 const messagesList = document.getElementById('messagesList');
@@ -12,6 +41,13 @@ const messageInput = document.getElementById('messageInput');
 const selectedUserHeader = document.getElementById('selectedUser');
 const sidebar = document.getElementById('sidebar');
 const sidebarToggle = document.getElementById('sidebarToggle');
+const connectionStatus = document.getElementById('connectionStatus');
+
+function setConnectionStatus(text, className) {
+    if (!connectionStatus) return;
+    connectionStatus.textContent = text;
+    connectionStatus.className = `text-xs ${className || 'text-gray-500'}`;
+}
 
 // Initialize UI state
 if (messageInput) messageInput.disabled = true;
@@ -31,6 +67,52 @@ if (messagesList) {
     `;
 }
 
+function startHeartbeat(intervalSeconds) {
+    stopHeartbeat();
+    if (!intervalSeconds) return;
+    const interval = intervalSeconds * 1000;
+    lastPong = Date.now();
+    heartbeatTimer = setInterval(() => {
+        if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) return;
+        if (Date.now() - lastPong > interval * 2) {
+            // Two missed pongs: the connection is dead even if the browser hasn't noticed
+            console.log('Heartbeat timed out, reconnecting');
+            chatSocket.close();
+            return;
+        }
+        chatSocket.send(JSON.stringify({ type: 'ping' }));
+    }, interval);
+}
+
+function stopHeartbeat() {
+    if (heartbeatTimer) {
+        clearInterval(heartbeatTimer);
+        heartbeatTimer = null;
+    }
+}
+
+function sendAck() {
+    clearTimeout(ackTimer);
+    ackTimer = null;
+    if (framesAcked === framesReceived) return;
+    if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) return;
+    chatSocket.send(JSON.stringify({ type: 'ack', frames: framesReceived }));
+    framesAcked = framesReceived;
+}
+
+function frameHandled() {
+    framesReceived++;
+    if (framesReceived - framesAcked >= ackEvery) {
+        sendAck();
+    } else if (ackTimer === null) {
+        ackTimer = setTimeout(sendAck, ackDelay);
+    }
+}
+
+function backoffDelay(attempt) {
+    return Math.random() * Math.min(reconnectMaxDelay, reconnectBaseDelay * Math.pow(2, attempt));
+}
+
 function connectWebSocket() {
     if (isConnecting) return; // Prevent multiple connection attempts
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) return;
@@ -39,7 +121,11 @@ function connectWebSocket() {
     intentionalClose = false;
 
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${protocol}//${window.location.hostname}:8001/ws/chat/`;
+    // We acknowledge frames, so the server may hold events back until we do
+    const resume = new URLSearchParams({ acks: '1' });
+    if (lastSeq !== null) resume.set('last_seq', lastSeq);
+    if (lastSeenId !== null) resume.set('last_id', lastSeenId);
+    const wsUrl = `${protocol}//${window.location.hostname}:8001/ws/chat/?${resume}`;
     
     console.log('Attempting to connect to:', wsUrl);
     
@@ -49,48 +135,103 @@ function connectWebSocket() {
         }
 
         chatSocket = new WebSocket(wsUrl);
+        framesReceived = 0;
+        framesAcked = 0;
+        clearTimeout(ackTimer);
+        ackTimer = null;
 
         chatSocket.onopen = function() {
             console.log('WebSocket connection established');
             isConnecting = false;
             reconnectAttempts = 0;
             
-            // Only show connection message if a user is selected
-            if (selectedUserId) {
-                messagesList.innerHTML = `
-                    <div class="flex justify-center">
-                        <div class="bg-green-100 text-green-700 px-4 py-2 rounded-full text-sm">
-                            Connected to chat server
-                        </div>
-                    </div>
-                `;
-                // Reload messages if a user was selected
-                loadMessageHistory(selectedUserId);
-            }
+            setConnectionStatus('Connected', 'text-green-600');
         };
 
+        function updatePresence(userId, isActive) {
+            document.querySelectorAll(`.user-button[data-user-id="${userId}"] .absolute`).forEach(dot => {
+                dot.classList.toggle('bg-emerald-500', isActive);
+                dot.classList.toggle('bg-gray-400', !isActive);
+            });
+        }
+
         chatSocket.onmessage = function(e) {
             try {
+                // Events that piled up server-side arrive together as an array
                 const data = JSON.parse(e.data);
+                (Array.isArray(data) ? data : [data]).forEach(handleEvent);
+            } catch (error) {
+                console.error('Error processing message:', error);
+            }
+            frameHandled();
+        };
+
+        function handleEvent(data) {
+            try {
                 console.log('Received message:', data);
                 
                 // Only process messages if they contain an error or if a user is selected
-                if (data.error) {
+                if (data.type === 'connection_established') {
+                    startHeartbeat(data.heartbeat_interval);
+                    // The server replays missed messages right after this;
+                    // if it can't, fetch what was missed for the open chat
+                    if (!data.resumed && selectedUserId) {
+                        syncNewMessages(selectedUserId);
+                    }
+                    lastSeq = data.seq;
+                } else if (data.type === 'retry_after') {
+                    retryAfter = data.retry_after;
+                } else if (data.type === 'messages_dropped') {
+                    // We fell behind and the server skipped some events
+                    if (selectedUserId) syncNewMessages(selectedUserId);
+                } else if (data.type === 'pong') {
+                    lastPong = Date.now();
+                } else if (data.type === 'rate_limited') {
+                    // The message wasn't sent; say so without clearing the chat
+                    console.warn(`Rate limited, retry in ${data.retry_after}s`);
+                    setConnectionStatus('Sending too fast, slow down', 'text-yellow-500');
+                    setTimeout(() => {
+                        if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+                            setConnectionStatus('Connected', 'text-green-600');
+                        }
+                    }, data.retry_after * 1000 + 1000);
+                } else if (data.error) {
                     console.error('Received error:', data.error);
                     if (selectedUserId) {  // Only show errors if a user is selected
                         messagesList.innerHTML = `<div class="text-center text-red-500 p-2">${data.error}</div>`;
                     }
-                } else if (selectedUserId) {  // Only process messages if a user is selected
-                    addMessage(data);
+                } else if (data.type === 'presence') {
+                    updatePresence(data.user_id, data.is_active);
+                } else if (data.type === 'persisted') {
+                    // A message shown under a temporary id has been saved
+                    if (data.seq !== undefined) lastSeq = Math.max(lastSeq || 0, data.seq);
+                    lastSeenId = Math.max(lastSeenId || 0, data.id);
+                    messagePersisted(data);
+                } else if (data.type === 'persist_failed') {
+                    if (data.seq !== undefined) lastSeq = Math.max(lastSeq || 0, data.seq);
+                    messageNotPersisted(data);
+                } else if (data.type === 'read_receipt') {
+                    if (selectedUserId && parseInt(data.reader_id) === parseInt(selectedUserId)) {
+                        markMessagesRead(data.up_to);
+                    }
+                } else if (data.content !== undefined) {
+                    if (data.seq !== undefined) lastSeq = Math.max(lastSeq || 0, data.seq);
+                    if (data.id) lastSeenId = Math.max(lastSeenId || 0, data.id);
+                    updateConversationPreview(data);
+                    if (selectedUserId && isForSelectedConversation(data)) {
+                        addMessage(data);
+                        sendReadReceipt();
+                    }
                 }
             } catch (error) {
                 console.error('Error processing message:', error);
             }
-        };
+        }
 
         chatSocket.onclose = function(e) {
             console.log('WebSocket connection closed. Code:', e.code, 'Reason:', e.reason);
             isConnecting = false;
+            stopHeartbeat();
             
             if (e.code === 4001) {
                 messagesList.innerHTML = '<div class="text-center text-red-500 p-2">Authentication required</div>';
@@ -102,11 +243,39 @@ function connectWebSocket() {
                 return;
             }
 
-            messagesList.innerHTML = '<div class="text-center text-yellow-500 p-2">Disconnected from chat server</div>';
+            if (e.code === 1012) {
+                // Server worker restarting: reconnect soon, spread out so the
+                // other workers aren't hit by every client at once
+                setConnectionStatus('Reconnecting...', 'text-yellow-500');
+                reconnectAttempts = 0;
+                setTimeout(connectWebSocket, backoffDelay(1) + 500);
+                return;
+            }
+
+            if (e.code === 4008) {
+                // We fell too far behind: reconnect straight away and let the
+                // server replay from lastSeq
+                setConnectionStatus('Reconnecting...', 'text-yellow-500');
+                setTimeout(connectWebSocket, backoffDelay(0));
+                return;
+            }
+
+            if (e.code === 1013 && retryAfter !== null) {
+                // Server is admitting connections slowly: come back when told,
+                // plus jitter. Doesn't count as a failed attempt.
+                setConnectionStatus('Reconnecting...', 'text-yellow-500');
+                const delay = retryAfter * 1000 * (1 + Math.random() * 0.5);
+                retryAfter = null;
+                console.log(`Server busy, reconnecting in ${(delay/1000).toFixed(1)} seconds...`);
+                setTimeout(connectWebSocket, delay);
+                return;
+            }
+
+            setConnectionStatus('Disconnected', 'text-yellow-500');
             
             if (reconnectAttempts < maxReconnectAttempts) {
-                const delay = Math.min(1000 * Math.pow(2, reconnectAttempts), 10000);
-                console.log(`Reconnecting in ${delay/1000} seconds...`);
+                const delay = backoffDelay(reconnectAttempts);
+                console.log(`Reconnecting in ${(delay/1000).toFixed(1)} seconds...`);
                 setTimeout(() => {
                     console.log('Attempting to reconnect...');
                     reconnectAttempts++;
@@ -143,57 +312,126 @@ document.addEventListener('DOMContentLoaded', function() {
     setupMessageForm();
 });
 
-// Add user search functionality
+// User directory search, served page by page from /api/users/
 const userSearch = document.getElementById('userSearch');
 const allUsersList = document.getElementById('allUsersList');
-const userButtons = document.querySelectorAll('.user-button');
+const userSearchSection = document.getElementById('userSearchSection');
+const loadMoreUsers = document.getElementById('loadMoreUsers');
+let userSearchTimer = null;
+let userSearchCursor = null;
+let userSearchQuery = '';
+
+function formatLastSeen(user) {
+    if (user.is_active) return 'Active Now';
+    if (!user.last_seen) return 'Offline';
+    return `Last seen: ${new Date(user.last_seen).toLocaleString()}`;
+}
+
+function createUserButton(user) {
+    const button = document.createElement('button');
+    button.className = 'user-button w-full text-left p-3 rounded-xl hover:bg-gray-50 transition-colors flex items-center space-x-3 group';
+    button.dataset.userId = user.id;
+    button.dataset.username = user.username;
+    button.innerHTML = `
+        <div class="relative flex-shrink-0">
+            <div class="w-12 h-12 rounded-full bg-blue-100 flex items-center justify-center group-hover:bg-blue-200 transition-colors">
+                <span class="text-blue-600 font-semibold text-lg"></span>
+            </div>
+            <div class="absolute bottom-0 right-0 w-3.5 h-3.5 ${user.is_active ? 'bg-emerald-500' : 'bg-gray-400'} rounded-full border-2 border-white"></div>
+        </div>
+        <div class="flex-1 min-w-0">
+            <span class="font-medium text-gray-900"></span>
+            <p class="text-sm text-gray-500 truncate"></p>
+        </div>
+    `;
+    button.querySelector('.text-lg').textContent = user.username.charAt(0).toUpperCase();
+    button.querySelector('.font-medium').textContent = user.username;
+    button.querySelector('p').textContent = formatLastSeen(user);
+    return button;
+}
+
+async function searchUsers(query, cursor) {
+    const params = new URLSearchParams({ q: query });
+    if (cursor) params.set('cursor', cursor);
+
+    try {
+        const response = await fetch(`/api/users/?${params}`);
+        const users = await response.json();
+        if (query !== userSearchQuery) return;
+
+        if (!cursor) allUsersList.innerHTML = '';
+        users.forEach(user => allUsersList.appendChild(createUserButton(user)));
+        if (!cursor && users.length === 0) {
+            allUsersList.innerHTML = '<p class="text-sm text-gray-500">No users found</p>';
+        }
+
+        userSearchCursor = response.headers.get('X-Next-Cursor');
+        loadMoreUsers.classList.toggle('hidden', !userSearchCursor);
+    } catch (error) {
+        console.error('Error searching users:', error);
+    }
+}
 
-if (userSearch) {
+if (userSearch && allUsersList) {
     userSearch.addEventListener('input', function(e) {
-        const searchTerm = e.target.value.toLowerCase();
-        
-        userButtons.forEach(button => {
-            const username = button.dataset.username.toLowerCase();
-            const shouldShow = username.includes(searchTerm);
-            button.style.display = shouldShow ? 'flex' : 'none';
-        });
+        clearTimeout(userSearchTimer);
+        userSearchTimer = setTimeout(() => {
+            userSearchQuery = e.target.value.trim();
+            userSearchCursor = null;
+            userSearchSection.classList.toggle('hidden', !userSearchQuery);
+            if (userSearchQuery) {
+                searchUsers(userSearchQuery);
+            } else {
+                allUsersList.innerHTML = '';
+            }
+        }, 250);
+    });
+
+    loadMoreUsers.addEventListener('click', function() {
+        if (userSearchCursor) searchUsers(userSearchQuery, userSearchCursor);
     });
 }
 
-// Enhance user selection with active state
+// Enhance user selection with active state. Delegated, since search
+// results are rendered after page load.
 function setupUserSelection() {
-    const userButtons = document.querySelectorAll('.user-button');
     let activeChat = null;
 
-    userButtons.forEach(button => {
-        button.addEventListener('click', function() {
-            // Remove active state from previous chat
-            if (activeChat) {
-                activeChat.classList.remove('bg-blue-50', 'border-blue-500');
-            }
+    document.addEventListener('click', function(e) {
+        const button = e.target.closest('.user-button');
+        if (!button) return;
 
-            // Add active state to current chat
-            this.classList.add('bg-blue-50', 'border-blue-500');
-            activeChat = this;
+        // Remove active state from previous chat
+        if (activeChat) {
+            activeChat.classList.remove('bg-blue-50', 'border-blue-500');
+        }
 
-            // Set up chat
-            selectedUserId = this.dataset.userId;
-            const username = this.dataset.username;
-            
-            // Update UI
-            selectedUserHeader.textContent = username;
-            messageInput.disabled = false;
-            messageForm.querySelector('button').disabled = false;
-            
-            // Load messages
-            messagesList.innerHTML = '<div class="text-center text-gray-500">Loading messages...</div>';
-            loadMessageHistory(selectedUserId);
+        // Add active state to current chat
+        button.classList.add('bg-blue-50', 'border-blue-500');
+        activeChat = button;
+
+        // Set up chat
+        selectedUserId = button.dataset.userId;
+        clearUnreadBadge(selectedUserId);
+        nextCursor = null;
+        lastMessageId = null;
+        lastIncomingId = null;
+        lastReadSent = null;
+        const username = button.dataset.username;
+        
+        // Update UI
+        selectedUserHeader.textContent = username;
+        messageInput.disabled = false;
+        messageForm.querySelector('button').disabled = false;
+        
+        // Load messages
+        messagesList.innerHTML = '<div class="text-center text-gray-500">Loading messages...</div>';
+        loadMessageHistory(selectedUserId);
 
-            // Close sidebar on mobile
-            if (window.innerWidth < 768) {
-                sidebar.classList.add('-translate-x-full');
-            }
-        });
+        // Close sidebar on mobile
+        if (window.innerWidth < 768) {
+            sidebar.classList.add('-translate-x-full');
+        }
     });
 }
 
@@ -217,12 +455,65 @@ function setupMessageForm() {
     });
 }
 
-// Load message history
+// Normalise an /api/messages/ row to the shape used by WebSocket events
+function toMessageData(message) {
+    return {
+        id: message.id,
+        sender: message.sender_username,
+        sender_id: message.sender,
+        recipient_id: message.recipient,
+        content: message.content,
+        timestamp: message.timestamp,
+        is_read: message.is_read
+    };
+}
+
+function isForSelectedConversation(data) {
+    const selected = parseInt(selectedUserId);
+    return parseInt(data.sender_id) === selected || parseInt(data.recipient_id) === selected;
+}
+
+function createDateSeparator(date) {
+    const dateElement = document.createElement('div');
+    dateElement.className = 'flex justify-center my-4';
+    dateElement.dataset.date = date;
+    dateElement.innerHTML = `
+        <div class="bg-gray-100 text-gray-500 px-3 py-1 rounded-full text-xs">
+            ${date}
+        </div>
+    `;
+    return dateElement;
+}
+
+// Render a page of messages (oldest first) with date separators
+function renderMessageBatch(messages) {
+    const fragment = document.createDocumentFragment();
+    let currentDate = null;
+    messages.forEach(message => {
+        const date = new Date(message.timestamp).toLocaleDateString();
+        if (date !== currentDate) {
+            fragment.appendChild(createDateSeparator(date));
+            currentDate = date;
+        }
+        fragment.appendChild(createMessageElement(toMessageData(message)));
+    });
+    return fragment;
+}
+
+function messagesUrl(userId, params) {
+    const query = new URLSearchParams({ user_id: userId, page_size: historyPageSize, ...params });
+    return `/api/messages/?${query}`;
+}
+
+// Load the newest page of message history
 async function loadMessageHistory(userId) {
     try {
-        const response = await fetch(`/api/messages/?user_id=${userId}`);
+        const response = await fetch(messagesUrl(userId));
         const messages = await response.json();
-        
+        if (userId !== selectedUserId) return;
+
+        nextCursor = response.headers.get('X-Next-Cursor');
+        lastMessageId = null;
         messagesList.innerHTML = '';
         
         if (messages.length === 0) {
@@ -236,40 +527,11 @@ async function loadMessageHistory(userId) {
             return;
         }
 
-        // Group messages by date
-        const messagesByDate = messages.reduce((groups, message) => {
-            const date = new Date(message.timestamp).toLocaleDateString();
-            if (!groups[date]) {
-                groups[date] = [];
-            }
-            groups[date].push(message);
-            return groups;
-        }, {});
-
-        // Add messages with date separators
-        Object.entries(messagesByDate).forEach(([date, dateMessages]) => {
-            // Add date separator
-            const dateElement = document.createElement('div');
-            dateElement.className = 'flex justify-center my-4';
-            dateElement.innerHTML = `
-                <div class="bg-gray-100 text-gray-500 px-3 py-1 rounded-full text-xs">
-                    ${date}
-                </div>
-            `;
-            messagesList.appendChild(dateElement);
-
-            // Add messages for this date
-            dateMessages.forEach(message => {
-                addMessage({
-                    sender: message.sender_username,
-                    sender_id: message.sender,
-                    content: message.content,
-                    timestamp: message.timestamp
-                });
-            });
-        });
-
+        messagesList.appendChild(renderMessageBatch(messages));
+        lastMessageId = messages[messages.length - 1].id;
+        messages.forEach(message => trackIncoming(toMessageData(message)));
         messagesList.scrollTop = messagesList.scrollHeight;
+        sendReadReceipt();
     } catch (error) {
         console.error('Error loading messages:', error);
         messagesList.innerHTML = `
@@ -282,14 +544,71 @@ async function loadMessageHistory(userId) {
     }
 }
 
-// Add a message to the UI
-function addMessage(data) {
-    // Don't add messages if no user is selected
-    if (!selectedUserId) return;
-    
+// Fetch older pages lazily as the user scrolls up
+async function loadOlderMessages() {
+    if (!nextCursor || loadingOlder || !selectedUserId) return;
+    loadingOlder = true;
+    const userId = selectedUserId;
+
+    try {
+        const response = await fetch(messagesUrl(userId, { cursor: nextCursor }));
+        const messages = await response.json();
+        if (userId !== selectedUserId) return;
+
+        nextCursor = response.headers.get('X-Next-Cursor');
+        if (messages.length === 0) return;
+
+        // Drop the separator at the top if the new page ends on the same day
+        const lastDate = new Date(messages[messages.length - 1].timestamp).toLocaleDateString();
+        const firstElement = messagesList.firstElementChild;
+        if (firstElement && firstElement.dataset.date === lastDate) {
+            firstElement.remove();
+        }
+
+        const previousHeight = messagesList.scrollHeight;
+        messagesList.insertBefore(renderMessageBatch(messages), messagesList.firstChild);
+        messagesList.scrollTop += messagesList.scrollHeight - previousHeight;
+    } catch (error) {
+        console.error('Error loading older messages:', error);
+    } finally {
+        loadingOlder = false;
+    }
+}
+
+// After a reconnect, fetch only messages newer than the last one shown
+async function syncNewMessages(userId) {
+    if (lastMessageId === null) {
+        return loadMessageHistory(userId);
+    }
+
+    try {
+        let messages;
+        do {
+            const response = await fetch(messagesUrl(userId, { after_id: lastMessageId }));
+            messages = await response.json();
+            if (userId !== selectedUserId) return;
+            messages.forEach(message => addMessage(toMessageData(message)));
+        } while (messages.length === historyPageSize);
+        sendReadReceipt();
+    } catch (error) {
+        console.error('Error syncing messages:', error);
+    }
+}
+
+if (messagesList) {
+    messagesList.addEventListener('scroll', function() {
+        if (messagesList.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
+}
+
+function createMessageElement(data) {
     const isCurrentUser = parseInt(data.sender_id) === parseInt(currentUserId);
     const messageElement = document.createElement('div');
     messageElement.className = `flex ${isCurrentUser ? 'justify-end' : 'justify-start'} mb-4`;
+    if (data.id) messageElement.dataset.messageId = data.id;
+    else if (data.temp_id) messageElement.dataset.tempId = data.temp_id;
     
     // Get sender name, fallback to sender_username if sender is not available
     const senderName = data.sender || data.sender_username || 'Unknown';
@@ -320,19 +639,111 @@ function addMessage(data) {
                         ${isCurrentUser ? 'rounded-tr-none' : 'rounded-tl-none'}">
                 ${data.content}
             </div>
-            ${timeString ? `
+            ${timeString || isCurrentUser ? `
                 <div class="text-xs text-gray-500 mt-1">
-                    ${timeString}
+                    ${timeString}${isCurrentUser ? `<span class="read-marker ${data.is_read ? '' : 'hidden'}"> · Read</span>` : ''}
                 </div>
             ` : ''}
         </div>
     `;
     
     messageElement.innerHTML = messageContent;
-    messagesList.appendChild(messageElement);
+    return messageElement;
+}
+
+// Add a message to the UI
+function addMessage(data) {
+    // Don't add messages if no user is selected
+    if (!selectedUserId) return;
+
+    // Skip messages already shown (e.g. delivered live and then re-synced)
+    if (data.id) {
+        if (lastMessageId !== null && data.id <= lastMessageId) return;
+        if (lastMessageId === null) messagesList.innerHTML = '';
+        lastMessageId = data.id;
+        trackIncoming(data);
+    }
+
+    messagesList.appendChild(createMessageElement(data));
     messagesList.scrollTop = messagesList.scrollHeight;
 }
 
+// Give a message delivered before it was saved its real id
+function messagePersisted(data) {
+    const element = messagesList && messagesList.querySelector(`[data-temp-id="${data.temp_id}"]`);
+    if (!element) return;
+    element.dataset.messageId = data.id;
+    delete element.dataset.tempId;
+    lastMessageId = Math.max(lastMessageId || 0, data.id);
+    trackIncoming(data);
+    sendReadReceipt();
+}
+
+function messageNotPersisted(data) {
+    const element = messagesList && messagesList.querySelector(`[data-temp-id="${data.temp_id}"]`);
+    if (!element) return;
+    element.classList.add('opacity-50');
+    element.title = 'This message could not be saved';
+}
+
+function trackIncoming(data) {
+    if (data.id && parseInt(data.sender_id) === parseInt(selectedUserId)) {
+        lastIncomingId = Math.max(lastIncomingId || 0, data.id);
+    }
+}
+
+// Tell the server we've read everything up to the newest incoming message.
+// The server coalesces these, so sending one per new message is fine.
+function sendReadReceipt() {
+    if (document.hidden || !selectedUserId || lastIncomingId === null) return;
+    if (lastReadSent !== null && lastIncomingId <= lastReadSent) return;
+    if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) return;
+
+    chatSocket.send(JSON.stringify({
+        type: 'read',
+        sender_id: selectedUserId,
+        up_to: lastIncomingId
+    }));
+    lastReadSent = lastIncomingId;
+}
+
+// Keep the Recent Chats entry for this conversation current
+function updateConversationPreview(data) {
+    const recentChats = document.getElementById('recentChatsList');
+    if (!recentChats) return;
+
+    const isOwn = parseInt(data.sender_id) === parseInt(currentUserId);
+    const otherId = isOwn ? data.recipient_id : data.sender_id;
+    const button = recentChats.querySelector(`.conversation-button[data-user-id="${otherId}"]`);
+    if (!button) return;
+
+    const snippet = button.querySelector('.conversation-snippet');
+    if (snippet) snippet.textContent = `${isOwn ? 'You: ' : ''}${data.content}`;
+
+    const badge = button.querySelector('.unread-badge');
+    if (badge && !isOwn && parseInt(otherId) !== parseInt(selectedUserId)) {
+        badge.textContent = (parseInt(badge.textContent) || 0) + 1;
+        badge.classList.remove('hidden');
+    }
+    recentChats.prepend(button);
+}
+
+function clearUnreadBadge(userId) {
+    document.querySelectorAll(`.conversation-button[data-user-id="${userId}"] .unread-badge`).forEach(badge => {
+        badge.textContent = '0';
+        badge.classList.add('hidden');
+    });
+}
+
+function markMessagesRead(upTo) {
+    messagesList.querySelectorAll('[data-message-id]').forEach(element => {
+        if (parseInt(element.dataset.messageId) <= upTo) {
+            const marker = element.querySelector('.read-marker');
+            if (marker) marker.classList.remove('hidden');
+        }
+    });
+}
+
 // Handle page visibility changes
 document.addEventListener('visibilitychange', function() {
     if (document.hidden) {